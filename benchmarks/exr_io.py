@@ -0,0 +1,124 @@
+"""
+Benchmarks OpenEXR compression methods and pixel types of raw and composed
+images. Logs a table of write and read throughput, file size and the
+relative error of channel sums, which the compositor uses for calibration.
+"""
+
+import logging
+import time
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from sispo.sim import utilities as utils
+
+logger = logging.getLogger("exr_io")
+logger.setLevel(logging.DEBUG)
+logger_formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(funcName)s - %(message)s"
+)
+
+now = datetime.now().strftime("%Y-%m-%dT%H%M%S%z")
+filename = "exr_io.log"
+res_dir = Path(".").resolve()
+res_dir = res_dir / now
+Path.mkdir(res_dir)
+log_file = res_dir / filename
+file_handler = logging.FileHandler(str(log_file))
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logger_formatter)
+logger.addHandler(file_handler)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setLevel(logging.DEBUG)
+stream_handler.setFormatter(logger_formatter)
+logger.addHandler(stream_handler)
+
+
+def create_images(res, rng):
+    """Creates a sparse starmap and a smooth SSSB image with alpha."""
+    (width, height) = res
+
+    stars = np.zeros((height, width, 4), np.float32)
+    num_stars = width * height // 500
+    y = rng.integers(0, height, num_stars)
+    x = rng.integers(0, width, num_stars)
+    flux = np.power(10., -0.4 * rng.uniform(0, 12, num_stars))
+    stars[y, x, 0:3] = flux[:, None]
+    stars[:, :, 3] = 1.
+
+    y_grid, x_grid = np.mgrid[0:height, 0:width]
+    radius = np.hypot(y_grid - height / 2, x_grid - width / 2)
+    sssb = np.zeros((height, width, 4), np.float32)
+    sssb[:, :, 3] = radius < min(res) / 4
+    shading = np.cos(np.minimum(radius / (min(res) / 4), 1) * np.pi / 2)
+    sssb[:, :, 0:3] = (shading * sssb[:, :, 3])[:, :, None]
+    sssb[:, :, 0:3] += rng.normal(0, 0.01, (height, width, 3))
+
+    return {"Stars": stars, "SssbOnly": sssb}
+
+
+def time_func(func, iterations, *args, **kwargs):
+    """Minimum execution time of func over given number of iterations."""
+    times = []
+    for _ in range(iterations):
+        start = time.time()
+        func(*args, **kwargs)
+        end = time.time()
+        times.append(end - start)
+
+    return min(times)
+
+
+def benchmark(iterations=3, resolutions=((800, 600), (2456, 2054))):
+    """Executes benchmark."""
+    logger.debug("Starting OpenEXR benchmarking")
+    logger.debug("Iterations: #%d", iterations)
+
+    rng = np.random.default_rng(0)
+    exr_file = res_dir / "benchmark.exr"
+
+    for res in resolutions:
+        images = create_images(res, rng)
+
+        for name, image in images.items():
+            megabytes = image.nbytes / 1E6
+            ref_sums = np.sum(image, axis=(0, 1), dtype=np.float64)
+            logger.debug("Res: %s; image: %s; half check: %s", res, name,
+                         utils.check_half_precision(image))
+            logger.debug("%-6s %-5s %10s %10s %10s %12s", "codec", "type",
+                         "write MB/s", "read MB/s", "size MB", "sum error")
+
+            for compression in utils.EXR_COMPRESSIONS:
+                for half in (False, True):
+                    time_write = time_func(
+                        utils.write_openexr_image, iterations, exr_file,
+                        image, compression=compression, half=half,
+                        half_rtol=np.inf
+                    )
+                    time_read = time_func(
+                        utils.read_openexr_image, iterations, exr_file
+                    )
+
+                    result = utils.read_openexr_image(exr_file)
+                    sums = np.sum(result, axis=(0, 1), dtype=np.float64)
+                    error = np.max(np.abs(sums - ref_sums) / ref_sums)
+                    size = exr_file.stat().st_size / 1E6
+
+                    logger.debug("%-6s %-5s %10.1f %10.1f %10.2f %12.3e",
+                                 compression, "HALF" if half else "FLOAT",
+                                 megabytes / time_write,
+                                 megabytes / time_read, size, error)
+
+    exr_file.unlink()
+
+
+if __name__ == "__main__":
+    args = {}
+    try:
+        args["iterations"] = int(sys.argv[1])
+    except Exception:
+        logger.debug("No number of iterations given")
+
+    benchmark(**args)
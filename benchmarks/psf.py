@@ -0,0 +1,124 @@
+"""
+Benchmarks PSF convolution engines against the former Gaussian blur of
+Instrument.sense. Compares cv2.GaussianBlur with separable, spatial and
+overlap-add FFT convolution for several sigmas and sensor sizes.
+"""
+
+import logging
+import time
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from sispo.sim import psf
+
+logger = logging.getLogger("psf")
+logger.setLevel(logging.DEBUG)
+logger_formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(funcName)s - %(message)s"
+)
+
+now = datetime.now().strftime("%Y-%m-%dT%H%M%S%z")
+filename = "psf.log"
+res_dir = Path(".").resolve()
+res_dir = res_dir / now
+Path.mkdir(res_dir)
+log_file = res_dir / filename
+file_handler = logging.FileHandler(str(log_file))
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logger_formatter)
+logger.addHandler(file_handler)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setLevel(logging.DEBUG)
+stream_handler.setFormatter(logger_formatter)
+logger.addHandler(stream_handler)
+
+
+def run_gauss(image, sigma):
+    """Former blur of Instrument.sense."""
+    kernel = int(round(4 * float(sigma)) * 2 + 1)
+    kernel = max(kernel, 5)
+    return cv2.GaussianBlur(image, (kernel, kernel), sigma)
+
+
+def run_engine(image, point_spread, engine):
+    """Convolution with a given engine."""
+    return point_spread.apply(image, engine=engine)
+
+
+def time_func(func, iterations, *args):
+    """Minimum execution time of func over given number of iterations."""
+    times = []
+    for _ in range(iterations):
+        start = time.time()
+        func(*args)
+        end = time.time()
+        times.append(end - start)
+
+    return min(times)
+
+
+def benchmark(iterations=3,
+              sigmas=(1, 2, 4, 8, 16, 32, 64),
+              resolutions=((800, 600), (2456, 2054), (6000, 4000))):
+    """Executes benchmark."""
+    logger.debug("Starting PSF benchmarking")
+    logger.debug("Iterations: #%d", iterations)
+
+    rng = np.random.default_rng(0)
+
+    for res in resolutions:
+        image = rng.random((res[1], res[0], 3), dtype=np.float32)
+
+        for sigma in sigmas:
+            kernel = int(round(4 * float(sigma)) * 2 + 1)
+            kernel = max(kernel, 5)
+            point_spread = psf.gaussian_psf(sigma, kernel)
+
+            reference = run_gauss(image, sigma)
+            time_ref = time_func(run_gauss, iterations, image, sigma)
+
+            times = []
+            for engine in ("separable", "spatial", "fft"):
+                result = run_engine(image, point_spread, engine)
+                diff = np.max(np.abs(result - reference))
+                time_engine = time_func(run_engine, iterations,
+                                        image, point_spread, engine)
+                times.append(time_engine)
+
+                logger.debug("Res: %s; sigma: %d; %s: %f s; gauss: %f s; "
+                             "ratio: %f; max difference: %e", res, sigma,
+                             engine, time_engine, time_ref,
+                             time_ref / time_engine, diff)
+
+            logger.debug("Res: %s; sigma: %d; auto selects %s", res, sigma,
+                         point_spread.select_engine(image.shape))
+
+    for res in resolutions:
+        image = rng.random((res[1], res[0], 3), dtype=np.float32)
+
+        for zero_radius in (2, 6, 15, 40):
+            point_spread = psf.airy_psf(zero_radius)
+
+            for engine in ("spatial", "fft"):
+                time_engine = time_func(run_engine, iterations,
+                                        image, point_spread, engine)
+                logger.debug("Res: %s; airy radius: %d; kernel: %s; %s: %f s",
+                             res, zero_radius, point_spread.shape, engine,
+                             time_engine)
+
+            logger.debug("Res: %s; airy radius: %d; auto selects %s", res,
+                         zero_radius, point_spread.select_engine(image.shape))
+
+
+if __name__ == "__main__":
+    args = {}
+    try:
+        args["iterations"] = int(sys.argv[1])
+    except Exception:
+        logger.debug("No number of iterations given")
+
+    benchmark(**args)
@@ -0,0 +1,222 @@
+"""
+Benchmarks star projection of the starmap rendering.
+Compares the former per star loop against the vectorised projection for
+star counts from 10^2 to 10^6. Also compares the former supersampled
+gaussian blur of the starmap against splatting star stamps.
+"""
+
+import logging
+import time
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from sispo.sim import starcat
+
+logger = logging.getLogger("starmap")
+logger.setLevel(logging.DEBUG)
+logger_formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(funcName)s - %(message)s"
+)
+
+now = datetime.now().strftime("%Y-%m-%dT%H%M%S%z")
+filename = "starmap.log"
+res_dir = Path(".").resolve()
+res_dir = res_dir / now
+Path.mkdir(res_dir)
+log_file = res_dir / filename
+file_handler = logging.FileHandler(str(log_file))
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logger_formatter)
+logger.addHandler(file_handler)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setLevel(logging.DEBUG)
+stream_handler.setFormatter(logger_formatter)
+logger.addHandler(stream_handler)
+
+
+def create_fov_vecs(fov_half=0.05, aspect=4 / 3):
+    """Creates camera vectors of a camera looking at an arbitrary direction."""
+    direction = np.array([0.3, -0.8, 0.2])
+    direction /= np.linalg.norm(direction)
+    up_vec = np.cross(direction, (0.0, 0.0, 1.0))
+    up_vec /= np.linalg.norm(up_vec)
+    right_vec = np.cross(direction, up_vec)
+
+    right_edge = direction + right_vec * fov_half * aspect
+    left_edge = direction - right_vec * fov_half * aspect
+    upper_edge = direction + up_vec * fov_half
+    lower_edge = direction - up_vec * fov_half
+
+    return (direction, right_edge, left_edge, upper_edge, lower_edge)
+
+
+def create_stardata(direction, num_stars, seed=0):
+    """Creates random stars around the given direction."""
+    rng = np.random.default_rng(seed)
+
+    dec = np.degrees(np.arcsin(direction[2]))
+    ra = np.degrees(np.arccos(direction[0] / np.cos(np.radians(dec))))
+    ra += 180
+
+    stardata = np.empty((num_stars, 3), np.float64)
+    stardata[:, 0] = ra + rng.uniform(-4, 4, num_stars)
+    stardata[:, 1] = dec + rng.uniform(-4, 4, num_stars)
+    stardata[:, 2] = rng.uniform(0, 16, num_stars)
+
+    return stardata
+
+
+def run_loop(stardata, fov_vecs, res, ss):
+    """Former per star implementation of the starmap projection."""
+    (direction, right_edge, _, upper_edge, _) = fov_vecs
+    (res_x, res_y) = res
+
+    upper_edge = upper_edge - direction
+    right_edge = right_edge - direction
+    up_norm = upper_edge / np.linalg.norm(upper_edge)
+    right_norm = right_edge / np.linalg.norm(right_edge)
+    f_over_h_ccd_2 = 1.0 / np.linalg.norm(upper_edge)
+    f_over_w_ccd_2 = 1.0 / np.linalg.norm(right_edge)
+
+    starmap = np.zeros((res_y * ss, res_x * ss), np.float32)
+
+    total_flux = 0.0
+    for star in stardata:
+        mag_star = star[2]
+        flux = np.power(10., -0.4 * mag_star)
+        total_flux += flux
+        ra_star = np.radians(star[0])
+        dec_star = np.radians(star[1])
+
+        z_star = np.sin(dec_star)
+        x_star = np.cos(dec_star) * np.cos(ra_star - np.pi)
+        y_star = -np.cos(dec_star) * np.sin(ra_star - np.pi)
+        vec = [x_star, y_star, z_star]
+        vec2 = [x_star, -y_star, z_star]
+        if np.dot(vec, direction) < np.dot(vec2, direction):
+            vec = vec2
+        x_pix = ss * ((f_over_w_ccd_2 * np.dot(right_norm, vec)
+                / np.dot(direction, vec) + 1.0)) * (res_x - 1) / 2.0
+        x_pix = min(round(x_pix), res_x * ss - 1)
+        x_pix = max(0, int(x_pix))
+        y_pix = ss * ((-f_over_h_ccd_2 * np.dot(up_norm, vec)
+                / np.dot(direction, vec) + 1.)) * (res_y - 1) / 2.
+        y_pix = min(round(y_pix), res_y * ss - 1)
+        y_pix = max(0, int(y_pix))
+        starmap[y_pix, x_pix] += flux
+
+    return starmap, total_flux
+
+
+def run_vectorised(stardata, fov_vecs, res, ss):
+    """Vectorised starmap projection."""
+    (res_x, res_y) = res
+    starmap = np.zeros((res_y * ss, res_x * ss), np.float32)
+
+    x_pix, y_pix, flux = starcat.project_stars(stardata, fov_vecs, res, ss)
+    np.add.at(starmap, (y_pix, x_pix), flux)
+
+    return starmap, np.sum(flux)
+
+
+def run_blur(stardata, fov_vecs, res, ss):
+    """Former supersampled gaussian blur and resize rendering."""
+    (res_x, res_y) = res
+    starmap = np.zeros((res_y * ss, res_x * ss, 4), np.float32)
+    starmap[:, :, 3] = 1.0
+
+    x_pix, y_pix, flux = starcat.project_stars(stardata, fov_vecs, res, ss)
+    np.add.at(starmap[:, :, 0], (y_pix, x_pix), flux)
+    starmap[:, :, 1] = starmap[:, :, 0]
+    starmap[:, :, 2] = starmap[:, :, 0]
+
+    sig = ss / 2.0
+    kernel = int((4 * sig + 0.5) * 2)
+    sm_gauss = cv2.GaussianBlur(
+        starmap, (kernel, kernel), sig, borderType=cv2.BORDER_REPLICATE
+    )
+    sm_scale = cv2.resize(
+        sm_gauss, None, fx=1 / ss, fy=1 / ss, interpolation=cv2.INTER_AREA
+    )
+    sm_scale *= ss * ss
+
+    return sm_scale[:, :, 0]
+
+
+def run_splat(stardata, fov_vecs, res, ss):
+    """Splatting of precomputed star stamps at final resolution."""
+    (res_x, res_y) = res
+
+    x_pix, y_pix, flux = starcat.project_stars(stardata, fov_vecs, res, ss)
+
+    return starcat.splat_stars((res_y, res_x), x_pix, y_pix, flux, ss)
+
+
+def time_func(func, iterations, *args):
+    """Minimum execution time of func over given number of iterations."""
+    times = []
+    for _ in range(iterations):
+        start = time.time()
+        func(*args)
+        end = time.time()
+        times.append(end - start)
+
+    return min(times)
+
+
+def benchmark(iterations=3, max_exp=6, res=(2456, 2054), ss=2):
+    """Executes benchmark."""
+    fov_vecs = create_fov_vecs()
+
+    logger.debug("Starting starmap projection benchmarking")
+    logger.debug("Resolution: %s, supersampling: %d", res, ss)
+    logger.debug("Iterations: #%d", iterations)
+
+    for exp in range(2, max_exp + 1):
+        num_stars = 10 ** exp
+        stardata = create_stardata(fov_vecs[0], num_stars)
+
+        starmap_loop, flux_loop = run_loop(stardata, fov_vecs, res, ss)
+        starmap_vec, flux_vec = run_vectorised(stardata, fov_vecs, res, ss)
+        diff = np.max(np.abs(starmap_loop - starmap_vec))
+        logger.debug("Stars: %d; max pixel difference: %e; flux difference: %e",
+                     num_stars, diff, flux_loop - flux_vec)
+
+        # The loop is too slow to be repeated for many stars
+        loop_iterations = iterations if exp < 5 else 1
+        time_loop = time_func(run_loop, loop_iterations,
+                              stardata, fov_vecs, res, ss)
+        time_vec = time_func(run_vectorised, iterations,
+                             stardata, fov_vecs, res, ss)
+
+        logger.debug("Stars: %d; loop: %f s; vectorised: %f s; ratio: %f",
+                     num_stars, time_loop, time_vec, time_loop / time_vec)
+
+        starmap_blur = run_blur(stardata, fov_vecs, res, ss)
+        starmap_splat = run_splat(stardata, fov_vecs, res, ss)
+        diff = np.max(np.abs(starmap_blur - starmap_splat))
+        logger.debug("Stars: %d; max blur/splat difference: %e; "
+                     "sum blur: %f; sum splat: %f", num_stars, diff,
+                     np.sum(starmap_blur), np.sum(starmap_splat))
+
+        time_blur = time_func(run_blur, iterations,
+                              stardata, fov_vecs, res, ss)
+        time_splat = time_func(run_splat, iterations,
+                               stardata, fov_vecs, res, ss)
+
+        logger.debug("Stars: %d; blur: %f s; splat: %f s; ratio: %f",
+                     num_stars, time_blur, time_splat, time_blur / time_splat)
+
+
+if __name__ == "__main__":
+    args = {}
+    try:
+        args["iterations"] = int(sys.argv[1])
+    except Exception:
+        logger.debug("No number of iterations given")
+
+    benchmark(**args)
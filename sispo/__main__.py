@@ -1,3 +1,5 @@
 import sispo
 
-sispo.main()
+# Guarded, render worker processes import this module as __mp_main__
+if __name__ == "__main__":
+    sispo.main()
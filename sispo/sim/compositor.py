@@ -7,7 +7,10 @@
 """
 
 import json
+import os
+import tempfile
 import threading
+from concurrent import futures
 from pathlib import Path
 from datetime import datetime
 
@@ -16,7 +19,7 @@
 from astropy import constants as const
 from astropy import units as u
 
-from . import utils
+from . import utilities as utils
 
 #Astrometric calibrations 
 #https://www.cfa.harvard.edu/~dfabricant/huchra/ay145/mags.html
@@ -24,6 +27,9 @@
 SUN_MAG_VBAND = -26.74 * u.mag  # 1 AU distance
 SUN_FLUX_VBAND_1AU = np.power(10., -0.4 * SUN_MAG_VBAND.value) * FLUX0_VBAND
 
+# Composition buffers, reused per worker thread (and process)
+_buffers = threading.local()
+
 
 class ImageCompositorError(RuntimeError):
     """This is a generic error for the compositor."""
@@ -31,13 +37,27 @@ class ImageCompositorError(RuntimeError):
 
 
 class Frame:
-    """Class to wrap all data of a single frame."""
+    """
+    Class to wrap all data of a single frame.
+
+    A frame is either created from images in memory, e.g. render results,
+    or from an image directory or a run store. The latter are read lazily
+    on first access. Only the channels used by the compositor are
+    read and the LightRef scene is only read in the rows needed for the
+    reference intensity. Tiles of rows can be read without reading the
+    complete scenes, see get_rows.
+    """
 
     metadata = None
-    stars = None
-    sssb_only = None
-    sssb_const_dist = None
-    light_ref = None
+
+    # Channels read from file for each scene, Stars alpha is not used
+    SCENE_CHANNELS = {
+        "Stars": ("R", "G", "B"),
+        "SssbOnly": ("R", "G", "B", "A"),
+        "SssbConstDist": ("R", "G", "B", "A"),
+        "LightRef": ("R", "G", "B", "A"),
+    }
+    REF_PATCH_SIZE = 70
 
     def __init__(
         self,
@@ -46,33 +66,204 @@ def __init__(
         stars=None,
         sssb_only=None,
         sssb_const_dist=None,
-        light_ref=None
+        light_ref=None,
+        store=None,
+        metadata=None
     ):
+        """
+        :type metadata: dict
+        :param metadata: Metadata of a frame created from images, as parsed
+                         by parse_metadata.
+        """
 
         self.id = frame_id
+        self.image_dir = image_dir
+        self.store = store
+        self._scenes = {}
+        self._ref_intensity = None
+
+        images = (stars, sssb_only, sssb_const_dist, light_ref)
 
-        if None not in (stars, sssb_only, sssb_const_dist, light_ref):
-            self.stars = stars
-            self.sssb_only = sssb_only
-            self.sssb_const_dist = sssb_const_dist
-            self.light_ref = light_ref
+        if all(img is not None for img in images):
+            self._scenes["Stars"] = stars
+            self._scenes["SssbOnly"] = sssb_only
+            self._scenes["SssbConstDist"] = sssb_const_dist
+            self._scenes["LightRef"] = light_ref
+            self.metadata = metadata
+
+        elif store is not None:
+            self.metadata = self.parse_metadata(store.get_metadata(self.id))
 
         elif image_dir is not None:
-            self.read_complete_frame(self.id, image_dir)
+            self.metadata = self.read_meta_file(self.id, image_dir)
 
         else:
             raise ImageCompositorError("Unable to create frame.")
 
+    @property
+    def stars(self):
+        return self.get_scene("Stars")
+
+    @property
+    def sssb_only(self):
+        return self.get_scene("SssbOnly")
+
+    @property
+    def sssb_const_dist(self):
+        return self.get_scene("SssbConstDist")
+
+    @property
+    def light_ref(self):
+        return self.get_scene("LightRef")
+
+    @property
+    def shape(self):
+        """Image shape (height, width) of the frame."""
+        if "Stars" in self._scenes:
+            return self._scenes["Stars"].shape[0:2]
+
+        if self.store is not None:
+            return self.store.get_shape(self.id, "Stars")[0:2]
+
+        (width, height) = utils.read_openexr_resolution(
+            self._get_filename("Stars")
+        )
+        return (height, width)
+
+    def get_scene(self, scene_name):
+        """Returns image of a scene, reads it from file on first access."""
+        if scene_name not in self._scenes:
+            self._scenes[scene_name] = self._read_scene(scene_name)
+
+        return self._scenes[scene_name]
+
+    def get_rows(self, scene_name, start, stop, out=None):
+        """
+        Returns rows (start, stop) of a scene image.
+
+        Rows of scenes which have not been read are read from file without
+        keeping them, so that memory is bound by the number of rows.
+
+        :type out: numpy.ndarray
+        :param out: Optional float32 buffer (rows, width, channels) the
+                    rows are read into, if they are read from file.
+        """
+        if scene_name in self._scenes:
+            return self._scenes[scene_name][start:stop]
+
+        return self._read_scene(scene_name, (start, stop), out)
+
+    def iter_rows(self, scene_name, tile_rows=None):
+        """
+        Iterates over tiles of rows of a scene image.
+
+        :type tile_rows: int
+        :param tile_rows: Rows per tile, the complete image if None.
+        :returns: Iterator of tuples (first row, tile).
+        """
+        if tile_rows is None:
+            yield (0, self.get_scene(scene_name))
+            return
+
+        height = self.shape[0]
+        for start in range(0, height, tile_rows):
+            stop = min(start + tile_rows, height)
+            yield (start, self.get_rows(scene_name, start, stop))
+
+    def _read_scene(self, scene_name, rows=None, out=None):
+        """Reads rows of a scene image from the run store or from file."""
+        channels = self.SCENE_CHANNELS[scene_name]
+
+        if self.store is not None:
+            return self.store.read(self.id, scene_name, channels, rows, out)
+
+        filename = self._get_filename(scene_name)
+        image = utils.read_openexr_image(filename, channels, rows, out=out)
+
+        if image is None:
+            raise ImageCompositorError(f"Unable to read {filename}.")
+
+        return image
+
+    def _get_filename(self, scene_name):
+        """File name of a scene image of this frame."""
+        if self.image_dir is None:
+            raise ImageCompositorError(f"No {scene_name} image of frame.")
+
+        return self.image_dir / (scene_name + "_" + self.id + ".exr")
+
     def calc_ref_intensity(self):
-        """Calculates reference intensitiy using the light reference scene."""
+        """
+        Calculates reference intensitiy using the light reference scene.
+
+        The result is kept, so that compositors of several instruments read
+        the light reference scene once.
+        """
+        if self._ref_intensity is not None:
+            return self._ref_intensity
+
+        half = self.REF_PATCH_SIZE // 2
+
+        if "LightRef" in self._scenes:
+            light_ref = self._scenes["LightRef"]
+            (height, width, _) = light_ref.shape
+            h_slice = (max(height // 2 - half, 0), height // 2 + half)
+            w_slice = (max(width // 2 - half, 0), width // 2 + half)
+            area = light_ref[h_slice[0] : h_slice[1],
+                             w_slice[0] : w_slice[1], 0]
+        elif self.store is not None:
+            # Only read the rows of the centre patch
+            (height, width, _) = self.store.get_shape(self.id, "LightRef")
+            h_slice = (max(height // 2 - half, 0), height // 2 + half)
+            w_slice = (max(width // 2 - half, 0), width // 2 + half)
+            area = self.store.read(self.id, "LightRef", ("R",), h_slice)
+            area = area[:, w_slice[0] : w_slice[1], 0]
+        else:
+            # Only decode the centre patch of the red channel
+            filename = self._get_filename("LightRef")
+            (width, height) = utils.read_openexr_resolution(filename)
+            h_slice = (max(height // 2 - half, 0), height // 2 + half)
+            w_slice = (max(width // 2 - half, 0), width // 2 + half)
+            area = utils.read_openexr_image(
+                filename, ("R",), h_slice, w_slice, planar=True
+            )
+            if area is None:
+                raise ImageCompositorError(f"Unable to read {filename}.")
+            area = area[0]
+
+        self._ref_intensity = np.mean(area)
+        return self._ref_intensity
+
+    def calc_sssb_centroid(self, tile_rows=None):
+        """
+        Calculates the sub-pixel centroid (y, x) of the SssbOnly scene.
+
+        Pixel k covers positions k to k + 1. If the sssb is not visible, the
+        image centre is returned.
+
+        :type tile_rows: int
+        :param tile_rows: Rows read at once, the complete image if None.
+        """
+        (height, width) = self.shape
+
+        total = 0.
+        y_c = 0.
+        x_sums = np.zeros(width, np.float64)
+        for start, sssb_only in self.iter_rows("SssbOnly", tile_rows):
+            weights = sssb_only[:, :, 0] * sssb_only[:, :, 3]
+            row_sums = np.sum(weights, axis=1)
+            rows = np.arange(start, start + len(row_sums)) + 0.5
+
+            total += np.sum(row_sums)
+            y_c += np.sum(row_sums * rows)
+            x_sums += np.sum(weights, axis=0)
+
+        if total <= 0:
+            return (height / 2, width / 2)
 
-        (height, width, _) = self.light_ref.shape
-        h_slice = (height // 2 - 35, height // 2 + 35)
-        w_slice = (width // 2 - 35, width // 2 + 35)
+        x_c = np.sum(x_sums * (np.arange(width) + 0.5))
 
-        area = self.light_ref[h_slice[0] : h_slice[1], w_slice[0] : w_slice[1], 0]
-        intensities = np.mean(area)
-        return intensities
+        return (y_c / total, x_c / total)
 
     def calc_stars_stats(self):
         """Calculate star scene parameters."""
@@ -91,15 +282,13 @@ def calc_sssb_stats(self, const_dist=False):
         If const_dist is True, stats of const distant images are calculated.
         """
         if const_dist:
-            sssb_max = np.max(
-                self.sssb_const_dist[:, :, 0] * self.sssb_const_dist[:, :, 3]
-            )
-            sssb_sum = np.sum(
-                self.sssb_const_dist[:, :, 0] * self.sssb_const_dist[:, :, 3]
-            )
+            img = self.sssb_const_dist
         else:
-            sssb_max = np.max(self.sssb_only[:, :, 0] * self.sssb_only[:, :, 3])
-            sssb_sum = np.sum(self.sssb_only[:, :, 0] * self.sssb_only[:, :, 3])
+            img = self.sssb_only
+
+        weighted = np.multiply(img[:, :, 0], img[:, :, 3])
+        sssb_max = np.max(weighted)
+        sssb_sum = np.sum(weighted)
 
         return (sssb_max, sssb_sum)
 
@@ -108,22 +297,12 @@ def read_complete_frame(self, frame_id, image_dir):
 
         This includes Stars, SssbOnly, SssbConstDist, and LightRef.
         """
-        frame_fmt_str = image_dir / ("{}_" + frame_id + ".exr")
-        frame_fmt_str = str(frame_fmt_str)
-
+        self.id = frame_id
+        self.image_dir = image_dir
         self.metadata = self.read_meta_file(frame_id, image_dir)
 
-        filename = frame_fmt_str.format("Stars")
-        self.stars = utils.read_openexr_image(filename)
-
-        filename = frame_fmt_str.format("SssbOnly")
-        self.sssb_only = utils.read_openexr_image(filename)
-
-        filename = frame_fmt_str.format("SssbConstDist")
-        self.sssb_const_dist = utils.read_openexr_image(filename)
-
-        filename = frame_fmt_str.format("LightRef")
-        self.light_ref = utils.read_openexr_image(filename)
+        for scene_name in self.SCENE_CHANNELS:
+            self.get_scene(scene_name)
 
     def read_meta_file(self, frame_id, image_dir):
         """Reads metafile of a frame."""
@@ -132,16 +311,197 @@ def read_meta_file(self, frame_id, image_dir):
         with open(str(filename), "r") as metafile:
             metadata = json.load(metafile)
 
-            date = datetime.strptime(metadata["date"], "%Y-%m-%dT%H%M%S-%f")
-            metadata["date"] = date
-            metadata["distance"] = metadata["distance"] * u.m
+        return self.parse_metadata(metadata)
+
+    @staticmethod
+    def parse_metadata(metadata):
+        """Converts json metadata of a frame to dates and quantities."""
+        metadata = dict(metadata)
+
+        date = datetime.strptime(metadata["date"], "%Y-%m-%dT%H%M%S-%f")
+        metadata["date"] = date
+        metadata["distance"] = metadata["distance"] * u.m
+
+        metadata["sc_pos"] = np.asarray(metadata["sc_pos"]) * u.m
+        metadata["sssb_pos"] = np.asarray(metadata["sssb_pos"]) * u.m
 
-            metadata["sc_pos"] = np.asarray(metadata["sc_pos"]) * u.m
-            metadata["sssb_pos"] = np.asarray(metadata["sssb_pos"]) * u.m
+        # Velocities are missing in metadata of older renders
+        for key in ("sc_vel", "sssb_vel"):
+            if key in metadata:
+                metadata[key] = np.asarray(metadata[key]) * u.m / u.s
 
         return metadata
 
 
+class PhotometryModel:
+    """
+    Unit-free photometry of an instrument used for composition.
+
+    All astropy quantities are reduced to float64 coefficients in SI units
+    once, per frame calculations only use floats. Coefficients are
+    validated against the astropy formulation at construction.
+    """
+
+    # Reference distance of the SssbConstDist scene in m
+    CONST_DIST = 1E6
+
+    def __init__(self, instrument, sssb, flux0=None, sun_mag=None):
+        """
+        :type instrument: Instrument
+        :param instrument: Instrument whose photometry is modelled.
+        :type sssb: dict
+        :param sssb: SSSB settings, requires max_dim and albedo.
+        :type flux0: astropy.units.Quantity
+        :param flux0: Photon flux of a magnitude 0 star, default V band.
+        :type sun_mag: astropy.units.Quantity
+        :param sun_mag: Magnitude of the sun at 1 AU, default V band.
+        """
+        self.inst = instrument
+
+        if flux0 is None:
+            flux0 = FLUX0_VBAND
+        if sun_mag is None:
+            sun_mag = SUN_MAG_VBAND
+        self.flux0 = flux0
+        self.sun_flux_1au = np.power(10., -0.4 * sun_mag.value) * flux0
+
+        self.max_dim = float(sssb["max_dim"])
+        self.albedo = float(sssb["albedo"])
+
+        # Sun flux per pixel at 1 m distance, scaled with 1/d^2
+        ref_flux = self.sun_flux_1au * const.au ** 2
+        ref_flux *= instrument.aperture_a * instrument.pix_a
+        ref_flux /= (instrument.focal_l ** 2) * np.pi
+        self.ref_flux_coeff = float(ref_flux.decompose().value)
+
+        # Flux of a magnitude 0 star
+        starmap_flux = flux0 * instrument.aperture_a
+        self.starmap_flux_coeff = float(starmap_flux.decompose().value)
+
+        self.validate()
+
+    def calc_ref_flux(self, sc_sun_dist):
+        """Sun flux per pixel at given sc sun distance in m."""
+        return self.ref_flux_coeff / (sc_sun_dist * sc_sun_dist)
+
+    def calc_starmap_flux(self, total_flux):
+        """Flux of a starmap with given total relative star flux."""
+        return self.starmap_flux_coeff * total_flux
+
+    def calc_dist_scale(self, distance):
+        """Flux scale of sssb at given distance in m from constant distance."""
+        return (self.CONST_DIST / distance) ** 2
+
+    def calc_vis_dim(self, distance):
+        """Scaled visible dimension of sssb at given distance in m."""
+        return self.max_dim * self.calc_dist_scale(distance)
+
+    def validate(self, rtol=1E-9):
+        """
+        Compares the unit-free model with the astropy formulation.
+
+        :raises ImageCompositorError: If results differ more than rtol.
+        """
+        inst = self.inst
+
+        for sc_sun_dist in (0.5 * const.au, const.au, 3.2 * const.au):
+            ref_flux = self.sun_flux_1au * ((const.au / sc_sun_dist) ** 2)
+            ref_flux *= inst.aperture_a * inst.pix_a
+            ref_flux /= (inst.focal_l ** 2) * np.pi
+            ref_flux = ref_flux.decompose().value
+            model = self.calc_ref_flux(sc_sun_dist.to_value(u.m))
+
+            if not np.isclose(model, ref_flux, rtol=rtol, atol=0):
+                raise ImageCompositorError(
+                    f"Sun flux model {model} differs from {ref_flux}."
+                )
+
+        for total_flux in (1E-3, 1., 1E3):
+            starmap_flux = self.flux0 * total_flux * inst.aperture_a
+            starmap_flux = starmap_flux.decompose().value
+            model = self.calc_starmap_flux(total_flux)
+
+            if not np.isclose(model, starmap_flux, rtol=rtol, atol=0):
+                raise ImageCompositorError(
+                    f"Starmap flux model {model} differs from {starmap_flux}."
+                )
+
+        for distance in (1E3 * u.m, 1E6 * u.m, 1E9 * u.m):
+            dist_scale = np.power(1E6 * u.m / distance, 2.0)
+            dist_scale = dist_scale.decompose().value
+            model = self.calc_dist_scale(distance.to_value(u.m))
+
+            if not np.isclose(model, dist_scale, rtol=rtol, atol=0):
+                raise ImageCompositorError(
+                    f"Distance scale model {model} differs from {dist_scale}."
+                )
+
+
+def _get_buffers(shape, bands=None, sssb_img=False, scenes=False):
+    """
+    Returns preallocated composition buffers of the calling worker.
+
+    Buffers are created once per worker thread and image shape.
+
+    :type shape: tuple
+    :param shape: Image shape (height, width).
+    :type bands: int
+    :param bands: Number of bands of multi-band instruments.
+    :type sssb_img: bool
+    :param sssb_img: Whether a separate SSSB image is required.
+    :type scenes: bool
+    :param scenes: Whether buffers are required to read scene images.
+    :returns: Dict with float32 buffers "img" (height, width, 3) and
+              "stars_weight", "sssb_weight", "tmp" (height, width). With
+              bands also "bands" (height, width, bands), with sssb_img also
+              "sssb_img" (height, width, 3). With scenes also a buffer per
+              scene name with the channels of Frame.SCENE_CHANNELS.
+    """
+    buffers = getattr(_buffers, "buffers", None)
+
+    if buffers is None or buffers["img"].shape[0:2] != shape:
+        buffers = {
+            "img": np.empty(shape + (3,), np.float32),
+            "stars_weight": np.empty(shape, np.float32),
+            "sssb_weight": np.empty(shape, np.float32),
+            "tmp": np.empty(shape, np.float32),
+        }
+        _buffers.buffers = buffers
+
+    if bands is not None:
+        if "bands" not in buffers or buffers["bands"].shape[2] != bands:
+            buffers["bands"] = np.empty(shape + (bands,), np.float32)
+
+    if sssb_img and "sssb_img" not in buffers:
+        buffers["sssb_img"] = np.empty(shape + (3,), np.float32)
+
+    if scenes and "Stars" not in buffers:
+        for name, channels in Frame.SCENE_CHANNELS.items():
+            buffers[name] = np.empty(shape + (len(channels),), np.float32)
+
+    return buffers
+
+
+def _compose_frame(compositor, frame, variants=None):
+    """
+    Composes a single frame, used as worker function of the pool.
+
+    Module level function so that it can be used by a process pool. If
+    variants are given, the frame is read once and composed by each of the
+    variant compositors instead of compositor.
+    """
+    if not isinstance(frame, Frame):
+        frame = Frame(frame, compositor.image_dir, store=compositor.store)
+
+    if variants is None:
+        variants = [compositor]
+
+    for variant in variants:
+        variant._compose(frame)
+
+    return frame.id
+
+
 class ImageCompositor:
     """This class provides functions to combine the final simulation images."""
 
@@ -156,7 +516,15 @@ def __init__(
         sssb,
         with_infobox,
         with_clipping,
-        ext_logger
+        ext_logger,
+        workers=None,
+        executor="thread",
+        queue_size=None,
+        with_smear=False,
+        tile_rows=None,
+        tile_workers=1,
+        exr=None,
+        store=None
     ):
 
         self.logger = ext_logger
@@ -164,32 +532,97 @@ def __init__(
         self.res_dir = res_dir
         self.image_dir = img_dir
 
+        # Raw frames are read from the run store instead of image_dir if set
+        self.store = store
+
         self.image_extension = ".exr"
 
-        self._threads = []
+        if workers is None:
+            workers = min(os.cpu_count() or 1, 4)
+        if queue_size is None:
+            queue_size = 2 * workers
+        if executor not in ("thread", "process"):
+            raise ImageCompositorError(f"Unknown executor {executor}.")
+
+        self.workers = workers
+        self.executor = executor
+        self.queue_size = queue_size
+
+        # Pool is created on first submission, slots bound pending frames
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._futures = {}
+        self._lock = threading.Lock()
 
         self.inst = instrument
 
+        # Photometry is precomputed once per instrument and band
+        self.band_photometry = None
+        if instrument is not None:
+            self.photometry = PhotometryModel(instrument, sssb)
+
+            if instrument.bands is not None:
+                self.band_photometry = [
+                    PhotometryModel(instrument, sssb, band.flux0, band.sun_mag)
+                    for band in instrument.bands
+                ]
+        else:
+            self.photometry = None
+
+        # Point source reference profiles, created once per instrument
+        self._sssb_ref = None
+
         self.sssb = sssb
 
         self.with_infobox = with_infobox
         self.with_clipping = with_clipping
-
-        self.logger.debug("Infobox: %d. Clip: %d.", with_infobox, with_clipping)
+        self.with_smear = with_smear
+
+        # Large frames are composed in tiles of rows to bound memory
+        if tile_rows is not None and tile_rows < 1:
+            raise ImageCompositorError("Tiles require at least one row.")
+        self.tile_rows = tile_rows
+        self.tile_workers = tile_workers
+
+        # Compression and pixel type of composed OpenEXR images
+        if exr is None:
+            exr = {}
+        self.exr = dict(exr)
+
+        self.logger.debug("Infobox: %d. Clip: %d. Smear: %d.",
+                          with_infobox, with_clipping, with_smear)
+        self.logger.debug("Compositor %s pool: %d workers, queue size %d.",
+                          executor, workers, queue_size)
+        if tile_rows is not None:
+            self.logger.debug("Tiles of %d rows, %d tile workers.",
+                              tile_rows, tile_workers)
+
+    def __getstate__(self):
+        """Pool and synchronisation objects are not sent to workers."""
+        state = self.__dict__.copy()
+        for key in ("_pool", "_slots", "_futures", "_lock"):
+            state[key] = None
+        return state
 
     def get_frame_ids(self):
-        """Extract list of frame ids from file names of SssbOnly scenes."""
-        scene_name = "SssbOnly"
-        image_names = scene_name + "*" + self.image_extension
+        """
+        List of frame ids of the run store in order of rendering.
+
+        Without run store, frame ids are extracted from file names of
+        SssbOnly scenes in image_dir and sorted.
+        """
+        if self.store is not None:
+            return self.store.frame_ids
+
+        prefix = "SssbOnly_"
+        image_names = prefix + "*" + self.image_extension
         filenames = self.image_dir.glob(image_names)
 
         ids = []
         for filename in filenames:
-            filename = str(filename.name).strip(self.image_extension)
-            filename = filename.strip(scene_name)
-            ids.append(filename.strip("_"))
+            ids.append(filename.name[len(prefix) : -len(self.image_extension)])
 
-        return ids
+        return sorted(ids)
 
     def calc_relative_intensity_curve(self):
         """Calculates the relative intensity curve for all sssb frames."""
@@ -217,188 +650,824 @@ def calc_relative_intensity_curve(self):
 
         return rel_intensity
 
-    def compose(self, frames=None, max_threads=3):
+    def compose(self, frames=None):
         """
-        Composes different images into final image, uses multi-threading.
-        
-        !!! CAUTION !!! Call only once at a time.
-        
+        Composes different images into final image, uses a worker pool.
+
+        Blocks until all given frames are composed.
+
         :type frames: String, Frame or List of Frame
         :param frames: FrameID, Frame or list of frames for calibration and
-                       composition.
-        :type name_suffix: str
-        :param name_suffix: Image suffix for file I/O. Used for constructing
-                            file names to read different images of a frame as
-                            well as used for composed image output.
+                       composition. If None, all frames in image_dir are
+                       composed.
+        :returns: List of futures of the composed frames.
         """
 
         if frames is None:
             self.frame_ids = self.get_frame_ids()
-            frames = []
-            for frame_id in self.frame_ids:
-                new_frame = Frame(frame_id, self.image_dir)
-                frames.append(new_frame)
-
-        elif isinstance(frames, str):
-            frames = [Frame(frames, self.image_dir)]
+            frames = self.frame_ids
 
-        elif isinstance(frames, Frame):
+        elif isinstance(frames, (str, Frame)):
             frames = [frames]
-        elif isinstance(frames, list) and isinstance(frames[0], Frame):
+
+        elif isinstance(frames, list) and isinstance(frames[0], (str, Frame)):
             pass
         else:
             raise ImageCompositorError(
                 "Compositor.compose requires frame or list of frames as input"
             )
 
-        for frame in frames:
+        submitted = [self.submit(frame) for frame in frames]
+        self._check_results(submitted)
 
-            for thr in self._threads:
-                if not thr.is_alive():
-                    self._threads.pop(self._threads.index(thr))
+        return submitted
 
-            if len(self._threads) < max_threads - 1:
-                # Allow up to 2 additional threads
-                thr = threading.Thread(target=self._compose, args=(frame,))
-                thr.start()
-                self._threads.append(thr)
-            else:
-                # If too many, also compose in main thread to not drop a frame
-                self._compose(frame)
+    def recompose(self, instruments, res_dir=None, frames=None):
+        """
+        Composes existing raw frames for several instrument variants.
+
+        Each raw frame is read once and composed with every instrument,
+        results of a variant are written to a sub directory of res_dir named
+        after the variant. Blocks until all frames are composed.
+
+        :type instruments: dict
+        :param instruments: Variant name and Instrument pairs.
+        :type res_dir: Path
+        :param res_dir: Directory of variant results, default is res_dir of
+                        this compositor.
+        :type frames: list
+        :param frames: FrameIDs to recompose, default are all frames in
+                       image_dir.
+        :returns: List of futures of the composed frames.
+        """
+        if res_dir is None:
+            res_dir = self.res_dir
+
+        variants = []
+        for name, instrument in instruments.items():
+            variant_dir = utils.check_dir(res_dir / name)
+            variant = ImageCompositor(
+                variant_dir,
+                variant_dir,
+                instrument,
+                self.sssb,
+                self.with_infobox,
+                self.with_clipping,
+                self.logger,
+                workers=1,
+                queue_size=1,
+                with_smear=self.with_smear,
+                tile_rows=self.tile_rows,
+                tile_workers=self.tile_workers,
+                exr=self.exr
+            )
+            variants.append(variant)
+
+        if frames is None:
+            frames = self.get_frame_ids()
+
+        self.logger.debug("Recomposing %d frames for %d instruments.",
+                          len(frames), len(variants))
+
+        submitted = [self.submit(frame, variants) for frame in frames]
+        self._check_results(submitted)
+
+        return submitted
+
+    def submit(self, frame, variants=None):
+        """
+        Submits a single frame for composition to the worker pool.
+
+        Returns immediately unless queue_size frames are already pending,
+        in which case it blocks until a slot is free.
+
+        :type frame: String or Frame
+        :param frame: FrameID or Frame. Frames given by id are read by the
+                      worker.
+        :type variants: list
+        :param variants: Optional compositors which compose the frame
+                         instead of this compositor.
+        :returns: concurrent.futures.Future of the composition.
+        """
+        self._slots.acquire()
+
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = self._create_pool()
+                future = self._pool.submit(
+                    _compose_frame, self, frame, variants
+                )
+                frame_id = frame.id if isinstance(frame, Frame) else frame
+                self._futures[future] = frame_id
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(self._release)
+
+        return future
+
+    def wait(self):
+        """
+        Waits for all submitted frames.
+
+        :raises ImageCompositorError: If composition of a frame failed.
+        """
+        with self._lock:
+            pending = list(self._futures)
+
+        futures.wait(pending)
+
+        failed = []
+        for future in pending:
+            if future.exception() is not None:
+                frame_id = self._futures.get(future)
+                self.logger.debug("Composition of %s failed: %s",
+                                  frame_id, future.exception())
+                failed.append(frame_id)
+
+        with self._lock:
+            for future in pending:
+                self._futures.pop(future, None)
+
+        if failed:
+            raise ImageCompositorError(f"Composition failed for {failed}.")
+
+    def close(self):
+        """Waits for all submitted frames and shuts the worker pool down."""
+        try:
+            self.wait()
+        finally:
+            with self._lock:
+                pool = self._pool
+                self._pool = None
+
+            # Workers might still release slots, which requires the lock
+            if pool is not None:
+                pool.shutdown()
+
+    def _create_pool(self):
+        """Creates the thread or process pool for composition."""
+        if self.executor == "process":
+            return futures.ProcessPoolExecutor(self.workers)
+
+        return futures.ThreadPoolExecutor(self.workers, "compositor")
+
+    def _release(self, future):
+        """Frees queue slot of a finished frame, keeps failures for wait."""
+        if future.exception() is None:
+            with self._lock:
+                self._futures.pop(future, None)
+        self._slots.release()
+
+    def _check_results(self, submitted):
+        """
+        Waits for submitted frames and raises the first failure.
+
+        Checked frames are removed, so that wait and close do not report
+        their failures again.
+        """
+        futures.wait(submitted)
+
+        with self._lock:
+            for future in submitted:
+                self._futures.pop(future, None)
+
+        for future in submitted:
+            future.result()
 
-            for thr in self._threads:
-                thr.join()
-    
     def _compose(self, frame):
         """
         Composes raw images and adjusts light intensities.
 
+        If tile_rows is set, the frame is composed in tiles, see
+        _compose_tiled.
+
         :type frame: Frame
         :param frame: Frame containing necessary inormation for composition.
         """
+        if self.band_photometry is not None:
+            return self._compose_bands(frame)
+
+        params = self.calc_frame_params(frame)
 
-        # SSSB photometry
-        sc_sun_dist = np.linalg.norm(frame.metadata["sc_pos"]) * u.m
-        ref_flux = SUN_FLUX_VBAND_1AU * ((const.au / sc_sun_dist) ** 2)
-        ref_flux *= self.inst.aperture_a * self.inst.pix_a 
-        ref_flux /= (self.inst.focal_l ** 2) * np.pi
-        ref_flux = ref_flux.decompose()
+        if params["tile_rows"] is not None:
+            return self._compose_tiled(frame, params)
 
-        # Star photometry
-        starmap_flux = FLUX0_VBAND * frame.metadata["total_flux"]
-        starmap_flux *= self.inst.aperture_a
-        starmap_flux = starmap_flux.decompose()
+        height = params["shape"][0]
+        (composed_img, ref_sssb_max) = self._compose_tile(
+            frame, (0, height), params
+        )
+
+        composed_max = np.max(composed_img)
+        if params["point_source"] and composed_max > ref_sssb_max * 5:
+            composed_max = ref_sssb_max * 5
+
+        composed_img /= composed_max
+
+        self.write_composition(composed_img, frame)
 
-        # Calibrate starmap
-        (_, stars_sums) = frame.calc_stars_stats()
-        frame.stars[:, :, 0:3] *= starmap_flux.value / stars_sums[0]
+    def calc_frame_params(self, frame):
+        """
+        Calculates calibration parameters of a frame for composition.
 
-        # Create composition image array
-        composed_img = np.zeros(frame.stars.shape, dtype=np.float32)
+        Sums over scene images are calculated tile by tile if tile_rows is
+        set.
+
+        :type frame: Frame
+        :param frame: Frame containing necessary inormation for composition.
+        :returns: Dict of parameters used by _compose_tile.
+        """
+        photometry = self.photometry
+        shape = frame.shape
+
+        tile_rows = self.tile_rows
+        halo = 0
+        velocities = self.calc_smear_velocities(frame)
+        if tile_rows is not None:
+            # Tiles start at noise strip boundaries
+            strip_rows = self.inst.noise.strip_rows
+            tile_rows = -(-tile_rows // strip_rows) * strip_rows
+
+            halo = self.inst.calc_halo()
+            if velocities is not None:
+                halo += max(self.inst.smear.calc_halo(v) for v in velocities)
+
+        # Star photometry, calibration factor of starmap
+        starmap_flux = photometry.calc_starmap_flux(
+            frame.metadata["total_flux"]
+        )
+        stars_sum = 0.
+        for _, stars in frame.iter_rows("Stars", tile_rows):
+            stars_sum += np.sum(stars[:, :, 0])
+
+        params = {
+            "shape": shape,
+            "tile_rows": tile_rows,
+            "halo": halo,
+            "tile_shape": (min(shape[0], (tile_rows or shape[0]) + 2 * halo),
+                           shape[1]),
+            "velocities": velocities,
+            "stars_scale": starmap_flux / stars_sum,
+        }
 
         # Calibrate SSSB, depending on visible size
-        dist_scale = np.power(1E6 * u.m / frame.metadata["distance"], 2.0)
-        vis_dim = self.sssb["max_dim"] * dist_scale
+        distance = frame.metadata["distance"].to_value(u.m)
+        dist_scale = photometry.calc_dist_scale(distance)
+        vis_dim = photometry.calc_vis_dim(distance)
+        params["point_source"] = vis_dim < 0.1
+
+        if params["point_source"]:
+            # Total flux of sssb, scaled from constant distance
+            sssb_flux = 0.
+            for _, const_dist in frame.iter_rows("SssbConstDist", tile_rows):
+                sssb_flux += np.einsum(
+                    "ijc,ij->", const_dist[:, :, 0:3], const_dist[:, :, 3]
+                )
+            params["sssb_flux"] = sssb_flux * dist_scale
+            params["centre"] = frame.calc_sssb_centroid(tile_rows)
+        else:
+            # SSSB photometry
+            sc_pos = frame.metadata["sc_pos"].to_value(u.m)
+            ref_flux = photometry.calc_ref_flux(np.linalg.norm(sc_pos))
+            ref_int = frame.calc_ref_intensity()
+            params["sssb_cal_factor"] = ref_flux * photometry.albedo / ref_int
 
-        if vis_dim < 0.1:
+        return params
+
+    def _compose_tile(self, frame, rows, params, valid=None):
+        """
+        Composes and senses rows of a frame in buffers of the worker.
+
+        :type frame: Frame
+        :param frame: Frame containing necessary inormation for composition.
+        :type rows: tuple
+        :param rows: Rows (start, stop) of the tile including halo margins.
+        :type params: dict
+        :param params: Frame parameters, see calc_frame_params.
+        :type valid: slice
+        :param valid: Rows of the tile without halo margins.
+        :returns: Tuple of sensed tile, view of the worker buffers, and
+                  maximum of the point source sssb or None.
+        """
+        (top, bottom) = rows
+        tile = (top, params["shape"][0])
+        rows = bottom - top
+        if valid is None:
+            valid = slice(0, rows)
+
+        velocities = params["velocities"]
+        smear = self.inst.smear
+        stars_scale = params["stars_scale"]
+
+        # Composition is done in buffers of the worker
+        tiled = params["tile_rows"] is not None
+        buffers = _get_buffers(
+            params["tile_shape"],
+            sssb_img=velocities is not None,
+            scenes=tiled
+        )
+        composed_img = buffers["img"][:rows]
+
+        # Tiles are read into buffers of the worker, complete scenes are
+        # kept by the frame for compositors of other instruments
+        def read_scene(name):
+            if tiled:
+                return frame.get_rows(name, top, bottom, buffers[name][:rows])
+            return frame.get_scene(name)
+
+        stars = read_scene("Stars")
+
+        if params["point_source"]:
             # Use point source sssb
-            # Generate point source reference image
-            sssb_ref = self.create_sssb_ref(self.inst.res)
-            alpha = frame.sssb_const_dist[:, :, 3]
-            scale = frame.sssb_const_dist[:, :, 0:3] * alpha
-            sssb_ref[:, :, 0:3] *= np.sum(scale, axis=-1) * dist_scale
-
-            composed_img = self.inst.sense(sssb_ref[:, :, 0:3] + frame.stars[:, :, 0:3])
-            composed_max = np.max(composed_img)
-            ref_sssb_max = np.max(sssb_ref[:, :, 0:3])
-            if composed_max > ref_sssb_max * 5:
-                composed_max = ref_sssb_max * 5
+            centre = params["centre"]
+            sssb_flux = params["sssb_flux"]
+
+            np.multiply(stars[:, :, 0:3], stars_scale, out=composed_img)
+            if velocities is None:
+                ref_sssb_max = self.add_sssb_ref(
+                    composed_img, centre, sssb_flux, tile
+                )
+            else:
+                # Stars and SSSB move differently, they are smeared apart
+                sssb_img = buffers["tmp"][:rows]
+                sssb_img[:, :] = 0
+                self.add_sssb_ref(
+                    sssb_img[:, :, None], centre, sssb_flux / 3, tile
+                )
+                smear.apply(composed_img, velocities[0], composed_img, tile)
+                smear.apply(sssb_img, velocities[1], sssb_img, tile)
+                # Halo margins may contain reflections of the tile border
+                ref_sssb_max = np.max(sssb_img[valid])
+                composed_img += sssb_img[:, :, None]
         else:
-            # Calibrate sssb images
-            ref_int = frame.calc_ref_intensity()
-            sssb_cal_factor = ref_flux * self.sssb["albedo"] / ref_int
-            sssb_cal_factor = sssb_cal_factor.decompose().value
-            frame.sssb_only[:, :, 0:3] *= sssb_cal_factor
-            frame.sssb_const_dist[:, :, 0:3] *= sssb_cal_factor
+            ref_sssb_max = None
+            sssb_only = read_scene("SssbOnly")
+            sssb_cal_factor = params["sssb_cal_factor"]
+
+            # Merge calibrated images taking alpha channel into account
+            alpha = sssb_only[:, :, 3]
+            stars_weight = buffers["stars_weight"][:rows]
+            sssb_weight = buffers["sssb_weight"][:rows]
+            tmp = buffers["tmp"][:rows]
+            np.multiply(alpha, -stars_scale, out=stars_weight)
+            stars_weight += stars_scale
+            np.multiply(alpha, sssb_cal_factor, out=sssb_weight)
+            for c in range(3):
+                channel = composed_img[:, :, c]
+                np.multiply(stars[:, :, c], stars_weight, out=channel)
+                if velocities is None:
+                    np.multiply(sssb_only[:, :, c], sssb_weight, out=tmp)
+                    channel += tmp
+                else:
+                    np.multiply(
+                        sssb_only[:, :, c],
+                        sssb_weight,
+                        out=buffers["sssb_img"][:rows, :, c]
+                    )
+
+            if velocities is not None:
+                # Occluded stars move with the stars, the alpha weighted
+                # SSSB with the SSSB
+                sssb_img = buffers["sssb_img"][:rows]
+                smear.apply(composed_img, velocities[0], composed_img, tile)
+                smear.apply(sssb_img, velocities[1], sssb_img, tile)
+                composed_img += sssb_img
+
+        self.inst.sense(
+            composed_img,
+            out=composed_img,
+            frame_id=frame.id,
+            valid=valid,
+            row_offset=top + valid.start
+        )
+
+        return (composed_img, ref_sssb_max)
+
+    def _compose_tiled(self, frame, params):
+        """
+        Composes a frame in tiles of rows with halo margins.
+
+        Halo margins cover the PSF and smear kernels, so that tiles equal
+        the rows of a frame composed at once within float32 rounding. The
+        convolution engine and FFT blocks depend on the tile shape, they may
+        round differently. Sensed tiles are collected in a memory mapped
+        temporary file, from which the normalised outputs are written in
+        strips. Peak memory is bound by the tile size and number of tile
+        workers instead of the frame size.
+
+        :type frame: Frame
+        :param frame: Frame containing necessary inormation for composition.
+        :type params: dict
+        :param params: Frame parameters, see calc_frame_params.
+        """
+        (height, width) = params["shape"]
+        tile_rows = params["tile_rows"]
+        tiles = [(start, min(start + tile_rows, height))
+                 for start in range(0, height, tile_rows)]
+
+        with tempfile.TemporaryFile(dir=str(self.res_dir)) as tmp_file:
+            composed = np.memmap(
+                tmp_file, np.float32, "w+", shape=(height, width, 3)
+            )
+
+            def compose_tile(rows):
+                return self._compose_valid_rows(frame, rows, params, composed)
+
+            if self.tile_workers > 1 and len(tiles) > 1:
+                with futures.ThreadPoolExecutor(self.tile_workers) as pool:
+                    results = list(pool.map(compose_tile, tiles))
+            else:
+                results = [compose_tile(rows) for rows in tiles]
+
+            composed_max = max(result[0] for result in results)
+            if params["point_source"]:
+                ref_sssb_max = max(result[1] for result in results)
+                composed_max = min(composed_max, ref_sssb_max * 5)
+
+            self.write_composition_tiled(
+                composed, composed_max, frame, tile_rows
+            )
+            del composed
+
+    def _compose_valid_rows(self, frame, rows, params, composed):
+        """
+        Composes a tile and stores its rows without halo margins.
+
+        :returns: Tuple of maximum of the stored rows and maximum of the
+                  point source sssb or None.
+        """
+        (start, stop) = rows
+        halo = params["halo"]
+        top = max(start - halo, 0)
+        bottom = min(stop + halo, params["shape"][0])
+
+        valid = slice(start - top, stop - top)
+        (tile_img, ref_sssb_max) = self._compose_tile(
+            frame, (top, bottom), params, valid
+        )
+        composed[start:stop] = tile_img[valid]
+
+        return (np.max(tile_img[valid]), ref_sssb_max)
+
+    def calc_smear_velocities(self, frame):
+        """
+        Image velocities of stars and SSSB used for motion smear.
+
+        :type frame: Frame
+        :param frame: Frame whose metadata contains velocities.
+        :returns: Tuple of star and SSSB velocities in pixel per second or
+                  None if smear is disabled or negligible.
+        """
+        if not self.with_smear:
+            return None
+
+        smear = self.inst.smear
+        velocities = smear.calc_image_velocities(frame.metadata)
+        if velocities is None:
+            self.logger.debug("No velocities for smear of frame %s", frame.id)
+            return None
+
+        if smear.is_static(velocities[0]) and smear.is_static(velocities[1]):
+            return None
+
+        self.logger.debug("Smear of frame %s, stars %s px/s, sssb %s px/s",
+                          frame.id, velocities[0], velocities[1])
+
+        return velocities
+
+    def _compose_bands(self, frame):
+        """
+        Composes raw images of a frame for each band of the instrument.
+
+        Band images are linear combinations of a star and an sssb base
+        image, which are convolved with the PSFs of all bands in one batch.
+        The red channel of the raw renders is used as broadband flux. Each
+        band is normalised and written separately.
 
-            # Merge images taking alpha channel and q.e. into account
+        :type frame: Frame
+        :param frame: Frame containing necessary inormation for composition.
+        """
+        bands = self.inst.bands
+        photometries = self.band_photometry
+
+        sc_pos = frame.metadata["sc_pos"].to_value(u.m)
+        sc_sun_dist = np.linalg.norm(sc_pos)
+        stars_sum = np.sum(frame.stars[:, :, 0])
+
+        # Weight buffers hold the base images
+        buffers = _get_buffers(frame.stars.shape[0:2], len(bands))
+        stars_base = buffers["stars_weight"]
+        sssb_base = buffers["sssb_weight"]
+
+        distance = frame.metadata["distance"].to_value(u.m)
+        dist_scale = self.photometry.calc_dist_scale(distance)
+        vis_dim = self.photometry.calc_vis_dim(distance)
+
+        weights = np.empty((len(bands), 2), np.float64)
+        for b, photometry in enumerate(photometries):
+            starmap_flux = photometry.calc_starmap_flux(
+                frame.metadata["total_flux"]
+            )
+            weights[b, 0] = starmap_flux / stars_sum
+
+        if vis_dim < 0.1:
+            # Point source sssb with flux relative to the sun in each band
+            const_dist = frame.sssb_const_dist
+            sssb_flux = np.einsum(
+                "ijc,ij->", const_dist[:, :, 0:3], const_dist[:, :, 3]
+            )
+            sssb_flux *= dist_scale / 3
+
+            stars_base[:, :] = frame.stars[:, :, 0]
+            sssb_base[:, :] = 0
+            centre = frame.calc_sssb_centroid()
+            ref_sssb_max = self.add_sssb_ref(
+                sssb_base[:, :, None], centre, sssb_flux
+            )
+
+            for b, photometry in enumerate(photometries):
+                weights[b, 1] = (photometry.ref_flux_coeff
+                                 / self.photometry.ref_flux_coeff)
+        else:
+            # Merge with alpha channel, calibration is applied by weights
             alpha = frame.sssb_only[:, :, 3]
-            for c in range(3):
-                sssb = frame.sssb_only[:, :, c]
-                stars = frame.stars[:, :, c]
-                composed_img[:, :, c] = alpha * sssb + (1 - alpha) * stars
+            np.subtract(1, alpha, out=stars_base)
+            stars_base *= frame.stars[:, :, 0]
+            np.multiply(alpha, frame.sssb_only[:, :, 0], out=sssb_base)
+
+            ref_int = frame.calc_ref_intensity()
+            for b, photometry in enumerate(photometries):
+                ref_flux = photometry.calc_ref_flux(sc_sun_dist)
+                weights[b, 1] = ref_flux * photometry.albedo / ref_int
+
+        velocities = self.calc_smear_velocities(frame)
+        if velocities is not None:
+            smear = self.inst.smear
+            smear.apply(stars_base, velocities[0], out=stars_base)
+            smear.apply(sssb_base, velocities[1], out=sssb_base)
+            if vis_dim < 0.1:
+                ref_sssb_max = np.max(sssb_base)
+
+        composed = self.inst.sense_bands(
+            [stars_base, sssb_base],
+            weights,
+            out=buffers["bands"],
+            frame_id=frame.id
+        )
 
-            composed_img = self.inst.sense(composed_img[:, :, 0:3])
-            composed_max = np.max(composed_img)
+        for b, band in enumerate(bands):
+            band_img = composed[:, :, b:b + 1]
+            composed_max = np.max(band_img)
+            if vis_dim < 0.1:
+                sssb_max = ref_sssb_max * weights[b, 1]
+                composed_max = min(composed_max, sssb_max * 5)
 
-        composed_img[:, :, :] /= composed_max
+            band_img /= composed_max
+
+            self.write_composition(band_img, frame, band.name)
+
+    def write_composition(self, composed_img, frame, band=None):
+        """
+        Writes a composed image and optionally infobox and instrument images.
+
+        :type composed_img: numpy.ndarray
+        :param composed_img: Normalised image (height, width, channels).
+        :type frame: Frame
+        :param frame: Composed frame.
+        :type band: str
+        :param band: Band name, which is added to file names.
+        """
+        (infobox_file, inst_file, exrfile) = self.get_output_files(frame, band)
 
         if self.with_infobox:
             infobox_img = composed_img[:, :, 0:3] * 255
             infobox_img = infobox_img.astype(np.uint8)
+            self.write_infobox(infobox_file, infobox_img, frame)
+
+        if self.with_clipping:
+            clipped_img = self.clip_color_depth(composed_img)
+            cv2.imwrite(str(inst_file), clipped_img)
+            self.write_prior(inst_file, frame)
+
+        self.write_exr(exrfile, composed_img)
+
+    def write_composition_tiled(self, composed, composed_max, frame, tile_rows):
+        """
+        Normalises and writes a composed image in strips of rows.
+
+        The EXR image is streamed strip by strip, PNG images are assembled
+        in memory mapped temporary files before they are encoded. Half
+        float EXR images are checked strip by strip, which is stricter than
+        checking the complete image.
+
+        :type composed: numpy.ndarray
+        :param composed: Composed image (height, width, 3), it is
+                         normalised in place.
+        :type composed_max: float
+        :param composed_max: Value normalised to 1.
+        :type frame: Frame
+        :param frame: Composed frame.
+        :type tile_rows: int
+        :param tile_rows: Rows per strip.
+        """
+        (infobox_file, inst_file, exrfile) = self.get_output_files(frame)
+        (height, width, channels) = composed.shape
+
+        if self.inst.color_depth <= 8:
+            clipped_dtype = np.uint8
+        else:
+            clipped_dtype = np.uint16
+
+        with tempfile.TemporaryFile(dir=str(self.res_dir)) as infobox_tmp, \
+                tempfile.TemporaryFile(dir=str(self.res_dir)) as clipped_tmp:
+            if self.with_infobox:
+                infobox_img = np.memmap(
+                    infobox_tmp, np.uint8, "w+", shape=(height, width, 3)
+                )
+            if self.with_clipping:
+                clipped_img = np.memmap(
+                    clipped_tmp, clipped_dtype, "w+", shape=(height, width, 3)
+                )
+
+            half = self.exr.get("half", False)
+            half_rtol = self.exr.get("half_rtol", 1E-3)
+
+            for start in range(0, height, tile_rows):
+                strip = composed[start:start + tile_rows]
+                strip /= composed_max
+
+                if half:
+                    half = utils.check_half_precision(strip, half_rtol)
+                if self.with_infobox:
+                    rows = infobox_img[start:start + tile_rows]
+                    rows[...] = strip[:, :, 0:3] * 255
+                if self.with_clipping:
+                    rows = clipped_img[start:start + tile_rows]
+                    rows[...] = self.clip_color_depth(strip)
+
+            if self.exr.get("half", False) and not half:
+                self.logger.debug("%s exceeds half float tolerance, stored "
+                                  "as float", exrfile)
+
+            writer = utils.OpenEXRWriter(
+                exrfile,
+                width,
+                height,
+                channels,
+                self.exr.get("compression"),
+                half
+            )
             try:
-                self.add_infobox(infobox_img, frame.metadata)
-            except ImageCompositorError as e:
-                self.logger.debug("No Infobox could be added. %s!", str(e))
+                for start in range(0, height, tile_rows):
+                    writer.write(composed[start:start + tile_rows])
+            finally:
+                writer.close()
+
+            if self.with_infobox:
+                self.write_infobox(infobox_file, infobox_img, frame)
+                del infobox_img
+
+            if self.with_clipping:
+                cv2.imwrite(str(inst_file), clipped_img)
+                self.write_prior(inst_file, frame)
+                del clipped_img
 
-            filename = self.res_dir / ("Comp_" + str(frame.id) + ".png")
-            cv2.imwrite(str(filename), infobox_img)
+    def write_exr(self, filename, composed_img):
+        """Writes a composed image with the OpenEXR settings."""
+        half = utils.write_openexr_image(filename, composed_img, **self.exr)
 
-            exrfile = self.image_dir / ("Comp_" + str(frame.id))
+        if self.exr.get("half", False) and not half:
+            self.logger.debug("%s exceeds half float tolerance, stored as "
+                              "float", filename)
+
+    def get_output_files(self, frame, band=None):
+        """
+        Returns file names of infobox, instrument and EXR images of a frame.
+
+        :type frame: Frame
+        :param frame: Composed frame.
+        :type band: str
+        :param band: Band name, which is added to file names.
+        """
+        if band is None:
+            name = str(frame.id)
         else:
-            exrfile = self.res_dir / ("Comp_" + str(frame.id))
+            name = band + "_" + str(frame.id)
+
+        infobox_file = self.res_dir / ("Comp_" + name + ".png")
+        inst_file = self.res_dir / ("Inst_" + name + ".png")
 
         if self.with_clipping:
-            clipped_img = self.clip_color_depth(composed_img)
-            filename = self.res_dir / ("Inst_" + str(frame.id) + ".png")
-            cv2.imwrite(str(filename), clipped_img)
+            exrfile = self.image_dir / ("Comp_" + name)
+        else:
+            exrfile = self.res_dir / ("Comp_" + name)
 
-            rel_pos = frame.metadata["sc_pos"] - frame.metadata["sssb_pos"]
-            rel_pos = rel_pos.value / 1000.0
-            filename = str(filename) + ".xyz"
-            with open(str(filename), "w") as priorfile:
-                priorfile.write(f"{rel_pos[0]} {rel_pos[1]} {rel_pos[2]}")
+        return (infobox_file, inst_file, exrfile)
 
-            exrfile = self.image_dir / ("Comp_" + str(frame.id))
-        else:
-            exrfile = self.res_dir / ("Comp_" + str(frame.id))
+    def write_infobox(self, filename, infobox_img, frame):
+        """Adds infobox to an 8 bit image and writes it."""
+        try:
+            self.add_infobox(infobox_img, frame.metadata)
+        except ImageCompositorError as e:
+            self.logger.debug("No Infobox could be added. %s!", str(e))
+
+        cv2.imwrite(str(filename), infobox_img)
 
-        utils.write_openexr_image(exrfile, composed_img)
+    def write_prior(self, filename, frame):
+        """Writes relative position of the sssb in km next to an image."""
+        rel_pos = frame.metadata["sc_pos"] - frame.metadata["sssb_pos"]
+        rel_pos = rel_pos.value / 1000.0
+        filename = str(filename) + ".xyz"
+        with open(str(filename), "w") as priorfile:
+            priorfile.write(f"{rel_pos[0]} {rel_pos[1]} {rel_pos[2]}")
 
-    def create_sssb_ref(self, res, scale=5):
-        """Creates a reference sssb image for calibration.
+    def create_sssb_ref(self, scale=5):
+        """Creates reference sssb profiles for calibration.
 
-        Sort of natural look by using image increased by factor of scale,
+        Sort of natural look by using a point increased by factor of scale,
         gaussian blur the result and decimate to match size of other images.
-        opencv resize algorithm needs integer divisable number of pixels
-        to have the same behaviour as skimage.transform.downscale_local_mean.
-        Zero-padding of skimage.transform.downscale_local_mean would be 
-        necessary without scaling.
-        """
-        res_x, res_y = res
+        Instead of blurring a full image, 1D profiles of the point are
+        calculated at final resolution for each of the scale sub-pixel
+        positions. Profiles are created once and cached, the reference image
+        is the outer product of a y and an x profile.
 
-        # Rescale
-        res_x_sc = res_x * scale
-        res_y_sc = res_y * scale
-        sssb_point = np.zeros((res_x_sc, res_y_sc, 4), np.float32)
+        :returns: Profiles normalised to sum 1 and offset of the first
+                  profile pixel to the pixel of the point.
+        """
+        if self._sssb_ref is not None:
+            return self._sssb_ref
 
         sig = scale / 2.0
-        kernel = int((4 * sig + 0.5) * 2)
-        ksize = (kernel, kernel)
+        kernel = int((4 * sig + 0.5) * 2) | 1
+        radius = kernel // 2
+        gauss = cv2.getGaussianKernel(kernel, sig, cv2.CV_64F).ravel()
 
-        # Create point source and blur
-        sssb_point[res_x_sc // 2, res_y_sc // 2, :] = [1., 1., 1., 1.]
-        sssb_point = cv2.GaussianBlur(sssb_point, ksize, sig)
+        offset = -(-radius // scale)
+        length = 2 * offset + 1
 
-        sssb = np.zeros((res_x, res_y, 4), np.float32)
-        sssb = cv2.resize(
-            sssb_point, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA
-        )
+        # Sum blurred point over the sub-pixels of each final pixel
+        profiles = np.zeros((scale, length), np.float64)
+        for phase in range(scale):
+            for k in range(length):
+                for m in range(scale):
+                    dist = scale * (k - offset) + m - phase
+                    if abs(dist) <= radius:
+                        profiles[phase, k] += gauss[dist + radius]
+
+        profiles /= np.sum(profiles, axis=1, keepdims=True)
+
+        self._sssb_ref = (profiles, offset, scale)
+
+        return self._sssb_ref
+
+    def add_sssb_ref(self, img, centre, flux, rows=None):
+        """
+        Adds the point source reference of the sssb to an image in place.
+
+        :type img: numpy.ndarray
+        :param img: Image with 3 color channels.
+        :type centre: tuple
+        :param centre: Sub-pixel position (y, x) of the sssb, pixel k covers
+                       positions k to k + 1.
+        :type flux: float
+        :param flux: Total flux of the sssb, distributed over all channels.
+        :type rows: tuple
+        :param rows: (first row, image height) if img is a tile of an image.
+        :returns: Maximum value added to a single channel.
+        """
+        (profiles, offset, scale) = self.create_sssb_ref()
+        (res_y, res_x, channels) = img.shape
+
+        if rows is None:
+            rows = (0, res_y)
+        (first, height) = rows
+
+        pos = []
+        for c, res in zip(centre, (height, res_x)):
+            sub_pix = min(max(int(np.floor(c * scale)), 0), res * scale - 1)
+            pos.append((sub_pix // scale - offset, sub_pix % scale))
+        ((y_start, y_phase), (x_start, x_phase)) = pos
+        y_start -= first
+
+        stamp = np.outer(profiles[y_phase], profiles[x_phase])
+        stamp *= flux / channels
+        stamp_max = np.max(stamp)
+
+        # Clip stamp footprint to image
+        y_0 = max(y_start, 0)
+        x_0 = max(x_start, 0)
+        y_1 = min(y_start + stamp.shape[0], res_y)
+        x_1 = min(x_start + stamp.shape[1], res_x)
+        if y_1 <= y_0 or x_1 <= x_0:
+            return stamp_max
+
+        stamp = stamp[y_0 - y_start:y_1 - y_start, x_0 - x_start:x_1 - x_start]
 
-        sssb *= scale * scale
-        sssb[:, :, 0:3] /= np.sum(sssb[:, :, 0:3])
+        img[y_0:y_1, x_0:x_1, :] += stamp[:, :, None].astype(img.dtype)
 
-        return sssb
+        return stamp_max
 
     def add_infobox(self, img, metadata, height=None, width=None):
         """Overlays an infobox to a given image in the lower right corner."""
@@ -458,7 +1527,7 @@ def add_infobox(self, img, metadata, height=None, width=None):
         alpha_s = textbox[:, :, 3] / 255.0
         alpha_l = 1.0 - alpha_s
 
-        for c in range(3):
+        for c in range(min(img.shape[2], 3)):
             tb_a = alpha_s * textbox[:, :, c]
             img_a = alpha_l * img[y_res - height : y_res + 1, x_res - width : x_res + 1, c]
             img_channel = tb_a + img_a
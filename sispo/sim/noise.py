@@ -0,0 +1,195 @@
+"""
+Detector noise of instruments.
+
+Noise is generated with numpy.random.Generator from seeds derived per
+frame, so results do not depend on the order or worker in which frames are
+composed. Images are processed in strips of rows in parallel threads, each
+strip has its own seed derived from the frame seed and its index. Tiles of
+an image therefore receive the same noise as the complete image if they
+start at a strip boundary.
+"""
+
+import os
+import threading
+import zlib
+from concurrent import futures
+
+import numpy as np
+
+
+class NoiseError(RuntimeError):
+    """This is a generic error for detector noise."""
+    pass
+
+
+class NoiseModel:
+    """Shot noise, dark current, read noise and quantization of a detector."""
+
+    def __init__(
+        self,
+        seed=None,
+        read_noise=0.,
+        dark_current=0.,
+        exposure_time=1.,
+        gain=None,
+        gaussian_threshold=1000.,
+        strip_rows=256,
+        workers=None
+    ):
+        """
+        :type seed: int
+        :param seed: Base seed of all frames. If None, a random base seed is
+                     drawn, it is available as attribute seed.
+        :type read_noise: float
+        :param read_noise: Standard deviation of read noise in electrons.
+        :type dark_current: float
+        :param dark_current: Dark current in electrons per second and pixel.
+        :type exposure_time: float
+        :param exposure_time: Exposure time in seconds.
+        :type gain: float
+        :param gain: Electrons per digital number, signal is quantized to
+                     multiples of gain. No quantization if None.
+        :type gaussian_threshold: float
+        :param gaussian_threshold: Above this expected number of electrons
+                                   shot noise is approximated as Gaussian.
+        :type strip_rows: int
+        :param strip_rows: Number of image rows processed per task.
+        :type workers: int
+        :param workers: Number of threads, default is number of CPUs up to 4.
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        if gain is not None and gain <= 0:
+            raise NoiseError("Gain must be positive.")
+        if strip_rows < 1:
+            raise NoiseError("Strips require at least one row.")
+
+        self.seed = int(seed)
+        self.read_noise = float(read_noise)
+        self.dark_current = float(dark_current)
+        self.exposure_time = float(exposure_time)
+        self.gain = gain
+        self.gaussian_threshold = float(gaussian_threshold)
+        self.strip_rows = int(strip_rows)
+
+        if workers is None:
+            workers = min(os.cpu_count() or 1, 4)
+        self.workers = workers
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """Thread pool is not sent to other processes."""
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_seed_sequence(self, frame_id=None):
+        """
+        Seed sequence of a frame, derived from base seed and frame id.
+
+        :type frame_id: str
+        :param frame_id: Frame id, crc32 of it is mixed into the seed.
+        """
+        entropy = [self.seed]
+        if frame_id is not None:
+            entropy.append(zlib.crc32(str(frame_id).encode("utf-8")))
+
+        return np.random.SeedSequence(entropy)
+
+    def apply(self, img, frame_id=None, out=None, row_offset=0):
+        """
+        Adds detector noise to an image of expected electrons.
+
+        :type img: numpy.ndarray
+        :param img: float32 image (height, width[, channels]) of expected
+                    number of electrons per pixel.
+        :type frame_id: str
+        :param frame_id: Frame id used to derive the seed.
+        :type out: numpy.ndarray
+        :param out: Optional output array, may be img itself.
+        :type row_offset: int
+        :param row_offset: Row of the full image at which img starts if img
+                           is a tile, must be a multiple of strip_rows.
+        :returns: Image with noise in electrons.
+        """
+        if row_offset % self.strip_rows != 0:
+            raise NoiseError("Tiles must start at a strip boundary.")
+
+        if out is None:
+            out = np.empty_like(img)
+
+        height = img.shape[0]
+        seq = self.get_seed_sequence(frame_id)
+        first = row_offset // self.strip_rows
+
+        tasks = []
+        for k, start in enumerate(range(0, height, self.strip_rows)):
+            rows = slice(start, min(start + self.strip_rows, height))
+            # Same as the strip index child of seq.spawn
+            seed = np.random.SeedSequence(
+                seq.entropy, spawn_key=seq.spawn_key + (first + k,)
+            )
+            tasks.append((img[rows], out[rows], seed))
+
+        if self.workers > 1 and len(tasks) > 1:
+            pool = self._get_pool()
+            results = [pool.submit(self._apply_strip, *task) for task in tasks]
+            for result in results:
+                result.result()
+        else:
+            for task in tasks:
+                self._apply_strip(*task)
+
+        return out
+
+    def _get_pool(self):
+        """Thread pool for strips, created on first use."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = futures.ThreadPoolExecutor(self.workers, "noise")
+
+        return self._pool
+
+    def _apply_strip(self, img, out, seed):
+        """Adds noise to a strip of rows in a single pass."""
+        rng = np.random.Generator(np.random.PCG64(seed))
+
+        # Copy of strip, so that out may be img
+        expected = np.maximum(img, 0)
+        if self.dark_current > 0:
+            expected += np.float32(self.dark_current * self.exposure_time)
+
+        # Gaussian approximation of shot noise for high signal
+        noise = rng.standard_normal(expected.shape, dtype=np.float32)
+        np.sqrt(expected, out=out)
+        out *= noise
+        out += expected
+
+        # Exact shot noise for low signal, zero signal is already zero
+        low = expected <= self.gaussian_threshold
+        low &= expected > 0
+        if np.any(low):
+            out[low] = rng.poisson(expected[low])
+
+        if self.read_noise > 0:
+            rng.standard_normal(expected.shape, dtype=np.float32, out=noise)
+            noise *= np.float32(self.read_noise)
+            out += noise
+
+        if self.gain is not None:
+            out /= np.float32(self.gain)
+            np.round(out, out=out)
+            out *= np.float32(self.gain)
+
+        return out
+
+
+if __name__ == "__main__":
+    pass
@@ -10,9 +10,10 @@
 import numpy as np
 import cv2
 import OpenEXR
-import Imath
 from org.hipparchus.geometry.euclidean.threed import Rotation, RotationConvention
 
+from .. import utilities as utils
+
 try:
     import quaternion
 
@@ -581,20 +582,20 @@ def load_coma(self, filename, dimensions, resolution, intensity, gf_ast_aa, scen
         lf_vx_ast_q = gf_vx_cam_q.conj() * gf_ast_q
 
         image = OpenEXR.InputFile(filename)
-        header = image.header()
-        mono = 'Y' in header['channels']
-        size = header["displayWindow"]
-        shape = (size.max.x - size.min.x + 1, size.max.y - size.min.y + 1)
+        mono = 'Y' in image.header()['channels']
+        image.close()
 
+        # Channels are decoded planar, each into a contiguous (rows, cols) array
         if mono:
-            data2d = np.frombuffer(image.channel('Y', Imath.PixelType(Imath.PixelType.FLOAT)), np.float32)
+            data2d = utils.read_openexr_image(filename, ('Y',), planar=True)[0]
         else:
             g, b = 1.0, 0.3  # corresponds to gas? (~jets), particles? (~haze)
-            # data2d = r * np.frombuffer(image.channel('R', Imath.PixelType(Imath.PixelType.FLOAT)), np.float32)
-            data2d = g * np.frombuffer(image.channel('G', Imath.PixelType(Imath.PixelType.FLOAT)), np.float32)
-            data2d = data2d + b * np.frombuffer(image.channel('B', Imath.PixelType(Imath.PixelType.FLOAT)), np.float32)
+            data = utils.read_openexr_image(filename, ('G', 'B'), planar=True)
+            data2d = data[0]
+            data2d *= g
+            data2d += b * data[1]
 
-        data2d = data2d.reshape(shape)
+        shape = data2d.shape
         n = int(np.prod(shape) ** (1 / 3) / 10) * 10
         k = math.ceil(n ** (1 / 2))
         voxel_data = np.zeros((n, n, n), dtype=np.float32)
@@ -0,0 +1,384 @@
+"""
+Point spread functions (PSF) of instruments and their convolution engines.
+
+A PSF is applied either as separable spatial convolution, as full 2D
+spatial convolution or as overlap-add FFT convolution. The engine is chosen
+from the kernel and image size unless it is set explicitly.
+"""
+
+import math
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from . import utilities as utils
+
+
+class PSFError(RuntimeError):
+    """This is a generic error for point spread functions."""
+    pass
+
+
+class PSF:
+    """Normalised convolution kernel and the engines to apply it."""
+
+    ENGINES = ("auto", "separable", "spatial", "fft")
+
+    # Relative cost of one FFT butterfly to one multiply-add of a kernel tap
+    FFT_COST = 24.0
+
+    # Cost of cv2.filter2D for large kernels, it switches to an internal
+    # DFT based correlation above 11 x 11 taps
+    SPATIAL_DFT_COST = 160.0
+
+    def __init__(self, kernel, separable=None, engine="auto"):
+        """
+        :type kernel: numpy.ndarray
+        :param kernel: 2D kernel, padded to odd size and normalised to sum 1.
+        :type separable: tuple
+        :param separable: Optional 1D kernels (k_y, k_x) with outer product
+                          equal to kernel.
+        :type engine: str
+        :param engine: Convolution engine, one of ENGINES.
+        """
+        if engine not in self.ENGINES:
+            raise PSFError(f"Unknown PSF engine {engine}.")
+
+        kernel = np.asarray(kernel, np.float64)
+        if kernel.ndim != 2 or np.sum(kernel) <= 0:
+            raise PSFError("PSF kernel must be 2D with positive sum.")
+
+        # Odd size, so that the kernel centre is a pixel centre
+        pad = (1 - kernel.shape[0] % 2, 1 - kernel.shape[1] % 2)
+        kernel = np.pad(kernel, ((0, pad[0]), (0, pad[1])))
+
+        norm = np.sum(kernel)
+        self.kernel = (kernel / norm).astype(np.float32)
+
+        if separable is not None:
+            (k_y, k_x) = separable
+            k_y = np.asarray(k_y, np.float64).ravel()
+            k_x = np.asarray(k_x, np.float64).ravel()
+            separable = (
+                (k_y / np.sum(k_y)).astype(np.float32),
+                (k_x / np.sum(k_x)).astype(np.float32),
+            )
+        self.separable = separable
+
+        self.engine = engine
+
+        # Kernel spectra per FFT size, created on first use
+        self._spectra = {}
+
+    @property
+    def shape(self):
+        return self.kernel.shape
+
+    def select_engine(self, img_shape):
+        """
+        Selects the cheapest engine for an image shape based on a cost model.
+
+        Cost is estimated as multiply-adds per pixel. Separable convolution
+        costs the sum, spatial convolution the product of the kernel sides
+        up to the cost of the DFT path of opencv. Overlap-add FFT costs a
+        forward and inverse transform per block, distributed over the valid
+        pixels of a block. Constants are calibrated with benchmarks/psf.py.
+        """
+        if self.engine != "auto":
+            return self.engine
+
+        (k_h, k_w) = self.shape
+
+        costs = {"spatial": min(k_h * k_w, self.SPATIAL_DFT_COST)}
+        if self.separable is not None:
+            costs["separable"] = k_h + k_w
+
+        (block_h, block_w) = self._get_block_shape(img_shape[0:2])
+        valid = (block_h - k_h + 1) * (block_w - k_w + 1)
+        fft_cost = 2 * self.FFT_COST * math.log2(block_h * block_w)
+        costs["fft"] = fft_cost * block_h * block_w / valid
+
+        return min(costs, key=costs.get)
+
+    def apply(self, img, out=None, engine=None):
+        """
+        Convolves an image with the PSF.
+
+        Borders are reflected like cv2.BORDER_REFLECT_101 for all engines.
+
+        :type img: numpy.ndarray
+        :param img: float32 image with shape (height, width[, channels]).
+        :type out: numpy.ndarray
+        :param out: Optional output array, may be img itself.
+        :type engine: str
+        :param engine: Overrides engine of the PSF.
+        :returns: Convolved image.
+        """
+        if engine is None or engine == "auto":
+            engine = self.select_engine(img.shape)
+
+        if out is None:
+            out = np.empty_like(img)
+
+        if engine == "separable":
+            if self.separable is None:
+                raise PSFError("PSF is not separable.")
+            (k_y, k_x) = self.separable
+            cv2.sepFilter2D(img, -1, k_x, k_y, dst=out)
+
+        elif engine == "spatial":
+            cv2.filter2D(img, -1, self.kernel, dst=out)
+
+        elif engine == "fft":
+            if img.ndim == 2:
+                self._convolve_fft(img, out)
+            else:
+                for c in range(img.shape[2]):
+                    out[:, :, c] = self._convolve_fft(img[:, :, c])
+
+        else:
+            raise PSFError(f"Unknown PSF engine {engine}.")
+
+        return out
+
+    def _get_block_shape(self, img_shape):
+        """FFT block shape of overlap-add for an image shape."""
+        block = []
+        for k, size in zip(self.shape, img_shape):
+            # Several kernels per block, not more than the padded image
+            length = min(max(8 * k, 1024), size + 2 * k)
+            block.append(cv2.getOptimalDFTSize(max(length, 2 * k)))
+
+        return tuple(block)
+
+    def _get_spectrum(self, block_shape):
+        """Spectrum of the kernel for FFTs of block_shape, CCS packed."""
+        if block_shape not in self._spectra:
+            # Flipped, since cv2 filters correlate instead of convolve
+            kernel = np.zeros(block_shape, np.float32)
+            (k_h, k_w) = self.shape
+            kernel[:k_h, :k_w] = self.kernel[::-1, ::-1]
+            self._spectra[block_shape] = cv2.dft(kernel, nonzeroRows=k_h)
+
+        return self._spectra[block_shape]
+
+    def _convolve_fft(self, img, out=None):
+        """Overlap-add FFT convolution of a single channel image."""
+        (height, width) = img.shape
+        (k_h, k_w) = self.shape
+        (r_y, r_x) = (k_h // 2, k_w // 2)
+
+        padded = cv2.copyMakeBorder(
+            img, r_y, r_y, r_x, r_x, cv2.BORDER_REFLECT_101
+        )
+        (pad_h, pad_w) = padded.shape
+
+        block_shape = self._get_block_shape((height, width))
+        spectrum = self._get_spectrum(block_shape)
+        step_y = block_shape[0] - k_h + 1
+        step_x = block_shape[1] - k_w + 1
+
+        # Full convolution of padded image
+        full = np.zeros((pad_h + k_h - 1, pad_w + k_w - 1), np.float32)
+        block = np.empty(block_shape, np.float32)
+
+        for y_0 in range(0, pad_h, step_y):
+            for x_0 in range(0, pad_w, step_x):
+                tile = padded[y_0:y_0 + step_y, x_0:x_0 + step_x]
+                (t_h, t_w) = tile.shape
+
+                block[:, :] = 0
+                block[:t_h, :t_w] = tile
+                tile_fft = cv2.dft(block, nonzeroRows=t_h)
+                tile_fft = cv2.mulSpectrums(tile_fft, spectrum, 0)
+                tile_conv = cv2.idft(
+                    tile_fft, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT
+                )
+
+                (t_h, t_w) = (t_h + k_h - 1, t_w + k_w - 1)
+                full[y_0:y_0 + t_h, x_0:x_0 + t_w] += tile_conv[:t_h, :t_w]
+
+        result = full[2 * r_y:2 * r_y + height, 2 * r_x:2 * r_x + width]
+
+        if out is None:
+            return result
+
+        out[:, :] = result
+        return out
+
+
+def convolve_bands(psfs, bases, weights, out=None):
+    """
+    Convolves linear combinations of base images with one PSF per band.
+
+    The image of band b is sum_i weights[b, i] * bases[i] convolved with
+    psfs[b]. Base images are transformed once, each band only requires a
+    spectral multiplication and an inverse transform. Borders are reflected
+    like cv2.BORDER_REFLECT_101.
+
+    :type psfs: list
+    :param psfs: PSF of each band.
+    :type bases: list
+    :param bases: 2D float32 base images of equal shape.
+    :type weights: numpy.ndarray
+    :param weights: Weights with shape (bands, bases).
+    :type out: numpy.ndarray
+    :param out: Optional float32 output (height, width, bands).
+    :returns: Convolved band images (height, width, bands).
+    """
+    weights = np.asarray(weights, np.float32)
+    if weights.shape != (len(psfs), len(bases)):
+        raise PSFError("Weights require shape (bands, bases).")
+
+    (height, width) = bases[0].shape
+    if out is None:
+        out = np.empty((height, width, len(psfs)), np.float32)
+
+    # Padding of images and kernels, so that transforms do not wrap
+    r_y = max(point_spread.shape[0] // 2 for point_spread in psfs)
+    r_x = max(point_spread.shape[1] // 2 for point_spread in psfs)
+    dft_shape = (
+        cv2.getOptimalDFTSize(height + 4 * r_y),
+        cv2.getOptimalDFTSize(width + 4 * r_x),
+    )
+
+    padded = np.zeros(dft_shape, np.float32)
+    spectra = []
+    for base in bases:
+        padded[:height + 2 * r_y, :width + 2 * r_x] = cv2.copyMakeBorder(
+            base, r_y, r_y, r_x, r_x, cv2.BORDER_REFLECT_101
+        )
+        spectra.append(cv2.dft(padded, nonzeroRows=height + 2 * r_y))
+
+    spectrum = np.empty_like(spectra[0])
+    for b, point_spread in enumerate(psfs):
+        np.multiply(spectra[0], weights[b, 0], out=spectrum)
+        for i in range(1, len(spectra)):
+            spectrum += weights[b, i] * spectra[i]
+
+        band = cv2.mulSpectrums(
+            spectrum, point_spread._get_spectrum(dft_shape), 0
+        )
+        band = cv2.idft(band, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+
+        # Kernel of band is flipped at origin, output is shifted by radius
+        (k_y, k_x) = (point_spread.shape[0] // 2, point_spread.shape[1] // 2)
+        out[:, :, b] = band[r_y + k_y:r_y + k_y + height,
+                            r_x + k_x:r_x + k_x + width]
+
+    return out
+
+
+def gaussian_psf(sigma, ksize=None, engine="auto"):
+    """
+    Creates a Gaussian PSF.
+
+    :type sigma: float
+    :param sigma: Standard deviation in pixels.
+    :type ksize: int
+    :param ksize: Kernel size, default is round(4 * sigma) * 2 + 1.
+    """
+    if ksize is None:
+        ksize = int(round(4 * sigma) * 2 + 1)
+
+    gauss = cv2.getGaussianKernel(ksize, sigma, cv2.CV_64F).ravel()
+
+    return PSF(np.outer(gauss, gauss), (gauss, gauss), engine)
+
+
+def bessel_j1(x):
+    """
+    Bessel function of the first kind of order one.
+
+    Polynomial approximations 9.4.4 and 9.4.6 of Abramowitz and Stegun,
+    absolute error below 1E-7.
+    """
+    x = np.asarray(x, np.float64)
+    ax = np.abs(x)
+    j_1 = np.empty_like(ax)
+
+    small = ax <= 3.
+    t = (ax[small] / 3.) ** 2
+    j_1[small] = ax[small] * (0.5 + t * (-0.56249985 + t * (0.21093573
+                 + t * (-0.03954289 + t * (0.00443319 + t * (-0.00031761
+                 + t * 0.00001109))))))
+
+    large = ~small
+    t = 3. / ax[large]
+    f_1 = (0.79788456 + t * (0.00000156 + t * (0.01659667 + t * (0.00017105
+           + t * (-0.00249511 + t * (0.00113653 + t * -0.00020033))))))
+    theta_1 = (ax[large] - 2.35619449 + t * (0.12499612 + t * (0.00005650
+               + t * (-0.00637879 + t * (0.00074348 + t * (0.00079824
+               + t * -0.00029166))))))
+    j_1[large] = f_1 * np.cos(theta_1) / np.sqrt(ax[large])
+
+    return np.sign(x) * j_1
+
+
+def airy_psf(zero_radius, rings=5, oversample=5, engine="auto"):
+    """
+    Creates an Airy disk PSF of a circular aperture.
+
+    The intensity (2 J1(x) / x)^2 is integrated over each pixel by
+    oversampling.
+
+    :type zero_radius: float
+    :param zero_radius: Radius of the first dark ring in pixels, i.e.
+                        1.22 * wavelength * focal length / aperture diameter
+                        divided by the pixel pitch.
+    :type rings: int
+    :param rings: Approximate number of rings included in the kernel.
+    :type oversample: int
+    :param oversample: Sub-samples per pixel and axis.
+    """
+    radius = max(int(math.ceil(rings * zero_radius)), 2)
+
+    sub = (np.arange(oversample) + 0.5) / oversample - 0.5
+    coords = (np.arange(-radius, radius + 1)[:, None] + sub).ravel()
+    r = np.hypot(coords[:, None], coords[None, :])
+
+    # First zero of J1 at x = 3.8317
+    x = 3.8317 * r / zero_radius
+    with np.errstate(invalid="ignore", divide="ignore"):
+        intensity = (2 * bessel_j1(x) / x) ** 2
+    intensity[x == 0] = 1.
+
+    size = 2 * radius + 1
+    kernel = intensity.reshape(size, oversample, size, oversample)
+    kernel = kernel.sum(axis=(1, 3))
+
+    return PSF(kernel, engine=engine)
+
+
+def file_psf(filename, engine="auto"):
+    """
+    Creates a PSF from a kernel file.
+
+    Supports numpy .npy files, OpenEXR files (red channel) and any image
+    format opencv can read (first channel).
+    """
+    filename = Path(filename)
+
+    if filename.suffix == ".npy":
+        kernel = np.load(str(filename))
+    elif filename.suffix == ".exr":
+        kernel = utils.read_openexr_image(filename, ("R",))
+        if kernel is None:
+            raise PSFError(f"Unable to read PSF file {filename}.")
+    else:
+        kernel = cv2.imread(
+            str(filename), cv2.IMREAD_UNCHANGED | cv2.IMREAD_ANYDEPTH
+        )
+        if kernel is None:
+            raise PSFError(f"Unable to read PSF file {filename}.")
+
+    kernel = np.asarray(kernel, np.float64)
+    if kernel.ndim == 3:
+        kernel = kernel[:, :, 0]
+
+    return PSF(kernel, engine=engine)
+
+
+if __name__ == "__main__":
+    pass
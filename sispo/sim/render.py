@@ -6,20 +6,22 @@
 
 import math
 import json
+import os
 import struct
 import time
 import threading
 import zlib
+from concurrent import futures
 from pathlib import Path
 
 import bpy
-import cv2
 import numpy as np
 from astropy import units as u
-from mathutils import Vector, Quaternion  # pylint: disable=import-error
+from bpy_extras.object_utils import world_to_camera_view  # pylint: disable=import-error
+from mathutils import Matrix, Vector, Quaternion  # pylint: disable=import-error
 
 from . import compositor as cp
-from . import starcat, utilities
+from . import runstore, starcat, utilities
 from .compositor import *
 from .starcat import *
 
@@ -34,6 +36,12 @@ class BlenderControllerError(RuntimeError):
     pass
 
 
+# Scene journal and base .blend file of a run in the raw directory
+JOURNAL_FILE = "scene_journal.jsonl"
+BASE_DFILE = "scene_base.blend"
+SCENE_SNAPSHOTS = ("journal", "blend", "none")
+
+
 class BlenderController:
     """Class to control blender module behaviour."""
 
@@ -46,9 +54,32 @@ def __init__(
         sssb,
         with_infobox,
         with_clipping,
+        star_mag_limit=None,
+        compositor=None,
+        exr=None,
+        run_store=None,
+        scene_snapshots="journal",
+        write_raw=True,
+        post_queue_size=2,
         ext_logger=None
     ):
-        """Initialise blender controller class."""
+        """
+        Initialise blender controller class.
+
+        :type scene_snapshots: str
+        :param scene_snapshots: "journal" records the scene state of each
+                                frame in a journal, from which .blend files
+                                are rebuilt with rebuild_blend. "blend"
+                                saves a .blend file per scene and frame,
+                                "none" saves neither.
+        :type write_raw: bool
+        :param write_raw: Whether raw images are written to OpenEXR files
+                          or the run store. Frames are composed from the
+                          render results in memory in any case.
+        :type post_queue_size: int
+        :param post_queue_size: Number of rendered frames waiting for post
+                                processing before rendering blocks.
+        """
 
         if ext_logger is not None:
             self.logger = ext_logger
@@ -57,6 +88,34 @@ def __init__(
 
         self.raw_dir = raw_dir
         self.res_dir = res_dir
+
+        if scene_snapshots not in SCENE_SNAPSHOTS:
+            raise BlenderControllerError(
+                f"Invalid scene snapshots setting {scene_snapshots}."
+            )
+        self.scene_snapshots = scene_snapshots
+        self._journal = None
+        self.write_raw = write_raw
+
+        # OpenEXR settings of raw and composed images
+        if exr is None:
+            exr = {}
+        self.raw_exr = dict(exr.get("raw", {}))
+
+        # Raw frames are appended to a run store instead of single files,
+        # render workers append to a shard sub directory of the store
+        self.store = None
+        enabled = run_store is not None and run_store.get("enabled", False)
+        if enabled and write_raw:
+            store_settings = dict(run_store)
+            del store_settings["enabled"]
+            store_dir = self.raw_dir / "store"
+            shard = store_settings.pop("shard", None)
+            if shard is not None:
+                store_dir = store_dir / shard
+            self.store = runstore.RunStore(store_dir, **store_settings)
+            self.logger.debug("Raw frames are stored in %s",
+                              self.store.store_dir)
         self.cycles = bpy.context.preferences.addons["cycles"]
 
         self.default_scene = bpy.context.scene
@@ -80,10 +139,15 @@ def __init__(
 
         # Star catalog
         self.sta = starcat.StarCatalog(
-            self.raw_dir, ext_logger=self.logger, starcat_dir=starcat_dir
+            self.raw_dir,
+            ext_logger=self.logger,
+            starcat_dir=starcat_dir,
+            mag_limit=star_mag_limit
         )
 
         # Create compositor
+        if compositor is None:
+            compositor = {}
         self.comp = cp.ImageCompositor(
             self.res_dir,
             self.raw_dir,
@@ -91,11 +155,28 @@ def __init__(
             sssb,
             with_infobox,
             with_clipping,
-            ext_logger=self.logger
+            ext_logger=self.logger,
+            exr=exr.get("composition"),
+            store=self.store,
+            **compositor
         )
 
         self.render_id = zlib.crc32(struct.pack("!f", time.time()))
 
+        # Starmaps, raw outputs and composition of rendered frames are
+        # processed in a background thread while the next frame renders.
+        # A single thread keeps star catalog state and store order simple.
+        self._post_pool = None
+        self._post_slots = threading.BoundedSemaphore(post_queue_size)
+        self._post_futures = []
+        self._post_lock = threading.Lock()
+        self._render_time = 0.
+        self._post_time = 0.
+
+        # Region of interest rendering, see enable_roi
+        self.roi_object = None
+        self.roi_margin = None
+
     def create_scene(self, scene_name):
         """Add empty scene."""
         bpy.ops.scene.new(type="FULL_COPY")
@@ -137,6 +218,161 @@ def set_scene_defaults(self, scenes=None):
             scene.cycles.seed = time.time()
             scene.cycles.film_transparent = True
 
+            self.setup_viewer(scene)
+
+    def setup_viewer(self, scene):
+        """
+        Links render layers to a viewer node of the compositing nodes.
+
+        After rendering, the viewer image holds the float RGBA render result,
+        which is read by get_render_result.
+        """
+        scene.use_nodes = True
+        tree = scene.node_tree
+
+        layers = tree.nodes.get("Render Layers")
+        if layers is None:
+            layers = tree.nodes.new("CompositorNodeRLayers")
+        viewer = tree.nodes.get("Viewer")
+        if viewer is None:
+            viewer = tree.nodes.new("CompositorNodeViewer")
+        viewer.use_alpha = True
+
+        tree.links.new(layers.outputs["Image"], viewer.inputs["Image"])
+        tree.links.new(layers.outputs["Alpha"], viewer.inputs["Alpha"])
+
+    def get_render_result(self, scene=None):
+        """
+        Returns the last render result from the viewer image.
+
+        If the result is cropped to the render border of scene, it is pasted
+        into a full size image with zero alpha elsewhere.
+
+        :returns: float32 image (height, width, 4), top row first.
+        """
+        image = bpy.data.images["Viewer Node"]
+        (width, height) = image.size
+
+        pixels = np.empty(width * height * 4, np.float32)
+        image.pixels.foreach_get(pixels)
+
+        # Blender stores rows bottom-up
+        pixels = pixels.reshape(height, width, 4)[::-1]
+
+        if scene is None or not scene.render.use_border:
+            return np.ascontiguousarray(pixels)
+
+        scale = scene.render.resolution_percentage / 100
+        full_w = int(scene.render.resolution_x * scale)
+        full_h = int(scene.render.resolution_y * scale)
+        if (height, width) == (full_h, full_w):
+            return np.ascontiguousarray(pixels)
+
+        x_0 = int(scene.render.border_min_x * full_w)
+        y_0 = full_h - int(scene.render.border_min_y * full_h) - height
+        x_0 = min(max(x_0, 0), full_w - width)
+        y_0 = min(max(y_0, 0), full_h - height)
+
+        result = np.zeros((full_h, full_w, 4), np.float32)
+        result[y_0:y_0 + height, x_0:x_0 + width] = pixels
+
+        return result
+
+    def enable_roi(self, obj, margin=8):
+        """
+        Renders only the region of interest of each frame.
+
+        SssbOnly and SssbConstDist are rendered inside the projected bounding
+        box of obj, LightRef inside the centre patch used for calibration.
+        Pixels outside are empty with zero alpha.
+
+        :type obj: bpy.types.Object
+        :param obj: Object of the region of interest, i.e. the SSSB.
+        :type margin: int
+        :param margin: Margin in pixels around the projected bounding box,
+                       covers the pixel filter of Cycles.
+        """
+        self.roi_object = obj
+        self.roi_margin = margin
+
+    def calc_roi(self, obj, scene, margin=8):
+        """
+        Calculates the render border of an object seen by the scene camera.
+
+        Corners of the bounding box are projected, which encloses the
+        projected object if all corners are in front of the camera.
+
+        :returns: Normalised border (min_x, max_x, min_y, max_y) with origin
+                  at the bottom left or None if the full frame is required.
+        """
+        camera = scene.camera
+        corners = [obj.matrix_world @ Vector(corner) for corner in obj.bound_box]
+        coords = [world_to_camera_view(scene, camera, co) for co in corners]
+
+        if any(co.z <= 0 for co in coords):
+            return None
+
+        scale = scene.render.resolution_percentage / 100
+        pixel_x = 1 / (scene.render.resolution_x * scale)
+        pixel_y = 1 / (scene.render.resolution_y * scale)
+        margin_x = margin * pixel_x
+        margin_y = margin * pixel_y
+
+        min_x = max(min(co.x for co in coords) - margin_x, 0.)
+        max_x = min(max(co.x for co in coords) + margin_x, 1.)
+        min_y = max(min(co.y for co in coords) - margin_y, 0.)
+        max_y = min(max(co.y for co in coords) + margin_y, 1.)
+
+        # Object outside of the frame, render a single pixel
+        if min_x >= max_x or min_y >= max_y:
+            return (0., pixel_x, 0., pixel_y)
+
+        return (min_x, max_x, min_y, max_y)
+
+    def set_border(self, scene, border=None):
+        """
+        Sets the render border of a scene, None renders the full frame.
+
+        The result is not cropped, pixels outside the border are empty.
+        """
+        if border is None:
+            scene.render.use_border = False
+            return
+
+        (min_x, max_x, min_y, max_y) = border
+        scene.render.use_border = True
+        scene.render.use_crop_to_border = False
+        scene.render.border_min_x = min_x
+        scene.render.border_max_x = max_x
+        scene.render.border_min_y = min_y
+        scene.render.border_max_y = max_y
+
+    def set_scene_roi(self, scene):
+        """Sets the render border of a scene to its region of interest."""
+        border = None
+
+        if scene.name in ("SssbOnly", "SssbConstDist"):
+            border = self.calc_roi(self.roi_object, scene, self.roi_margin)
+
+        elif scene.name == "LightRef":
+            scale = scene.render.resolution_percentage / 100
+            width = scene.render.resolution_x * scale
+            height = scene.render.resolution_y * scale
+            half = cp.Frame.REF_PATCH_SIZE // 2 + self.roi_margin
+            border = (
+                max(width // 2 - half, 0) / width,
+                min(width // 2 + half, width) / width,
+                max(height // 2 - half, 0) / height,
+                min(height // 2 + half, height) / height,
+            )
+
+        self.set_border(scene, border)
+
+        if border is not None:
+            area = (border[1] - border[0]) * (border[3] - border[2])
+            self.logger.debug("%s region of interest covers %.2f %%",
+                              scene.name, 100 * area)
+
     def set_device(self, device="AUTO", tile_size=None, scenes=None):
         """Set cycles rendering device for given scenes.
 
@@ -219,6 +455,17 @@ def _get_tile_size(self):
 
         return tile_size
 
+    def set_threads(self, threads=None, scenes=None):
+        """
+        Limits number of Cycles render threads, None detects all CPUs.
+        """
+        for scene in self._get_scenes_iter(scenes):
+            if threads is None:
+                scene.render.threads_mode = "AUTO"
+            else:
+                scene.render.threads_mode = "FIXED"
+                scene.render.threads = threads
+
     def set_samples(self, samples=6, scenes=None):
         """Set number of samples to render for each pixel."""
         for scene in self._get_scenes_iter(scenes):
@@ -239,13 +486,31 @@ def set_resolution(self, res, scenes=None):
             scene.render.resolution_y = res_y
 
     def set_output_format(
-        self, file_format="OPEN_EXR", color_depth="32", use_preview=True, scenes=None
+        self,
+        file_format="OPEN_EXR",
+        color_depth=None,
+        use_preview=True,
+        exr_codec=None,
+        scenes=None
     ):
-        """Set output file format."""
+        """
+        Set output file format.
+
+        EXR codec defaults to the raw EXR settings. Color depth defaults to
+        "32", i.e. float. Half floats of the raw settings are written by
+        write_raw_scenes after check_half_precision, not by blender.
+        """
+        if color_depth is None:
+            color_depth = "32"
+        if exr_codec is None:
+            exr_codec = self.raw_exr.get("compression", "ZIP")
+
         for scene in self._get_scenes_iter(scenes):
             scene.render.image_settings.file_format = file_format
             scene.render.image_settings.color_depth = color_depth
             scene.render.image_settings.use_preview = use_preview
+            if file_format == "OPEN_EXR":
+                scene.render.image_settings.exr_codec = exr_codec
 
     def set_output_file(self, name_suffix=None, scene=bpy.context.scene):
         """Set output file path to given scenes with prior extension check."""
@@ -309,9 +574,18 @@ def get_camera(self, camera_name="Camera"):
         return bpy.data.objects[camera_name]
 
     def target_camera(self, target, camera_name="Camera"):
-        """Target camera towards target."""
+        """
+        Target camera towards target.
+
+        An existing TRACK_TO constraint of the camera is reused, so that
+        targeting every frame does not add constraints.
+        """
         camera = bpy.data.objects[camera_name]
-        camera_constr = camera.constraints.new(type="TRACK_TO")
+        for camera_constr in camera.constraints:
+            if camera_constr.type == "TRACK_TO":
+                break
+        else:
+            camera_constr = camera.constraints.new(type="TRACK_TO")
         camera_constr.track_axis = "TRACK_NEGATIVE_Z"
         camera_constr.up_axis = "UP_Y"
         camera_constr.target = target
@@ -327,24 +601,185 @@ def render(self, metainfo, scenes=None):
         if metainfo["date"] is None:
             name = self.raw_dir / f"r{self.render_id:0.8X}"
 
+        # Fail early if post processing of a previous frame failed
+        self._check_post()
+        start = time.time()
+
+        # Raw files are only written by blender without run store
+        # Half floats are checked and written in post processing
+        write_still = (self.write_raw and self.store is None
+                       and not self.raw_exr.get("half", False))
+
+        images = {}
         for scene in self._get_scenes_iter(scenes):
             self.update(scene)
+            if self.roi_object is not None:
+                self.set_scene_roi(scene)
             self.set_output_file(metainfo["date"], scene)
-            bpy.ops.render.render(write_still=True, scene=scene.name)
-            self.save_blender_dfile(metainfo["date"], scene)
+            bpy.ops.render.render(write_still=write_still, scene=scene.name)
+            images[scene.name] = self.get_render_result(scene)
+            if self.scene_snapshots == "blend":
+                self.save_blender_dfile(metainfo["date"], scene)
 
-        # Render star background
+        if self.scene_snapshots == "journal":
+            self.write_journal_entry(metainfo["date"])
+
+        # Cameras move with the next frame, starmap FOV is taken now. Post
+        # processing does not access blender, which is not thread-safe.
+        scale = self.default_scene.render.resolution_percentage
         res = (
-            self.default_scene.render.resolution_x, 
-            self.default_scene.render.resolution_y
+            int(self.default_scene.render.resolution_x * scale / 100),
+            int(self.default_scene.render.resolution_y * scale / 100)
+        )
+        fov = get_fov("ScCam", "SssbOnly")
+        fov_vecs = tuple(vec.copy() for vec in get_fov_vecs("ScCam", "SssbOnly"))
+
+        self._render_time += time.time() - start
+
+        self.submit_post(metainfo, images, res, fov, fov_vecs)
+
+    def submit_post(self, metainfo, images, res, fov, fov_vecs):
+        """
+        Submits post processing of a rendered frame to the background thread.
+
+        Blocks if post_queue_size frames are already waiting.
+        """
+        self._post_slots.acquire()
+
+        try:
+            with self._post_lock:
+                if self._post_pool is None:
+                    self._post_pool = futures.ThreadPoolExecutor(1, "post")
+                future = self._post_pool.submit(
+                    self._post_process, metainfo, images, res, fov, fov_vecs
+                )
+                self._post_futures.append(future)
+        except Exception:
+            self._post_slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._post_slots.release())
+
+        return future
+
+    def _check_post(self, wait=False):
+        """
+        Removes finished post processing tasks, raises their errors.
+
+        :type wait: bool
+        :param wait: Whether to wait for all submitted tasks.
+        """
+        with self._post_lock:
+            pending = list(self._post_futures)
+
+        if wait:
+            futures.wait(pending)
+
+        for future in pending:
+            if not future.done():
+                continue
+            with self._post_lock:
+                self._post_futures.remove(future)
+            if future.exception() is not None:
+                self.logger.debug("Post processing failed: %s",
+                                  future.exception())
+                raise RenderingError(
+                    "Post processing of a frame failed."
+                ) from future.exception()
+
+    def _post_process(self, metainfo, images, res, fov, fov_vecs):
+        """
+        Renders starmap, writes raw outputs and submits frame composition.
+
+        Runs in the post processing thread.
+        """
+        start = time.time()
+
+        if self.store is not None:
+            for scene_name, image in images.items():
+                self.store.append_scene(metainfo["date"], scene_name, image)
+        elif self.write_raw and self.raw_exr.get("half", False):
+            self.write_raw_scenes(metainfo["date"], images)
+
+        # Render star background
+        fluxes = self.render_starmap(
+            res, metainfo["date"], self.write_raw, fov, fov_vecs
         )
-        fluxes = self.render_starmap(res, metainfo["date"])
+        images["Stars"] = fluxes[3]
 
         metainfo["total_flux"] = fluxes[0]
+        metainfo["dropped_flux"] = fluxes[2]
+        if fluxes[2] > 0:
+            self.logger.debug(
+                "Dropped %g of %g star flux (%.3f %%) fainter than mag %g",
+                fluxes[2], fluxes[0] + fluxes[2],
+                100 * fluxes[2] / (fluxes[0] + fluxes[2]), self.sta.mag_limit)
 
         self.write_meta_file(metainfo)
 
-        self.comp.compose(frames=metainfo["date"])
+        # Frame is handed to the compositor in memory if all scenes exist
+        scene_names = ("Stars", "SssbOnly", "SssbConstDist", "LightRef")
+        if all(name in images for name in scene_names):
+            frame = cp.Frame(
+                metainfo["date"],
+                stars=images["Stars"],
+                sssb_only=images["SssbOnly"],
+                sssb_const_dist=images["SssbConstDist"],
+                light_ref=images["LightRef"],
+                metadata=cp.Frame.parse_metadata(metainfo)
+            )
+            self.comp.submit(frame)
+        else:
+            self.comp.submit(metainfo["date"])
+
+        self._post_time += time.time() - start
+
+        return metainfo["date"]
+
+    def write_raw_scenes(self, name_suffix, images):
+        """
+        Writes rendered scene images with the raw OpenEXR settings.
+
+        Images stored as half floats must pass check_half_precision,
+        otherwise they are stored as floats. Does not access blender.
+
+        :type images: dict
+        :param images: Scene name and image pairs.
+        """
+        for scene_name, image in images.items():
+            filename = self.raw_dir / (scene_name + "_" + str(name_suffix))
+            half = utilities.write_openexr_image(
+                filename, image, **self.raw_exr
+            )
+            if not half:
+                self.logger.debug("%s %s exceeds half float tolerance, "
+                                  "stored as float", scene_name, name_suffix)
+
+    def finish(self):
+        """
+        Waits until all rendered frames are post processed and composed.
+
+        :raises RenderingError: If post processing of a frame failed.
+        """
+        try:
+            try:
+                self._check_post(wait=True)
+            finally:
+                with self._post_lock:
+                    pool = self._post_pool
+                    self._post_pool = None
+                if pool is not None:
+                    pool.shutdown()
+                self.comp.close()
+
+            self.logger.debug("Render time %.1f s, post processing %.1f s",
+                              self._render_time, self._post_time)
+        finally:
+            if self.store is not None:
+                self.store.close()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
 
     def load_object(self, filename, object_name, scenes=None):
         """Load blender object from file."""
@@ -384,8 +819,88 @@ def save_blender_dfile(self, name_suffix=None, scene=bpy.context.scene):
 
         bpy.ops.wm.save_as_mainfile(filepath=filename)
 
+    def save_base_dfile(self):
+        """
+        Saves the .blend file the scene journal is applied to.
+
+        The file is written under a temporary name first, so that render
+        workers saving the same base do not corrupt it.
+        """
+        filename = self.raw_dir / BASE_DFILE
+        tmp_filename = self.raw_dir / f"{BASE_DFILE}.{self.render_id:0.8X}"
+
+        bpy.ops.wm.save_as_mainfile(filepath=str(tmp_filename), copy=True)
+        os.replace(str(tmp_filename), str(filename))
+
+    def write_journal_entry(self, name_suffix):
+        """
+        Appends the scene state of a frame to the scene journal.
+
+        The state are world matrices of all objects, i.e. including
+        constraints, camera data and render settings of all scenes. Meshes
+        and materials are only saved once in the base .blend file.
+        """
+        if self._journal is None:
+            self.save_base_dfile()
+            filename = self.raw_dir / JOURNAL_FILE
+            self._journal = open(str(filename), "a")
+
+        entry = {
+            "frame": str(name_suffix),
+            "base": BASE_DFILE,
+            "objects": {},
+            "cameras": {},
+            "scenes": {},
+        }
+
+        for obj in bpy.data.objects:
+            entry["objects"][obj.name] = {
+                "matrix_world": [list(row) for row in obj.matrix_world],
+                "hide_render": obj.hide_render,
+            }
+
+        for cam in self.cameras:
+            entry["cameras"][cam.name] = {
+                "type": cam.type,
+                "lens": cam.lens,
+                "sensor_width": cam.sensor_width,
+                "clip_start": cam.clip_start,
+                "clip_end": cam.clip_end,
+                "ortho_scale": cam.ortho_scale,
+            }
+
+        for scene in self.scenes:
+            entry["scenes"][scene.name] = {
+                "camera": scene.camera.name if scene.camera else None,
+                "resolution_x": scene.render.resolution_x,
+                "resolution_y": scene.render.resolution_y,
+                "resolution_percentage": scene.render.resolution_percentage,
+                "samples": scene.cycles.samples,
+                "seed": scene.cycles.seed,
+                "exposure": scene.view_settings.exposure,
+                "filepath": scene.render.filepath,
+                "use_border": scene.render.use_border,
+                "border": [
+                    scene.render.border_min_x,
+                    scene.render.border_max_x,
+                    scene.render.border_min_y,
+                    scene.render.border_max_y,
+                ],
+            }
+
+        # One write per line, lines of several workers do not interleave
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
     def write_meta_file(self, metainfo):
-        """Writes metafile for a frame."""
+        """
+        Writes metafile for a frame.
+
+        With run store, the frame is completed in the store instead.
+        """
+        if self.store is not None:
+            self.store.append_frame(metainfo["date"], metainfo)
+            return
 
         filename = self.raw_dir / ("Metadata_" + str(metainfo["date"]))
         filename = str(filename)
@@ -426,82 +941,185 @@ def _get_scenes_iter(self, scenes):
 
         return iter(output)
 
-    def render_starmap(self, res, name_suffix):
-        """Render a starmap from given data and field of view."""
-        
-        ra, dec, width, height = get_fov("ScCam", "SssbOnly")
-        res_file = f"ucac4_{name_suffix}"
-        stardata = self.sta.get_stardata(ra, dec, width, height, res_file)
+    def get_starmap_fov(self):
+        """Calculates the current starmap FOV after updating the cameras."""
+        self.default_scene.view_layers.update()
 
-        fov_vecs = get_fov_vecs("ScCam", "SssbOnly")
-        (direction, right_edge, _, upper_edge, _) = fov_vecs
-        (res_x, res_y) = res
+        return get_fov("ScCam", "SssbOnly")
 
-        scale = self.default_scene.render.resolution_percentage
-        res_x = int(res_x * scale / 100)
-        res_y = int(res_y * scale / 100)
+    def get_camera_basis(self, camera_name="Camera"):
+        """
+        Returns view direction, up and right vectors of a camera.
 
-        upper_edge -= direction
-        right_edge -= direction
-        up_norm = upper_edge.normalized()
-        right_norm = right_edge.normalized()
-        f_over_h_ccd_2 = 1.0 / upper_edge.length
-        f_over_w_ccd_2 = 1.0 / right_edge.length
+        Vectors are unit vectors in world coordinates as numpy arrays.
+        """
+        self.default_scene.view_layers.update()
 
-        ss = 2
-        starmap = np.zeros((res_y * ss, res_x * ss, 4), np.float32)
+        camera = bpy.data.objects[camera_name]
+        rot = camera.matrix_world.to_quaternion()
+        direction = rot @ Vector((0.0, 0.0, -1.0))
+        up_vec = rot @ Vector((0.0, 1.0, 0.0))
+        right_vec = direction.cross(up_vec)
+
+        return tuple(np.asarray(vec) for vec in (direction, up_vec, right_vec))
+
+    def preload_stars(self, fovs, margin=0.1):
+        """
+        Queries stars of all given FOVs once before rendering.
+
+        Each frame then selects its stars from memory, see
+        :py:meth:`starcat.StarCatalog.preload`.
+        """
+        self.sta.preload(fovs, margin)
+
+    def render_starmap(
+        self,
+        res,
+        name_suffix,
+        write=True,
+        fov=None,
+        fov_vecs=None
+    ):
+        """
+        Render a starmap from given data and field of view.
+
+        Blender is only accessed if fov or fov_vecs are not given.
+
+        :type res: tuple
+        :param res: Resolution (x, y) of the starmap in pixels, including
+                    the resolution percentage of the scene.
+        :type write: bool
+        :param write: Whether the starmap is written to file or run store.
+        :type fov: tuple
+        :param fov: FOV as returned by get_fov, default is current ScCam FOV.
+        :type fov_vecs: tuple
+        :param fov_vecs: FOV vectors as returned by get_fov_vecs, default
+                         are current ScCam vectors.
+        :returns: Tuple of total flux, flux in the starmap, dropped flux and
+                  the starmap image.
+        """
         
-        # Set alpha channel
-        starmap[:, :, 3] = 1.0
-
-        total_flux = 0.0
-        for star in stardata:
-            mag_star = star[2]
-            flux = np.power(10., -0.4 * mag_star)
-            total_flux += flux
-            ra_star = np.radians(star[0])
-            dec_star = np.radians(star[1])
-
-            z_star = np.sin(dec_star)
-            x_star = np.cos(dec_star) * np.cos(ra_star - np.pi)
-            y_star = -np.cos(dec_star) * np.sin(ra_star - np.pi)
-            vec = [x_star, y_star, z_star]
-            vec2 = [x_star, -y_star, z_star]
-            if np.dot(vec, direction) < np.dot(vec2, direction):
-                vec = vec2
-            x_pix = ss * ((f_over_w_ccd_2 * np.dot(right_norm, vec)
-                    / np.dot(direction, vec) + 1.0)) * (res_x - 1) / 2.0
-            x_pix = min(round(x_pix), res_x * ss - 1)
-            x_pix = max(0, int(x_pix))
-            y_pix = ss * ((-f_over_h_ccd_2 * np.dot(up_norm, vec)
-                    / np.dot(direction, vec) + 1.)) * (res_y - 1) / 2.
-            y_pix = min(round(y_pix), res_y * ss - 1)
-            y_pix = max(0, int(y_pix))
-            # Add flux to color channels
-            starmap[y_pix, x_pix, 0:3] += flux
-
-        # Kernel size calculated to equal skimage.filters.gaussian
-        # Reference:
-        # https://github.com/scipy/scipy/blob/4bfc152f6ee1ca48c73c06e27f7ef021d729f496/scipy/ndimage/filters.py#L214
-        sig = ss / 2.0
-        kernel = int((4 * sig + 0.5) * 2)
-        ksize = (kernel, kernel)
-
-        # Border type replicate is equal to skimage.filters.gaussian nearest
-        sm_gauss = cv2.GaussianBlur(
-            starmap, ksize, sig, borderType=cv2.BORDER_REPLICATE
+        if fov is None:
+            fov = get_fov("ScCam", "SssbOnly")
+        if fov_vecs is None:
+            fov_vecs = get_fov_vecs("ScCam", "SssbOnly")
+
+        ra, dec, width, height = fov
+        stardata = self.sta.get_stardata(ra, dec, width, height)
+        (res_x, res_y) = res
+
+        # Star positions are determined on a supersampled grid
+        ss = 2
+        x_pix, y_pix, flux = starcat.project_stars(
+            stardata, fov_vecs, (res_x, res_y), ss
+        )
+        total_flux = np.sum(flux)
+
+        sm_scale = np.empty((res_y, res_x, 4), np.float32)
+        sm_scale[:, :, 0] = starcat.splat_stars(
+            (res_y, res_x), x_pix, y_pix, flux, ss
         )
+        sm_scale[:, :, 1] = sm_scale[:, :, 0]
+        sm_scale[:, :, 2] = sm_scale[:, :, 0]
 
-        sm_scale = np.zeros((res_y, res_x, 4), np.float32)
-        sm_scale = cv2.resize(
-            sm_gauss, None, fx=1 / ss, fy=1 / ss, interpolation=cv2.INTER_AREA
+        # Set alpha channel
+        sm_scale[:, :, 3] = 1.0
+
+        if write and self.store is not None:
+            self.store.append_scene(name_suffix, "Stars", sm_scale)
+        elif write:
+            filename = self.raw_dir / ("Stars_" + name_suffix)
+            half = utilities.write_openexr_image(
+                filename, sm_scale, **self.raw_exr
+            )
+            if self.raw_exr.get("half", False) and not half:
+                self.logger.debug("Starmap %s exceeds half float tolerance, "
+                                  "stored as float", name_suffix)
+
+        return (
+            total_flux,
+            np.sum(sm_scale[:, :, 0]),
+            self.sta.dropped_flux,
+            sm_scale
         )
-        sm_scale *= ss * ss
 
-        filename = self.raw_dir / ("Stars_" + name_suffix)
-        utilities.write_openexr_image(filename, sm_scale)
 
-        return (total_flux, np.sum(sm_scale[:, :, 0]))
+def rebuild_blend(raw_dir, frame_id, filename=None):
+    """
+    Rebuilds a .blend file of a frame from the scene journal.
+
+    The base .blend file is opened and the journal entry of the frame is
+    applied. Constraints are removed, as their result is part of the
+    recorded world matrices. The current blender file is replaced.
+
+    :type raw_dir: Path
+    :param raw_dir: Raw directory of a run with scene journal.
+    :type frame_id: str
+    :param frame_id: Frame id, i.e. date string, of the frame.
+    :type filename: Path
+    :param filename: Output .blend file, default is Scenes_<frame_id>.blend
+                     in raw_dir.
+    :returns: File name of the rebuilt .blend file.
+    """
+    raw_dir = Path(raw_dir)
+
+    entry = None
+    with open(str(raw_dir / JOURNAL_FILE), "r") as journal:
+        for line in journal:
+            if not line.strip():
+                continue
+            candidate = json.loads(line)
+            # Last entry wins if a frame was rendered again
+            if candidate["frame"] == frame_id:
+                entry = candidate
+
+    if entry is None:
+        raise BlenderControllerError(f"Frame {frame_id} not in journal.")
+
+    bpy.ops.wm.open_mainfile(filepath=str(raw_dir / entry["base"]))
+
+    for name, state in entry["objects"].items():
+        obj = bpy.data.objects.get(name)
+        if obj is None:
+            continue
+        for constraint in list(obj.constraints):
+            obj.constraints.remove(constraint)
+        obj.matrix_world = Matrix(state["matrix_world"])
+        obj.hide_render = state["hide_render"]
+
+    for name, state in entry["cameras"].items():
+        cam = bpy.data.cameras.get(name)
+        if cam is None:
+            continue
+        for key, value in state.items():
+            setattr(cam, key, value)
+
+    for name, state in entry["scenes"].items():
+        scene = bpy.data.scenes.get(name)
+        if scene is None:
+            continue
+        if state["camera"] is not None:
+            scene.camera = bpy.data.objects[state["camera"]]
+        scene.render.resolution_x = state["resolution_x"]
+        scene.render.resolution_y = state["resolution_y"]
+        scene.render.resolution_percentage = state["resolution_percentage"]
+        scene.cycles.samples = state["samples"]
+        scene.cycles.seed = state["seed"]
+        scene.view_settings.exposure = state["exposure"]
+        scene.render.filepath = state["filepath"]
+        if "use_border" in state:
+            scene.render.use_border = state["use_border"]
+            (scene.render.border_min_x,
+             scene.render.border_max_x,
+             scene.render.border_min_y,
+             scene.render.border_max_y) = state["border"]
+
+    if filename is None:
+        filename = raw_dir / ("Scenes_" + frame_id + ".blend")
+
+    bpy.ops.wm.save_as_mainfile(filepath=str(filename))
+
+    return filename
 
 
 def get_fov_vecs(camera_name, scene_name):
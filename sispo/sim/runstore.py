@@ -0,0 +1,368 @@
+"""
+Run store of raw frames.
+
+Instead of one OpenEXR file per scene and frame, raw frames of a run can be
+appended to a run store directory. Each scene has one data file holding the
+images of all frames, every image is split into chunks of rows which are
+stored uncompressed or zlib compressed. The append-only index.jsonl holds one
+line per frame with its metadata and the location of all chunks, it is only
+written after all scenes of a frame are stored. Readers therefore never see
+incomplete frames and can read while frames are appended.
+
+Uncompressed images are memory-mapped, compressed images are read chunk by
+chunk, so rows of a frame are read without reading the complete image.
+Readers open files per read and can be used from several threads or
+processes.
+"""
+
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from . import utilities as utils
+
+
+class RunStoreError(RuntimeError):
+    """This is a generic error for the run store."""
+    pass
+
+
+class RunStore:
+    """Chunked per-scene arrays of all frames of a run with a frame index."""
+
+    INDEX_FILE = "index.jsonl"
+    DATA_EXTENSION = ".dat"
+    COMPRESSIONS = (None, "zlib")
+
+    def __init__(self, store_dir, compression="zlib", level=1, chunk_rows=64):
+        """
+        :type store_dir: Path or str
+        :param store_dir: Directory of the store, created on first append.
+        :type compression: str
+        :param compression: "zlib" or None for uncompressed chunks, only used
+                            for appended frames.
+        :type level: int
+        :param level: zlib compression level.
+        :type chunk_rows: int
+        :param chunk_rows: Number of image rows per chunk.
+        """
+        if compression not in self.COMPRESSIONS:
+            raise RunStoreError(f"Unknown compression {compression}.")
+        if chunk_rows < 1:
+            raise RunStoreError("Chunks require at least one row.")
+
+        self.store_dir = Path(store_dir)
+        self.compression = compression
+        self.level = int(level)
+        self.chunk_rows = int(chunk_rows)
+
+        self._frames = {}
+        self._index_pos = 0
+        self._pending = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """Open files and pending frames are not sent to other processes."""
+        state = self.__dict__.copy()
+        state["_pending"] = {}
+        state["_files"] = {}
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __contains__(self, frame_id):
+        return self._get_entry(frame_id, required=False) is not None
+
+    def __len__(self):
+        self.refresh()
+        return len(self._frames)
+
+    @property
+    def frame_ids(self):
+        """Ids of all complete frames in the order they were appended."""
+        self.refresh()
+        with self._lock:
+            return list(self._frames)
+
+    @classmethod
+    def exists(cls, store_dir):
+        """Whether a store exists in given directory."""
+        return (Path(store_dir) / cls.INDEX_FILE).is_file()
+
+    @classmethod
+    def merge(cls, store_dir, shards):
+        """
+        Writes the index of a store of several shard stores.
+
+        Shards are stores in sub directories of store_dir, e.g. of render
+        workers. Frames are interleaved, frame k of shard w becomes frame
+        k * len(shards) + w, which is the order of strided partitions. Data
+        files stay in the shard directories.
+
+        :type store_dir: Path or str
+        :param store_dir: Directory of the merged store.
+        :type shards: list
+        :param shards: Names of the shard sub directories.
+        """
+        store_dir = Path(store_dir)
+        readers = [cls(store_dir / shard) for shard in shards]
+        frame_ids = [reader.frame_ids for reader in readers]
+
+        lines = []
+        for k in range(max((len(ids) for ids in frame_ids), default=0)):
+            for shard, reader, ids in zip(shards, readers, frame_ids):
+                if k >= len(ids):
+                    continue
+
+                entry = dict(reader._get_entry(ids[k]))
+                entry["scenes"] = {
+                    name: dict(scene, file=shard + "/" + scene["file"])
+                    for name, scene in entry["scenes"].items()
+                }
+                lines.append(json.dumps(entry) + "\n")
+
+        # Replaced at once, so that readers never see a partial index
+        store_dir.mkdir(parents=True, exist_ok=True)
+        filename = store_dir / cls.INDEX_FILE
+        tmp_filename = store_dir / (cls.INDEX_FILE + ".tmp")
+        with open(str(tmp_filename), "w") as index_file:
+            index_file.writelines(lines)
+        os.replace(str(tmp_filename), str(filename))
+
+    def refresh(self):
+        """Reads index lines of frames appended since the last refresh."""
+        filename = self.store_dir / self.INDEX_FILE
+        if not filename.is_file():
+            return
+
+        with self._lock:
+            with open(str(filename), "rb") as index_file:
+                index_file.seek(self._index_pos)
+                data = index_file.read()
+
+            # A last line without newline is still being written
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    self._frames[entry["id"]] = entry
+            self._index_pos += end
+
+    def append_scene(self, frame_id, scene_name, image, channels=None):
+        """
+        Appends the image of a scene of a frame.
+
+        The frame becomes visible to readers with append_frame.
+
+        :type frame_id: str
+        :param frame_id: Frame id.
+        :type scene_name: str
+        :param scene_name: Scene name, e.g. Stars.
+        :type image: numpy.ndarray
+        :param image: Image (height, width, channels), stored as float32.
+        :type channels: tuple
+        :param channels: Channel names, default is R, G, B, A.
+        """
+        image = np.asarray(image, np.float32)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        (height, width, num_channels) = image.shape
+
+        if channels is None:
+            channels = ("R", "G", "B", "A")[0:num_channels]
+        if len(channels) != num_channels:
+            raise RunStoreError("Number of channel names does not match.")
+
+        chunks = []
+        with self._lock:
+            data_file = self._get_data_file(scene_name)
+            offset = data_file.tell()
+
+            for start in range(0, height, self.chunk_rows):
+                chunk = np.ascontiguousarray(image[start:start + self.chunk_rows])
+                buf = memoryview(chunk).cast("B")
+                if self.compression == "zlib":
+                    buf = zlib.compress(buf, self.level)
+                data_file.write(buf)
+                chunks.append(len(buf))
+
+            data_file.flush()
+
+            self._pending.setdefault(frame_id, {})[scene_name] = {
+                "file": scene_name + self.DATA_EXTENSION,
+                "shape": [height, width, num_channels],
+                "channels": list(channels),
+                "dtype": "float32",
+                "compression": self.compression,
+                "chunk_rows": self.chunk_rows,
+                "offset": offset,
+                "chunks": chunks,
+            }
+
+    def append_frame(self, frame_id, metadata=None):
+        """
+        Completes a frame by appending its index line.
+
+        :type frame_id: str
+        :param frame_id: Frame id, scenes are appended with append_scene.
+        :type metadata: dict
+        :param metadata: Frame metadata, serialised to json.
+        """
+        with self._lock:
+            scenes = self._pending.pop(frame_id, {})
+            entry = {"id": frame_id, "metadata": metadata, "scenes": scenes}
+            line = json.dumps(entry, default=utils.serialise) + "\n"
+
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            filename = self.store_dir / self.INDEX_FILE
+            with open(str(filename), "ab") as index_file:
+                index_file.write(line.encode("utf-8"))
+
+    def close(self):
+        """Closes data files of appended frames."""
+        with self._lock:
+            if self._pending:
+                raise RunStoreError(
+                    f"Frames {list(self._pending)} were not completed."
+                )
+            for data_file in self._files.values():
+                data_file.close()
+            self._files = {}
+
+    def get_metadata(self, frame_id):
+        """Metadata of a frame as stored, i.e. json compatible."""
+        return self._get_entry(frame_id)["metadata"]
+
+    def get_scenes(self, frame_id):
+        """Names of stored scenes of a frame."""
+        return list(self._get_entry(frame_id)["scenes"])
+
+    def get_shape(self, frame_id, scene_name):
+        """Image shape (height, width, channels) of a scene of a frame."""
+        return tuple(self._get_scene_entry(frame_id, scene_name)["shape"])
+
+    def read(self, frame_id, scene_name, channels=None, rows=None, out=None):
+        """
+        Reads the image of a scene of a frame.
+
+        :type channels: tuple
+        :param channels: Channel names to read, default are all channels.
+        :type rows: tuple
+        :param rows: Rows (start, stop) to read, default are all rows.
+        :type out: numpy.ndarray
+        :param out: Optional float32 buffer (rows, width, channels).
+        :returns: float32 image (rows, width, channels). Uncompressed
+                  images are read-only memory maps, if neither channels nor
+                  out are given.
+        """
+        scene = self._get_scene_entry(frame_id, scene_name)
+        (height, width, num_channels) = scene["shape"]
+
+        if rows is None:
+            rows = (0, height)
+        (start, stop) = (max(rows[0], 0), min(rows[1], height))
+        if start >= stop:
+            raise RunStoreError(f"Invalid rows {rows}.")
+
+        if channels is None:
+            channel_idx = None
+        else:
+            try:
+                channel_idx = [scene["channels"].index(c) for c in channels]
+            except ValueError:
+                raise RunStoreError(
+                    f"Channels {channels} not in {scene['channels']}."
+                )
+
+        filename = self.store_dir / scene["file"]
+        row_bytes = width * num_channels * 4
+
+        if scene["compression"] is None:
+            image = np.memmap(
+                str(filename),
+                np.float32,
+                mode="r",
+                offset=scene["offset"] + start * row_bytes,
+                shape=(stop - start, width, num_channels)
+            )
+        else:
+            image = self._read_chunks(filename, scene, start, stop)
+
+        if channel_idx is not None:
+            image = image[:, :, channel_idx]
+
+        if out is None:
+            return image
+
+        out_view = out[0:stop - start]
+        out_view[...] = image
+        return out_view
+
+    def _read_chunks(self, filename, scene, start, stop):
+        """Decompresses the chunks overlapping rows (start, stop)."""
+        (_, width, num_channels) = scene["shape"]
+        chunk_rows = scene["chunk_rows"]
+        first = start // chunk_rows
+        last = (stop - 1) // chunk_rows
+
+        offsets = np.cumsum([scene["offset"]] + scene["chunks"])
+
+        image = np.empty(
+            ((last - first + 1) * chunk_rows, width, num_channels), np.float32
+        )
+        with open(str(filename), "rb") as data_file:
+            data_file.seek(offsets[first])
+            data = data_file.read(offsets[last + 1] - offsets[first])
+
+        pos = 0
+        row = 0
+        for size in scene["chunks"][first:last + 1]:
+            chunk = zlib.decompress(data[pos:pos + size])
+            chunk = np.frombuffer(chunk, np.float32)
+            chunk = chunk.reshape((-1, width, num_channels))
+            image[row:row + len(chunk)] = chunk
+            pos += size
+            row += len(chunk)
+
+        offset = start - first * chunk_rows
+        return image[offset:offset + stop - start]
+
+    def _get_entry(self, frame_id, required=True):
+        """Index entry of a frame, refreshes the index if it is unknown."""
+        if frame_id not in self._frames:
+            self.refresh()
+
+        entry = self._frames.get(frame_id)
+        if entry is None and required:
+            raise RunStoreError(f"Frame {frame_id} not in {self.store_dir}.")
+
+        return entry
+
+    def _get_scene_entry(self, frame_id, scene_name):
+        """Index entry of a scene of a frame."""
+        scenes = self._get_entry(frame_id)["scenes"]
+        if scene_name not in scenes:
+            raise RunStoreError(f"No {scene_name} image of frame {frame_id}.")
+
+        return scenes[scene_name]
+
+    def _get_data_file(self, scene_name):
+        """Data file of a scene opened for appending."""
+        if scene_name not in self._files:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            filename = self.store_dir / (scene_name + self.DATA_EXTENSION)
+            self._files[scene_name] = open(str(filename), "ab")
+
+        return self._files[scene_name]
+
+
+if __name__ == "__main__":
+    pass
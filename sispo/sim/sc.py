@@ -1,10 +1,10 @@
 """Defining behaviour of the spacecraft (sc)."""
 
+import math
 from pathlib import Path
 
 from astropy import units as u
 import numpy as np
-import cv2
 
 import orekit
 from org.orekit.orbits import KeplerianOrbit # pylint: disable=import-error
@@ -15,7 +15,9 @@
 from org.orekit.utils import PVCoordinates # pylint: disable=import-error
 from org.hipparchus.geometry.euclidean.threed import Vector3D  # pylint: disable=import-error
 
+from . import noise, psf, smear
 from .cb import CelestialBody
+from .compositor import FLUX0_VBAND, SUN_MAG_VBAND
 
 
 class Spacecraft(CelestialBody):
@@ -91,6 +93,56 @@ def calc_encounter_pos(sssb_pos,
         return sc_pos
         
 
+class Band():
+    """Spectral band of a multi-band instrument."""
+
+    def __init__(
+        self,
+        instrument,
+        name,
+        wavelength,
+        quantum_eff,
+        flux0=None,
+        sun_mag=None,
+        psf=None
+    ):
+        """
+        :type instrument: Instrument
+        :param instrument: Instrument the band belongs to.
+        :type name: str
+        :param name: Band name, used for output file names.
+        :type wavelength: float
+        :param wavelength: Central wavelength in nm.
+        :type quantum_eff: float
+        :param quantum_eff: Quantum efficiency in the band.
+        :type flux0: float
+        :param flux0: Photon flux of a magnitude 0 star in ph / (s m^2),
+                      default is the V band zero point.
+        :type sun_mag: float
+        :param sun_mag: Apparent magnitude of the sun at 1 AU in the band,
+                        default is the V band magnitude.
+        :type psf: dict
+        :param psf: PSF settings, see Instrument.create_psf.
+        """
+        self.name = str(name)
+        self.wavelength = wavelength * u.nm
+        self.quantum_eff = quantum_eff
+
+        if flux0 is None:
+            self.flux0 = FLUX0_VBAND
+        else:
+            self.flux0 = flux0 * u.ph / (u.s * u.m ** 2)
+
+        if sun_mag is None:
+            self.sun_mag = SUN_MAG_VBAND
+        else:
+            self.sun_mag = sun_mag * u.mag
+
+        if psf is None:
+            psf = {}
+        self.psf = instrument.create_psf(wavelength=self.wavelength, **psf)
+
+
 class Instrument():
     """Summarizes characteristics of an instrument."""
 
@@ -151,12 +203,56 @@ def __init__(self, charas=None):
         else:
             self.color_depth = 12
 
+        # Photometry of the compositor corresponds to 1 s exposures
+        if "exposure_time" in charas:
+            self.exposure_time = charas["exposure_time"] * u.s
+        else:
+            self.exposure_time = 1 * u.s
+
         self.aperture_a = ((2 * u.cm) ** 2 - (1.28 * u.cm) ** 2) * np.pi/4
         self.dlmult = 2
 
-    def sense(self, flux_img):
-        # Calculate Gaussian standard deviation for approx diffraction pattern
-        sigma = (self.dlmult * 0.45 * self.wavelength
+        (self.psf_sigma, self.psf_ksize) = self.calc_psf()
+
+        if "psf" in charas:
+            self.psf = self.create_psf(**charas["psf"])
+        else:
+            self.psf = self.create_psf()
+
+        # Rolling shutter readout of all rows, 0 is a global shutter
+        if "readout_time" in charas:
+            self.readout_time = charas["readout_time"] * u.s
+        else:
+            self.readout_time = 0 * u.s
+
+        self.smear = smear.MotionSmear(
+            self.exposure_time.to_value(u.s),
+            (self.focal_l / self.pix_l).decompose().value,
+            self.readout_time.to_value(u.s)
+        )
+
+        noise_settings = dict(charas.get("noise", {}))
+        noise_settings.setdefault("exposure_time", self.exposure_time.value)
+        self.noise = noise.NoiseModel(**noise_settings)
+
+        # Optional spectral bands, replace wavelength and quantum_eff
+        if "bands" in charas:
+            self.bands = [Band(self, **band) for band in charas["bands"]]
+        else:
+            self.bands = None
+
+    def calc_psf(self, wavelength=None):
+        """
+        Calculates Gaussian approximation of the diffraction pattern.
+
+        :type wavelength: astropy.units.Quantity
+        :param wavelength: Wavelength, default is wavelength of instrument.
+        :returns: Standard deviation in pixels and kernel size.
+        """
+        if wavelength is None:
+            wavelength = self.wavelength
+
+        sigma = (self.dlmult * 0.45 * wavelength
                 * self.focal_l / (self.aperture_d
                 * self.pix_l)).decompose()
         sigma = float(sigma.value)
@@ -168,8 +264,117 @@ def sense(self, flux_img):
         kernel = max(kernel, 5) # Don't use smaller than 5
         ksize = (kernel, kernel)
 
-        img = self.quantum_eff * flux_img
-        img = cv2.GaussianBlur(img, ksize, sigma)
-        img += np.random.poisson(img)
+        return (sigma, ksize)
+
+    def create_psf(self, type="gaussian", file=None, engine="auto",
+                   wavelength=None):
+        """
+        Creates the PSF applied when sensing images.
+
+        :type type: str
+        :param type: "gaussian" approximation of the diffraction pattern,
+                     "airy" disk of the circular aperture or kernel "file".
+        :type file: Path
+        :param file: Kernel file, see psf.file_psf.
+        :type engine: str
+        :param engine: Convolution engine, see psf.PSF.
+        :type wavelength: astropy.units.Quantity
+        :param wavelength: Wavelength, default is wavelength of instrument.
+        """
+        if wavelength is None:
+            wavelength = self.wavelength
+
+        if type == "gaussian":
+            (sigma, ksize) = self.calc_psf(wavelength)
+            return psf.gaussian_psf(sigma, ksize[0], engine)
+        elif type == "airy":
+            zero_radius = (1.22 * wavelength * self.focal_l
+                           / (self.aperture_d * self.pix_l)).decompose()
+            return psf.airy_psf(float(zero_radius.value), engine=engine)
+        elif type == "file":
+            return psf.file_psf(file, engine)
+
+        raise psf.PSFError(f"Unknown PSF type {type}.")
+
+    def calc_limiting_mag(self, snr=0.1, starmap_sigma=0.5):
+        """
+        Calculates the faintest star magnitude contributing to an image.
+
+        A star is considered if the signal of its brightest pixel reaches snr
+        times the chip noise. The default snr keeps stars well below the
+        noise floor, so dropping fainter stars does not change images.
+
+        :type snr: float
+        :param snr: Ratio of peak pixel signal to chip noise.
+        :type starmap_sigma: float
+        :param starmap_sigma: Gaussian standard deviation in pixels with which
+                              stars are rendered in the starmap.
+        """
+        sigma = math.sqrt(self.psf_sigma ** 2 + starmap_sigma ** 2)
+
+        # Fraction of flux in the central pixel of a Gaussian spot
+        peak_frac = math.erf(1. / (2 * math.sqrt(2) * sigma)) ** 2
+
+        signal_mag0 = (FLUX0_VBAND * self.aperture_a * self.exposure_time
+                       * self.quantum_eff * peak_frac).decompose()
+        signal_mag0 = float(signal_mag0.value)
+
+        return 2.5 * math.log10(signal_mag0 / (snr * self.chip_noise))
+
+    def sense_bands(self, bases, weights, out=None, frame_id=None):
+        """
+        Converts linear combinations of flux images into sensed band images.
+
+        PSF convolution is batched over bands, see psf.convolve_bands,
+        noise is generated for all bands in one pass.
+
+        :type bases: list
+        :param bases: 2D float32 flux base images.
+        :type weights: numpy.ndarray
+        :param weights: Weight of each base image per band (bands, bases).
+        :type out: numpy.ndarray
+        :param out: Optional float32 array (height, width, bands).
+        :type frame_id: str
+        :param frame_id: Frame id from which the noise seed is derived.
+        """
+        qe = np.asarray([band.quantum_eff for band in self.bands])
+        weights = np.asarray(weights) * qe[:, None]
+
+        psfs = [band.psf for band in self.bands]
+        img = psf.convolve_bands(psfs, bases, weights, out=out)
+        self.noise.apply(img, frame_id, out=img)
 
         return img
+
+    def sense(self, flux_img, out=None, frame_id=None, valid=None,
+              row_offset=0):
+        """
+        Converts a flux image into a sensed image.
+
+        Tiles of an image are sensed with halo margins of at least
+        calc_halo() rows, noise is only added to the valid rows.
+
+        :type flux_img: numpy.ndarray
+        :param flux_img: Flux image, float32.
+        :type out: numpy.ndarray
+        :param out: Optional array for the result, may be flux_img itself.
+        :type frame_id: str
+        :param frame_id: Frame id from which the noise seed is derived.
+        :type valid: slice
+        :param valid: Rows of a tile without halo margins, default all rows.
+        :type row_offset: int
+        :param row_offset: Image row of the first valid row.
+        """
+        img = np.multiply(flux_img, self.quantum_eff, out=out)
+        self.psf.apply(img, out=img)
+
+        if valid is None:
+            valid = slice(0, img.shape[0])
+        noisy = img[valid]
+        self.noise.apply(noisy, frame_id, out=noisy, row_offset=row_offset)
+
+        return img
+
+    def calc_halo(self):
+        """Rows of neighbouring pixels required to sense a tile."""
+        return self.psf.shape[0] // 2
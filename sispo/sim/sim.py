@@ -1,6 +1,11 @@
 """Trajectory simulation and object rendering module."""
 
 import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent import futures
 from datetime import datetime
 from pathlib import Path
 
@@ -30,7 +35,7 @@
     RotationConvention
 )  # pylint: disable=import-error
 
-from . import cb, sc, sssb, utilities
+from . import cb, runstore, sc, sssb, utilities
 from .cb import *
 from .sc import *
 from .sssb import *
@@ -70,8 +75,17 @@ def __init__(self,
                  samples,
                  device,
                  tile_size,
+                 threads=None,
                  oneshot=False,
                  spacecraft=None,
+                 with_star_preload=False,
+                 with_star_mag_limit=False,
+                 compositor=None,
+                 exr=None,
+                 run_store=None,
+                 scene_snapshots="journal",
+                 write_raw=True,
+                 roi=None,
                  ext_logger=None,
                  opengl_renderer=False):
 
@@ -123,10 +137,19 @@ def __init__(self,
         self.render_settings["samples"] = samples
         self.render_settings["device"] = device
         self.render_settings["tile"] = tile_size
+        self.render_settings["threads"] = threads
 
         self.sssb_settings = sssb
         self.with_infobox = with_infobox
         self.with_clipping = with_clipping
+        self.with_star_preload = bool(with_star_preload)
+        self.with_star_mag_limit = bool(with_star_mag_limit)
+        self.compositor_settings = compositor
+        self.exr_settings = exr
+        self.run_store_settings = run_store
+        self.scene_snapshots = scene_snapshots
+        self.write_raw = write_raw
+        self.roi_settings = roi
 
         # Setup rendering engine (renderer)
         self.setup_renderer()
@@ -156,6 +179,13 @@ def setup_renderer(self):
             self.renderer.create_scene("SssbOnly")
         else:
             from .render import BlenderController
+
+            if self.with_star_mag_limit:
+                star_mag_limit = self.inst.calc_limiting_mag()
+                self.logger.debug("Limiting star magnitude %f", star_mag_limit)
+            else:
+                star_mag_limit = None
+
             self.renderer = BlenderController(render_dir,
                                               raw_dir,
                                               self.starcat_dir,
@@ -163,6 +193,12 @@ def setup_renderer(self):
                                               self.sssb_settings,
                                               self.with_infobox,
                                               self.with_clipping,
+                                              star_mag_limit=star_mag_limit,
+                                              compositor=self.compositor_settings,
+                                              exr=self.exr_settings,
+                                              run_store=self.run_store_settings,
+                                              scene_snapshots=self.scene_snapshots,
+                                              write_raw=self.write_raw,
                                               ext_logger=self.logger)
 
         self.renderer.create_camera("ScCam")
@@ -198,6 +234,8 @@ def setup_renderer(self):
         self.renderer.set_device(self.render_settings["device"], 
                                  self.render_settings["tile"])
         self.renderer.set_samples(self.render_settings["samples"])
+        if self.render_settings["threads"] and not self.opengl_renderer:
+            self.renderer.set_threads(self.render_settings["threads"])
         self.renderer.set_exposure(self.render_settings["exposure"])
         self.renderer.set_resolution(self.inst.res)
         self.renderer.set_output_format()
@@ -251,6 +289,12 @@ def setup_sssb(self, settings):
         self.sssb.render_obj.rotation_mode = "AXIS_ANGLE"
         self.sssb.render_obj.location = (0.0, 0.0, 0.0)
 
+        # Render only the region of the SSSB in each frame
+        roi = self.roi_settings
+        if roi is not None and roi.get("enabled", False) and not self.opengl_renderer:
+            self.renderer.enable_roi(self.sssb.render_obj,
+                                     roi.get("margin", 8))
+
         # Setup previously generated coma
         coma = settings.get('coma', None)
         if coma:
@@ -335,8 +379,13 @@ def setup_lightref(self, settings):
                                                   scenes="LightRef")
         self.lightref.location = (0.0, 0.0, 0.0)
 
-    def simulate(self):
-        """Do simulation."""
+    def simulate(self, save_results=True):
+        """
+        Do simulation.
+
+        :type save_results: bool
+        :param save_results: Whether propagation results are saved to file.
+        """
         self.logger.debug("Starting simulation")
 
         self.logger.debug("Propagating SSSB")
@@ -354,22 +403,38 @@ def simulate(self):
                                   self.slowmotion_factor)
 
         self.logger.debug("Simulation completed")
-        self.save_results()
+        if save_results:
+            self.save_results()
 
-    def render(self):
-        """Render simulation scenario."""
+    def render(self, frames=None):
+        """
+        Render simulation scenario.
+
+        :type frames: list
+        :param frames: Indices of frames to render, default are all frames.
+        """
         self.logger.debug("Rendering simulation")
-        scaling = 1. if self.opengl_renderer else 1000.
         N = len(self.spacecraft.date_history)
+        if frames is not None:
+            frames = set(frames)
+            N = len(frames)
+        rendered = 0
+
+        if self.with_star_preload and not self.opengl_renderer:
+            self.preload_stars(frames)
 
         # Render frame by frame
         print("Rendering in progress...")
-        for i, (date, sc_pos, sc_rot, sssb_pos, sssb_rot) in enumerate(zip(
+        for i, (date, sc_pos, sc_rot, sssb_pos, sssb_rot, sc_vel, sssb_vel) in enumerate(zip(
                                                                    self.spacecraft.date_history,
                                                                    self.spacecraft.pos_history,
                                                                    self.spacecraft.rot_history,
                                                                    self.sssb.pos_history,
-                                                                   self.sssb.rot_history)):
+                                                                   self.sssb.rot_history,
+                                                                   self.spacecraft.vel_history,
+                                                                   self.sssb.vel_history)):
+            if frames is not None and i not in frames:
+                continue
 
             date_str = datetime.strptime(date.toString(), "%Y-%m-%dT%H:%M:%S.%f")
             date_str = date_str.strftime("%Y-%m-%dT%H%M%S-%f")
@@ -381,45 +446,91 @@ def render(self):
             metainfo["distance"] = sc_pos.distance(sssb_pos)
             metainfo["date"] = date_str
 
-            # Set Rotation
-            angle, axis = convert_rot_to_angle_axis(sssb_rot, RotationConvention.FRAME_TRANSFORM)
-            self.renderer.set_object_rot(angle, axis , self.sssb.render_obj)
+            # Velocities and camera basis are used to simulate motion smear
+            metainfo["sssb_vel"] = np.asarray(sssb_vel.toArray())
+            metainfo["sc_vel"] = np.asarray(sc_vel.toArray())
+            metainfo["cam_tracking"] = self.spacecraft.auto_targeting
 
-            # Update environment
-            # Removed unnecessary conditional, opengl can omit the scaling
-            self.renderer.set_sun_location(-np.asarray(sssb_pos.toArray()), 
-                                            scaling, getattr(self,"sun", None))
-
-            # Update sssb and spacecraft
-            pos_sc_rel_sssb = np.asarray(sc_pos.subtract(sssb_pos).toArray()) / scaling
-            self.renderer.set_camera_location("ScCam", pos_sc_rel_sssb)
-            if self.spacecraft.auto_targeting:
-                self.renderer.target_camera(self.sssb.render_obj, "ScCam")
-            else:
-                angle, axis = convert_rot_to_angle_axis(sc_rot, RotationConvention.FRAME_TRANSFORM)
-                self.renderer.set_camera_rot(angle, axis, "ScCam")
+            self.set_frame(sc_pos, sc_rot, sssb_pos, sssb_rot)
 
             if not self.opengl_renderer:
-                # Update scenes/cameras
-                pos_cam_const_dist = pos_sc_rel_sssb * scaling / np.sqrt(
-                                        np.dot(pos_sc_rel_sssb, pos_sc_rel_sssb))
-                self.renderer.set_camera_location("SssbConstDistCam", pos_cam_const_dist)
-                self.renderer.target_camera(self.sssb.render_obj, "SssbConstDistCam")
-
-                lightrefcam_pos = -np.asarray(sssb_pos.toArray()) * scaling \
-                                  / np.sqrt(np.dot(np.asarray(sssb_pos.toArray()), 
-                                    np.asarray(sssb_pos.toArray())))
-                self.renderer.set_camera_location("LightRefCam", lightrefcam_pos)
-                self.renderer.target_camera(self.sun.render_obj, "CalibrationDisk")
-                self.renderer.target_camera(self.lightref, "LightRefCam")
+                cam_dir, cam_up, cam_right = self.renderer.get_camera_basis("ScCam")
+                metainfo["cam_dir"] = cam_dir
+                metainfo["cam_up"] = cam_up
+                metainfo["cam_right"] = cam_right
 
             # Render blender scenes
             self.renderer.render(metainfo)
 
-            print('%d/%d' % (i+1, N))
+            rendered += 1
+            print('%d/%d' % (rendered, N))
+
+        if not self.opengl_renderer:
+            # Compositing runs in background, wait for remaining frames
+            self.renderer.finish()
 
         self.logger.debug("Rendering completed")
 
+    def set_frame(self, sc_pos, sc_rot, sssb_pos, sssb_rot):
+        """Sets objects and cameras of all scenes to the state of a frame."""
+        scaling = 1. if self.opengl_renderer else 1000.
+
+        # Set Rotation
+        angle, axis = convert_rot_to_angle_axis(sssb_rot, RotationConvention.FRAME_TRANSFORM)
+        self.renderer.set_object_rot(angle, axis , self.sssb.render_obj)
+
+        # Update environment
+        # Removed unnecessary conditional, opengl can omit the scaling
+        self.renderer.set_sun_location(-np.asarray(sssb_pos.toArray()), 
+                                        scaling, getattr(self,"sun", None))
+
+        # Update sssb and spacecraft
+        pos_sc_rel_sssb = np.asarray(sc_pos.subtract(sssb_pos).toArray()) / scaling
+        self.renderer.set_camera_location("ScCam", pos_sc_rel_sssb)
+        if self.spacecraft.auto_targeting:
+            self.renderer.target_camera(self.sssb.render_obj, "ScCam")
+        else:
+            angle, axis = convert_rot_to_angle_axis(sc_rot, RotationConvention.FRAME_TRANSFORM)
+            self.renderer.set_camera_rot(angle, axis, "ScCam")
+
+        if not self.opengl_renderer:
+            # Update scenes/cameras
+            pos_cam_const_dist = pos_sc_rel_sssb * scaling / np.sqrt(
+                                    np.dot(pos_sc_rel_sssb, pos_sc_rel_sssb))
+            self.renderer.set_camera_location("SssbConstDistCam", pos_cam_const_dist)
+            self.renderer.target_camera(self.sssb.render_obj, "SssbConstDistCam")
+
+            lightrefcam_pos = -np.asarray(sssb_pos.toArray()) * scaling \
+                              / np.sqrt(np.dot(np.asarray(sssb_pos.toArray()), 
+                                np.asarray(sssb_pos.toArray())))
+            self.renderer.set_camera_location("LightRefCam", lightrefcam_pos)
+            self.renderer.target_camera(self.sun.render_obj, "CalibrationDisk")
+            self.renderer.target_camera(self.lightref, "LightRefCam")
+
+    def preload_stars(self, frames=None):
+        """
+        Queries stars of the whole trajectory once before rendering.
+
+        Cameras are set to each frame of the propagated histories to
+        calculate the FOVs, without rendering.
+
+        :type frames: set
+        :param frames: Indices of rendered frames, default are all frames.
+        """
+        self.logger.debug("Preloading stars of all frames")
+
+        fovs = []
+        for i, (sc_pos, sc_rot, sssb_pos, sssb_rot) in enumerate(zip(self.spacecraft.pos_history,
+                                                                     self.spacecraft.rot_history,
+                                                                     self.sssb.pos_history,
+                                                                     self.sssb.rot_history)):
+            if frames is not None and i not in frames:
+                continue
+            self.set_frame(sc_pos, sc_rot, sssb_pos, sssb_rot)
+            fovs.append(self.renderer.get_starmap_fov())
+
+        self.renderer.preload_stars(fovs)
+
     def save_results(self):
         """Save simulation results to a file."""
         self.logger.debug("Saving propagation results")
@@ -446,6 +557,109 @@ def save_results(self):
         self.logger.debug("Propagation results saved")
 
 
+def render_sharded(settings,
+                   workers,
+                   threads=None,
+                   with_sim=False,
+                   ext_logger=None):
+    """
+    Renders frames in several processes, each with its own renderer.
+
+    Frame indices are partitioned in strides, worker k renders frames k,
+    k + workers, ... so that near and far frames are balanced. Each worker
+    propagates the scenario itself, which is deterministic, and composes its
+    frames. Outputs are written to the same raw and result directories with
+    per frame names. Shards of a run store are merged in frame order.
+
+    :type settings: dict
+    :param settings: Simulation settings, keyword arguments of Environment.
+    :type workers: int
+    :param workers: Number of render processes.
+    :type threads: int
+    :param threads: Cycles threads per worker, default is CPUs per worker.
+    :type with_sim: bool
+    :param with_sim: Whether propagation results are saved, by worker 0.
+    :returns: List of tuples (worker, number of frames, render time in s).
+    """
+    if ext_logger is not None:
+        logger = ext_logger
+    else:
+        logger = utilities.create_logger()
+
+    if threads is None:
+        threads = max((os.cpu_count() or 1) // workers, 1)
+
+    logger.debug("Rendering with %d workers, %d threads each",
+                 workers, threads)
+
+    # Blender and the orekit VM are initialised in fresh processes
+    context = multiprocessing.get_context("spawn")
+    start = time.time()
+    with futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        submitted = [
+            pool.submit(_render_shard, settings, worker, workers, threads,
+                        with_sim)
+            for worker in range(workers)
+        ]
+        results = [future.result() for future in submitted]
+    duration = time.time() - start
+
+    for (worker, frames, worker_time) in results:
+        logger.debug("Worker %d rendered %d frames in %.1f s, %.3f frames/s",
+                     worker, frames, worker_time,
+                     frames / worker_time if worker_time > 0 else 0.)
+    total = sum(result[1] for result in results)
+    logger.debug("Rendered %d frames in %.1f s, %.3f frames/s",
+                 total, duration, total / duration if duration > 0 else 0.)
+
+    run_store = settings.get("run_store")
+    if run_store is not None and run_store.get("enabled", False):
+        store_dir = Path(settings["res_dir"]) / "raw" / "store"
+        shards = [f"shard{worker}" for worker in range(workers)]
+        runstore.RunStore.merge(store_dir, shards)
+        logger.debug("Merged run store shards into %s", store_dir)
+
+    return results
+
+
+def _render_shard(settings, worker, workers, threads, with_sim):
+    """
+    Renders every workers-th frame starting at frame worker.
+
+    Module level function so that it can be used by a process pool. Logs
+    are written to render_worker<worker>.log in the result directory.
+    """
+    res_dir = utilities.check_dir(settings["res_dir"])
+
+    logger = logging.getLogger(f"sispo.render{worker}")
+    logger.setLevel(logging.DEBUG)
+    file_handler = logging.FileHandler(
+        str(res_dir / f"render_worker{worker}.log")
+    )
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(name)s - %(funcName)s - %(message)s"
+    ))
+    logger.addHandler(file_handler)
+
+    settings = dict(settings)
+    run_store = settings.get("run_store")
+    if run_store is not None:
+        settings["run_store"] = dict(run_store, shard=f"shard{worker}")
+
+    env = Environment(**settings, threads=threads, ext_logger=logger)
+    env.simulate(save_results=with_sim and worker == 0)
+
+    frames = list(range(worker, len(env.spacecraft.date_history), workers))
+    logger.debug("Worker %d of %d renders frames %s",
+                 worker, workers, frames)
+
+    start = time.time()
+    env.render(frames)
+
+    return (worker, len(frames), time.time() - start)
+
+
 def convert_rot_to_angle_axis(rot, rot_conv):
     angle = rot.getAngle()
     axis = np.array(rot.getAxis(rot_conv).toArray())
@@ -0,0 +1,251 @@
+"""
+Motion smear and rolling shutter of instruments.
+
+Smear is simulated on the composed flux images of a single render per frame
+instead of rendering sub-frames. Image velocities of stars and the SSSB are
+derived from the propagated velocities and the camera basis stored in the
+frame metadata. Each component is convolved once with a line-spread kernel
+covering its motion during the exposure. Rolling shutters are simulated by
+shifting rows according to their readout time offset.
+"""
+
+import math
+
+import cv2
+import numpy as np
+from astropy import units as u
+
+from . import psf
+
+
+class SmearError(RuntimeError):
+    """This is a generic error for motion smear."""
+    pass
+
+
+class MotionSmear:
+    """Line-spread kernels and row offsets from image velocities."""
+
+    def __init__(
+        self,
+        exposure_time,
+        focal_px,
+        readout_time=0.,
+        min_length=0.5,
+        oversample=8
+    ):
+        """
+        :type exposure_time: float
+        :param exposure_time: Exposure time in seconds.
+        :type focal_px: float
+        :param focal_px: Focal length in pixels, i.e. pixels per radian.
+        :type readout_time: float
+        :param readout_time: Time in seconds between readout of the first
+                             and the last row. 0 is a global shutter.
+        :type min_length: float
+        :param min_length: Smear shorter than this number of pixels is
+                           ignored.
+        :type oversample: int
+        :param oversample: Samples per pixel along the smear line.
+        """
+        if exposure_time < 0 or readout_time < 0:
+            raise SmearError("Exposure and readout time must not be negative.")
+        if focal_px <= 0:
+            raise SmearError("Focal length must be positive.")
+
+        self.exposure_time = float(exposure_time)
+        self.focal_px = float(focal_px)
+        self.readout_time = float(readout_time)
+        self.min_length = float(min_length)
+        self.oversample = int(oversample)
+
+    def calc_image_velocities(self, metadata):
+        """
+        Calculates image velocities of stars and SSSB in pixel per second.
+
+        The line of sight rate is the relative velocity perpendicular to the
+        line of sight divided by the distance. A camera tracking the SSSB
+        rotates with this rate, otherwise its attitude is assumed inertial
+        during the exposure. Stars are at infinity and only move with the
+        camera rotation.
+
+        :type metadata: dict
+        :param metadata: Frame metadata with sc_pos, sssb_pos, sc_vel,
+                         sssb_vel, cam_right, cam_up and cam_tracking.
+        :returns: Tuple of (x, y) velocities of stars and SSSB, x to the
+                  right and y down in image coordinates. None if metadata
+                  lacks velocities or camera basis.
+        """
+        keys = ("sc_vel", "sssb_vel", "cam_right", "cam_up")
+        if any(metadata.get(key) is None for key in keys):
+            return None
+
+        rel_pos = (metadata["sssb_pos"] - metadata["sc_pos"]).to_value(u.m)
+        rel_vel = (metadata["sssb_vel"] - metadata["sc_vel"]).to_value(u.m / u.s)
+
+        distance = np.linalg.norm(rel_pos)
+        los = rel_pos / distance
+        los_rate = (rel_vel - np.dot(rel_vel, los) * los) / distance
+
+        if metadata.get("cam_tracking", False):
+            cam_rate = los_rate
+        else:
+            cam_rate = np.zeros(3)
+
+        right = np.asarray(metadata["cam_right"], np.float64)
+        up = np.asarray(metadata["cam_up"], np.float64)
+
+        def project(rate):
+            return np.array((np.dot(rate, right), -np.dot(rate, up)))
+
+        stars_vel = -project(cam_rate) * self.focal_px
+        sssb_vel = project(los_rate - cam_rate) * self.focal_px
+
+        return (stars_vel, sssb_vel)
+
+    def is_static(self, velocity):
+        """Whether motion during exposure and readout is negligible."""
+        if velocity is None:
+            return True
+
+        time = max(self.exposure_time, self.readout_time)
+        return np.hypot(*velocity) * time < self.min_length
+
+    def line_kernel(self, velocity):
+        """
+        Creates the line-spread kernel of a motion during the exposure.
+
+        The line is centred, sampled with oversample points per pixel and
+        distributed bilinearly, so that subpixel lengths are preserved.
+
+        :type velocity: numpy.ndarray
+        :param velocity: Image velocity (x, y) in pixel per second.
+        :returns: Normalised float32 kernel or None for negligible motion.
+        """
+        (d_x, d_y) = np.asarray(velocity, np.float64) * self.exposure_time
+        length = math.hypot(d_x, d_y)
+        if length < self.min_length:
+            return None
+
+        half_w = int(math.ceil(abs(d_x) / 2)) + 1
+        half_h = int(math.ceil(abs(d_y) / 2)) + 1
+        kernel = np.zeros((2 * half_h + 1, 2 * half_w + 1), np.float64)
+
+        samples = int(math.ceil(length * self.oversample)) + 1
+        steps = np.linspace(-0.5, 0.5, samples)
+        x = half_w + steps * d_x
+        y = half_h + steps * d_y
+
+        x_0 = np.floor(x).astype(int)
+        y_0 = np.floor(y).astype(int)
+        f_x = x - x_0
+        f_y = y - y_0
+        np.add.at(kernel, (y_0, x_0), (1 - f_x) * (1 - f_y))
+        np.add.at(kernel, (y_0, x_0 + 1), f_x * (1 - f_y))
+        np.add.at(kernel, (y_0 + 1, x_0), (1 - f_x) * f_y)
+        np.add.at(kernel, (y_0 + 1, x_0 + 1), f_x * f_y)
+
+        kernel /= np.sum(kernel)
+
+        return kernel.astype(np.float32)
+
+    def calc_halo(self, velocity):
+        """Rows of neighbouring pixels required to smear a tile."""
+        if self.is_static(velocity):
+            return 0
+
+        kernel = self.line_kernel(velocity)
+        halo = 0 if kernel is None else kernel.shape[0] // 2
+        shift = abs(velocity[1]) * self.readout_time / 2
+
+        return halo + int(math.ceil(shift)) + 1
+
+    def apply(self, img, velocity, out=None, rows=None):
+        """
+        Smears an image moving with given velocity.
+
+        The line-spread kernel is applied in a single convolution, rows are
+        shifted afterwards if the instrument has a rolling shutter.
+
+        :type img: numpy.ndarray
+        :param img: float32 image (height, width[, channels]).
+        :type velocity: numpy.ndarray
+        :param velocity: Image velocity (x, y) in pixel per second.
+        :type out: numpy.ndarray
+        :param out: Optional output array, may be img itself.
+        :type rows: tuple
+        :param rows: (first row, image height) if img is a tile of an image.
+        :returns: Smeared image.
+        """
+        if out is None:
+            out = np.empty_like(img)
+
+        if self.is_static(velocity):
+            if out is not img:
+                out[...] = img
+            return out
+
+        kernel = self.line_kernel(velocity)
+        if kernel is not None:
+            psf.PSF(kernel).apply(img, out=out)
+        elif out is not img:
+            out[...] = img
+
+        if self.readout_time > 0:
+            self.shift_rows(out, velocity, out=out, rows=rows)
+
+        return out
+
+    def shift_rows(self, img, velocity, out=None, rows=None):
+        """
+        Shifts rows by the motion until their readout.
+
+        Rows are read out linearly over readout_time, the centre row is not
+        shifted. Rows are resampled bilinearly, uncovered pixels are zero.
+
+        :type img: numpy.ndarray
+        :param img: float32 image (height, width[, channels]).
+        :type velocity: numpy.ndarray
+        :param velocity: Image velocity (x, y) in pixel per second.
+        :type out: numpy.ndarray
+        :param out: Optional output array, may be img itself.
+        :type rows: tuple
+        :param rows: (first row, image height) if img is a tile of an image.
+        :returns: Image with shifted rows.
+        """
+        (height, width) = img.shape[0:2]
+        (v_x, v_y) = velocity
+
+        if rows is None:
+            rows = (0, height)
+        (first, img_height) = rows
+
+        # Readout time offset of each row relative to the centre row
+        offsets = np.arange(first, first + height, dtype=np.float32)
+        offsets *= np.float32(1 / max(img_height - 1, 1))
+        offsets -= np.float32(0.5)
+        offsets *= np.float32(self.readout_time)
+
+        cols = np.arange(width, dtype=np.float32)
+        rows = np.arange(height, dtype=np.float32)
+        map_x = cols[None, :] - (v_x * offsets)[:, None]
+        map_y = np.repeat((rows - v_y * offsets)[:, None], width, axis=1)
+
+        shifted = cv2.remap(
+            img,
+            map_x.astype(np.float32),
+            map_y.astype(np.float32),
+            cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0
+        )
+
+        if out is None:
+            return shifted
+
+        out[...] = shifted.reshape(out.shape)
+        return out
+
+
+if __name__ == "__main__":
+    pass
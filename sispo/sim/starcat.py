@@ -3,10 +3,66 @@
 render and write images.
 """
 
-import subprocess
-import sys
+import argparse
+import bisect
+import functools
+import json
+import sqlite3
+from collections import OrderedDict
 from pathlib import Path
 
+import cv2
+import numpy as np
+
+
+# UCAC4 binary record of the zone files, 78 bytes little endian.
+# Reference: UCAC4 readme, section 2e
+# https://cdsarc.u-strasbg.fr/ftp/I/322A/UCAC4/ucac4.txt
+UCAC4_DTYPE = np.dtype([
+    ("ra", "<i4"),          # RA at epoch 2000 [mas]
+    ("spd", "<i4"),         # South pole distance [mas]
+    ("magm", "<i2"),        # UCAC fit model magnitude [mmag]
+    ("maga", "<i2"),        # UCAC aperture magnitude [mmag]
+    ("sigmag", "u1"),
+    ("objt", "u1"),
+    ("cdf", "u1"),
+    ("sigra", "u1"),
+    ("sigdc", "u1"),
+    ("na1", "u1"),
+    ("nu1", "u1"),
+    ("cu1", "u1"),
+    ("cepra", "<i2"),
+    ("cepdc", "<i2"),
+    ("pmrac", "<i2"),
+    ("pmdc", "<i2"),
+    ("sigpmr", "u1"),
+    ("sigpmd", "u1"),
+    ("pts_key", "<u4"),
+    ("j_m", "<i2"),
+    ("h_m", "<i2"),
+    ("k_m", "<i2"),
+    ("icqflg", "u1", (3,)),
+    ("e2mpho", "u1", (3,)),
+    ("apasm", "<i2", (5,)),
+    ("apase", "u1", (5,)),
+    ("gcflg", "i1"),
+    ("mcf", "<i4"),
+    ("leda", "u1"),
+    ("x2cat", "u1"),
+    ("rnm", "<i4"),
+    ("zn2", "<u2"),
+    ("rn2", "<u4"),
+])
+UCAC4_ZONES = 900
+UCAC4_ZONE_HEIGHT = 0.2  # Declination height of a zone [deg]
+UCAC4_NO_MAG = 20000  # Magnitude value of missing magnitudes [mmag]
+MAS_PER_DEG = 3600 * 1000
+
+# Compact catalogue, columns of RA [mas], Dec [mas] and magnitude [mmag]
+COMPACT_META_FILE = "starcat.json"
+COMPACT_INDEX_FILE = "index.npy"
+COMPACT_COLUMNS = {"ra": "<u4", "dec": "<i4", "mag": "<i2"}
+
 
 class StarCatalogError(RuntimeError):
     """Generic error for star catalog module."""
@@ -16,15 +72,20 @@ class StarCatalogError(RuntimeError):
 class StarCatalog:
     """Class to access star catalogs and render stars."""
 
-    def __init__(self, res_dir, ext_logger, starcat_dir=None):
-        """."""
+    def __init__(self, res_dir, ext_logger, starcat_dir=None, mag_limit=None):
+        """
+        :type mag_limit: float
+        :param mag_limit: Faintest magnitude to retrieve. If the star cat dir
+                          contains compact catalogue tiers, the smallest tier
+                          containing all stars up to mag_limit is used.
+        """
 
         self.logger = ext_logger
 
         self.root_dir = Path(__file__).parent.parent.parent
 
         if starcat_dir is None:
-            self.starcat_dir = self.root_dir / "data" / "UCAC4"
+            starcat_dir = self.root_dir / "data" / "UCAC4"
         else:
             starcat_dir = Path(starcat_dir)
 
@@ -34,81 +95,750 @@ def __init__(self, res_dir, ext_logger, starcat_dir=None):
                 raise StarCatalogError(e)
 
             if not starcat_dir.is_dir():
-                starcat_dir = self.models_dir / starcat_dir.name
+                starcat_dir = self.root_dir / "data" / starcat_dir.name
                 starcat_dir = starcat_dir.resolve()
 
-            if not starcat_dir.is_dir():
-                raise StarCatalogError("Given star cat dir does not exist.")
+        if not starcat_dir.is_dir():
+            raise StarCatalogError("Given star cat dir does not exist.")
         self.starcat_dir = starcat_dir
 
         self.res_dir = res_dir
 
-        exe_dir = self.root_dir / "software" / "star_cats"
-
-        if (exe_dir / "u4test").is_file() or (exe_dir / "u4test.exe").is_file():
-            self.exe = exe_dir / "u4test"
-        elif ((exe_dir / "star_cats" / "u4test").is_file() or
-                (exe_dir / "star_cats" / "u4test.exe").is_file()):
-            self.exe = exe_dir / "star_cats" / "u4test"
-        elif ((exe_dir / "build_star_cats" / "u4test").is_file() or
-                (exe_dir / "build_star_cats" / "u4test.exe").is_file()):
-            self.exe = exe_dir / "build_star_cats" / "u4test"
-        else:
-            raise StarCatalogError("UCAC4 interface could not be found.")
+        self.mag_limit = mag_limit
+        self.dropped_flux = 0.0
 
-        # Don't display the Windows GPF dialog if the invoked program dies.
-        # See comp.os.ms-windows.programmer.win32
-        # How to suppress crash notification dialog?, Jan 14,2004 -
-        # Raymond Chen"s response [1]
-        if sys.platform.startswith("win"):
-            self.logger.debug("Windows system, surrpressing GPF dialog.")
-            import ctypes
+        tier_dir = select_catalog_tier(self.starcat_dir, mag_limit)
+        if tier_dir is not None:
+            self.catalog = CompactStarCatalog(tier_dir)
+            self.logger.debug("Using compact star catalog %s", tier_dir)
 
-            SEM_NOGPFAULTERRORBOX = 0x0002  # From MSDN
-            ctypes.windll.kernel32.SetErrorMode(SEM_NOGPFAULTERRORBOX)
+            if self.catalog.mag_limit is not None:
+                self.logger.debug(
+                    "Catalog tier limited to mag %g, %g of %g total flux dropped",
+                    self.catalog.mag_limit, self.catalog.meta["dropped_flux"],
+                    self.catalog.meta["total_flux"])
+        else:
+            self.catalog = UCAC4Reader(self.starcat_dir)
 
-    def get_stardata(self, ra, dec, width, height, filename="ucac4.txt"):
-        """Retrieve star data from given field of view using UCAC4 catalog."""
-        res_file = self.res_dir / filename
-        res_file = res_file.with_suffix(".txt")
+        # Box and stars of a trajectory-wide query, see preload
+        self.preloaded_box = None
+        self.preloaded_stars = None
 
-        command = [
-            str(self.exe),
-            str(ra),
-            str(dec),
-            str(width),
-            str(height),
-            "-h",
-            str(self.starcat_dir),
-            str(res_file)
-        ]
+    def preload(self, fovs, margin=0.1):
+        """
+        Queries the catalogue once for the union of given fields of view.
 
-        for _ in range(5):
-            ret = subprocess.run(command)
+        Afterwards, get_stardata selects stars of boxes inside the union from
+        memory instead of querying the catalogue.
 
-            if ret.returncode > 0:
-                break
+        :type fovs: list
+        :param fovs: Fields of view as (ra, dec, width, height) in degrees.
+        :type margin: float
+        :param margin: Margin added around the union in degrees.
+        """
+        self.preloaded_box = merge_fovs(fovs, margin)
+        self.preloaded_stars = self.catalog.query_box(*self.preloaded_box)
 
-            self.logger.debug("Error code from star cat %d", ret.returncode)
+        self.logger.debug("Preloaded %d stars in box %s",
+                          len(self.preloaded_stars), self.preloaded_box)
 
-        with open(str(res_file), "r") as rfile:
-            complete_data = rfile.readlines()
+    def get_stardata(self, ra, dec, width, height):
+        """
+        Retrieve star data from given field of view using UCAC4 catalog.
 
-        star_data = []
-        for line in complete_data[1:]:
-            line_data = line.split()
+        :returns: Array of stars with rows of (ra, dec, mag), angles in deg.
+        """
+        box = (ra, dec, width, height)
 
-            ra_star = float(line_data[1])
-            dec_star = float(line_data[2])
-            mag_star = float(line_data[3])
+        if (self.preloaded_box is not None
+                and box_contains(self.preloaded_box, box)):
+            star_data = select_box(self.preloaded_stars, *box)
+        else:
+            star_data = self.catalog.query_box(*box)
 
-            star_data.append((ra_star, dec_star, mag_star))
+        if self.mag_limit is not None:
+            faint = star_data[:, 2] > self.mag_limit
+            self.dropped_flux = np.sum(np.power(10., -0.4 * star_data[faint, 2]))
+            star_data = star_data[~faint]
 
         self.logger.debug("Found %d stars in catalog", len(star_data))
 
         return star_data
 
 
+class UCAC4Reader:
+    """
+    Reads the binary UCAC4 zone files directly.
+
+    Zone files are memory-mapped and decoded with a structured dtype. Stars
+    within a zone are sorted by RA, hence only the records inside a queried
+    box are read from disk.
+    """
+
+    def __init__(self, starcat_dir, max_open_zones=32):
+        """
+        :type starcat_dir: Path
+        :param starcat_dir: UCAC4 directory, either containing the zone files
+                            z001 to z900 or the u4b directory with them.
+        :type max_open_zones: int
+        :param max_open_zones: Number of zone files kept memory-mapped.
+        """
+        starcat_dir = Path(starcat_dir)
+
+        if (starcat_dir / "u4b").is_dir():
+            self.zone_dir = starcat_dir / "u4b"
+        else:
+            self.zone_dir = starcat_dir
+
+        if not (self.zone_dir / "z001").is_file():
+            raise StarCatalogError(
+                f"No UCAC4 zone files found in {self.zone_dir}.")
+
+        self.max_open_zones = max_open_zones
+        self._zones = OrderedDict()
+
+    def get_zone(self, zone):
+        """Memory-maps the zone file of given zone number, 1 to 900."""
+        if zone in self._zones:
+            self._zones.move_to_end(zone)
+            return self._zones[zone]
+
+        filename = self.zone_dir / f"z{zone:03d}"
+        if filename.stat().st_size == 0:
+            data = np.zeros(0, dtype=UCAC4_DTYPE)
+        else:
+            data = np.memmap(str(filename), dtype=UCAC4_DTYPE, mode="r")
+
+        self._zones[zone] = data
+        if len(self._zones) > self.max_open_zones:
+            self._zones.popitem(last=False)
+
+        return data
+
+    def query_box(self, ra, dec, width, height):
+        """
+        Retrieves stars inside a RA/Dec box, all values in degrees.
+
+        Boxes crossing RA 0/360 deg are split in two RA ranges.
+
+        :returns: Array of stars with rows of (ra, dec, mag).
+        """
+        dec_min = max(dec - height / 2, -90.)
+        dec_max = min(dec + height / 2, 90.)
+        spd_min = int(round((dec_min + 90.) * MAS_PER_DEG))
+        spd_max = int(round((dec_max + 90.) * MAS_PER_DEG))
+
+        zone_min = int((dec_min + 90.) / UCAC4_ZONE_HEIGHT) + 1
+        zone_max = int((dec_max + 90.) / UCAC4_ZONE_HEIGHT) + 1
+        zone_max = min(zone_max, UCAC4_ZONES)
+
+        ra_ranges = [(int(round(ra_min * MAS_PER_DEG)),
+                      int(round(ra_max * MAS_PER_DEG)))
+                     for ra_min, ra_max in split_ra_range(ra, width)]
+
+        records = []
+        for zone in range(zone_min, zone_max + 1):
+            data = self.get_zone(zone)
+            ra_col = data["ra"]
+
+            for ra_min, ra_max in ra_ranges:
+                start = bisect.bisect_left(ra_col, ra_min)
+                end = bisect.bisect_right(ra_col, ra_max, lo=start)
+                if end <= start:
+                    continue
+
+                rec = data[start:end]
+                spd = rec["spd"]
+                records.append(rec[(spd >= spd_min) & (spd <= spd_max)])
+
+        return decode_records(records)
+
+
+class CompactStarCatalog:
+    """
+    Spatially indexed star catalogue created by build_compact_catalog.
+
+    Stars are stored in columns sorted by sky cells of equal size in
+    declination and RA. An offset index gives the first star of each cell.
+    A query only reads the memory-mapped cells overlapping the queried area,
+    its latency does not depend on the catalogue size.
+    """
+
+    def __init__(self, catalog_dir):
+        """
+        :type catalog_dir: Path
+        :param catalog_dir: Directory created by build_compact_catalog.
+        """
+        catalog_dir = Path(catalog_dir)
+
+        with open(str(catalog_dir / COMPACT_META_FILE), "r") as metafile:
+            self.meta = json.load(metafile)
+
+        self.cell_size = self.meta["cell_size"]
+        self.n_dec = self.meta["n_dec"]
+        self.n_ra = self.meta["n_ra"]
+        self.mag_limit = self.meta["mag_limit"]
+
+        self.index = np.load(str(catalog_dir / COMPACT_INDEX_FILE),
+                             mmap_mode="r")
+
+        self.columns = {}
+        for name, dtype in COMPACT_COLUMNS.items():
+            filename = catalog_dir / (name + ".bin")
+            if self.meta["stars"] > 0:
+                column = np.memmap(str(filename), dtype=dtype, mode="r")
+            else:
+                column = np.zeros(0, dtype=dtype)
+            self.columns[name] = column
+
+    def query_box(self, ra, dec, width, height):
+        """
+        Retrieves stars inside a RA/Dec box, all values in degrees.
+
+        Boxes crossing RA 0/360 deg are split in two RA ranges.
+
+        :returns: Array of stars with rows of (ra, dec, mag).
+        """
+        dec_min = max(dec - height / 2, -90.)
+        dec_max = min(dec + height / 2, 90.)
+        dec_min_mas = int(round(dec_min * MAS_PER_DEG))
+        dec_max_mas = int(round(dec_max * MAS_PER_DEG))
+
+        band_min = self._get_band(dec_min)
+        band_max = self._get_band(dec_max)
+
+        selected = []
+        for ra_min, ra_max in split_ra_range(ra, width):
+            ra_min_mas = int(round(ra_min * MAS_PER_DEG))
+            ra_max_mas = int(round(ra_max * MAS_PER_DEG))
+            bin_min = self._get_ra_bin(ra_min)
+            bin_max = self._get_ra_bin(ra_max)
+
+            for band in range(band_min, band_max + 1):
+                # Cells of a band in an RA range are stored contiguously
+                start = self.index[band * self.n_ra + bin_min]
+                end = self.index[band * self.n_ra + bin_max + 1]
+                if end <= start:
+                    continue
+
+                ra_col = self.columns["ra"][start:end]
+                dec_col = self.columns["dec"][start:end]
+                inside = ((ra_col >= ra_min_mas) & (ra_col <= ra_max_mas)
+                          & (dec_col >= dec_min_mas) & (dec_col <= dec_max_mas))
+                selected.append(np.flatnonzero(inside) + start)
+
+        if selected:
+            selected = np.concatenate(selected)
+        else:
+            selected = np.zeros(0, np.intp)
+
+        stardata = np.empty((len(selected), 3), np.float64)
+        stardata[:, 0] = self.columns["ra"][selected] / MAS_PER_DEG
+        stardata[:, 1] = self.columns["dec"][selected] / MAS_PER_DEG
+        stardata[:, 2] = self.columns["mag"][selected] / 1000.
+
+        return stardata
+
+    def query_cone(self, ra, dec, radius):
+        """
+        Retrieves stars within radius around (ra, dec), all values in degrees.
+
+        :returns: Array of stars with rows of (ra, dec, mag).
+        """
+        if abs(dec) + radius >= 90.:
+            width = 360.
+        else:
+            width = 2 * np.degrees(np.arcsin(
+                np.sin(np.radians(radius)) / np.cos(np.radians(dec))))
+
+        stardata = self.query_box(ra, dec, width, 2 * radius)
+
+        ra_rad = np.radians(stardata[:, 0])
+        dec_rad = np.radians(stardata[:, 1])
+        cos_dist = (np.sin(dec_rad) * np.sin(np.radians(dec))
+                    + np.cos(dec_rad) * np.cos(np.radians(dec))
+                    * np.cos(ra_rad - np.radians(ra)))
+
+        return stardata[cos_dist >= np.cos(np.radians(radius))]
+
+    def _get_band(self, dec):
+        """Declination band index of given declination."""
+        band = int((dec + 90.) / self.cell_size)
+        return min(max(band, 0), self.n_dec - 1)
+
+    def _get_ra_bin(self, ra):
+        """RA bin index within a declination band of given RA."""
+        ra_bin = int(ra / self.cell_size)
+        return min(max(ra_bin, 0), self.n_ra - 1)
+
+
+class SQLiteStarReader:
+    """
+    Reads stars from an SQLite star database.
+
+    Defaults match the deep_space_objects.sqlite database of the OpenGL
+    renderer, angles in degrees.
+    """
+
+    def __init__(self, filename, table="deep_sky_objects",
+                 columns=("ra", "dec", "mag_v")):
+        self.filename = Path(filename)
+        self.table = table
+        self.columns = columns
+
+    def query_box(self, ra, dec, width, height):
+        """
+        Retrieves stars inside a RA/Dec box, all values in degrees.
+
+        :returns: Array of stars with rows of (ra, dec, mag).
+        """
+        dec_min = dec - height / 2
+        dec_max = dec + height / 2
+        ra_where = " OR ".join(
+            [f"({self.columns[0]} >= ? AND {self.columns[0]} <= ?)"]
+            * len(split_ra_range(ra, width)))
+        ra_params = [limit for ra_range in split_ra_range(ra, width)
+                     for limit in ra_range]
+
+        query = (f"SELECT {', '.join(self.columns)} FROM {self.table} "
+                 f"WHERE {self.columns[1]} >= ? AND {self.columns[1]} <= ? "
+                 f"AND {self.columns[2]} IS NOT NULL AND ({ra_where})")
+
+        with sqlite3.connect(str(self.filename)) as conn:
+            rows = conn.execute(query, [dec_min, dec_max] + ra_params)
+            stardata = np.asarray(rows.fetchall(), dtype=np.float64)
+
+        return stardata.reshape(-1, 3)
+
+
+def decode_records(records):
+    """Converts UCAC4 records into an array of (ra, dec, mag) in degrees."""
+    if not records:
+        return np.zeros((0, 3), np.float64)
+
+    records = np.concatenate(records)
+
+    stardata = np.empty((len(records), 3), np.float64)
+    stardata[:, 0] = records["ra"] / MAS_PER_DEG
+    stardata[:, 1] = records["spd"] / MAS_PER_DEG - 90.
+
+    # Use aperture magnitude if model magnitude is missing
+    mag = np.where(records["magm"] == UCAC4_NO_MAG,
+                   records["maga"], records["magm"])
+    stardata[:, 2] = mag / 1000.
+
+    return stardata
+
+
+def split_ra_range(ra, width):
+    """
+    Splits an RA interval into ranges within [0, 360) deg.
+
+    Intervals crossing RA 0/360 deg are returned as two ranges.
+    """
+    if width >= 360:
+        return [(0., 360.)]
+
+    ra_min = (ra - width / 2) % 360
+    ra_max = ra_min + width
+
+    if ra_max > 360:
+        return [(ra_min, 360.), (0., ra_max - 360)]
+
+    return [(ra_min, ra_max)]
+
+
+def select_catalog_tier(starcat_dir, mag_limit=None):
+    """
+    Selects the compact catalogue to use for a limiting magnitude.
+
+    Tiers are compact catalogues in sub directories of starcat_dir, see
+    build_catalog_tiers. The tier with the smallest magnitude limit that
+    still contains all stars up to mag_limit is selected.
+
+    :returns: Directory of the compact catalogue or None if there is none.
+    """
+    starcat_dir = Path(starcat_dir)
+    if (starcat_dir / COMPACT_META_FILE).is_file():
+        return starcat_dir
+
+    tiers = []
+    for meta_file in sorted(starcat_dir.glob("*/" + COMPACT_META_FILE)):
+        with open(str(meta_file), "r") as metafile:
+            tier_limit = json.load(metafile)["mag_limit"]
+
+        if tier_limit is None:
+            tier_limit = np.inf
+        if mag_limit is None and tier_limit < np.inf:
+            continue
+        if mag_limit is not None and tier_limit < mag_limit:
+            continue
+        tiers.append((tier_limit, meta_file.parent))
+
+    if not tiers:
+        return None
+
+    return min(tiers, key=lambda tier: tier[0])[1]
+
+
+def merge_fovs(fovs, margin=0.):
+    """
+    Calculates a box containing all given boxes, all values in degrees.
+
+    The RA extent is the complement of the largest RA gap not covered by any
+    box, hence the union may cross RA 0/360 deg.
+
+    :type fovs: list
+    :param fovs: Boxes as (ra, dec, width, height).
+    :type margin: float
+    :param margin: Margin added on all sides.
+    :returns: Box (ra, dec, width, height).
+    """
+    fovs = np.asarray(fovs, dtype=np.float64).reshape(-1, 4)
+
+    dec_min = max(np.min(fovs[:, 1] - fovs[:, 3] / 2) - margin, -90.)
+    dec_max = min(np.max(fovs[:, 1] + fovs[:, 3] / 2) + margin, 90.)
+
+    starts = (fovs[:, 0] - fovs[:, 2] / 2) % 360
+    ends = starts + fovs[:, 2]
+    order = np.argsort(starts)
+    starts = starts[order]
+    ends = ends[order]
+
+    # Largest gap between merged RA intervals, including the wrap-around gap
+    gap_len = 0.
+    gap_end = 0.
+    cur_end = ends[0]
+    for start, end in zip(starts[1:], ends[1:]):
+        if start - cur_end > gap_len:
+            gap_len = start - cur_end
+            gap_end = start
+        cur_end = max(cur_end, end)
+    if starts[0] + 360 - cur_end > gap_len:
+        gap_len = starts[0] + 360 - cur_end
+        gap_end = starts[0]
+
+    width = min(360. - gap_len + 2 * margin, 360.)
+    ra = (gap_end - margin + width / 2) % 360
+
+    return (float(ra), float((dec_min + dec_max) / 2), float(width),
+            float(dec_max - dec_min))
+
+
+def box_contains(outer, inner):
+    """Checks whether the inner box is within the outer box."""
+    (ra_o, dec_o, width_o, height_o) = outer
+    (ra_i, dec_i, width_i, height_i) = inner
+
+    if (max(dec_i - height_i / 2, -90.) < max(dec_o - height_o / 2, -90.)
+            or min(dec_i + height_i / 2, 90.) > min(dec_o + height_o / 2, 90.)):
+        return False
+
+    ranges_o = split_ra_range(ra_o, width_o)
+    for ra_min, ra_max in split_ra_range(ra_i, width_i):
+        if not any(ra_min >= ra_min_o and ra_max <= ra_max_o
+                   for ra_min_o, ra_max_o in ranges_o):
+            return False
+
+    return True
+
+
+def select_box(stardata, ra, dec, width, height):
+    """Selects stars inside a RA/Dec box, all values in degrees."""
+    stardata = np.asarray(stardata).reshape(-1, 3)
+
+    inside = ((stardata[:, 1] >= dec - height / 2)
+              & (stardata[:, 1] <= dec + height / 2))
+
+    in_ra = np.zeros(len(stardata), dtype=bool)
+    for ra_min, ra_max in split_ra_range(ra, width):
+        in_ra |= (stardata[:, 0] >= ra_min) & (stardata[:, 0] <= ra_max)
+
+    return stardata[inside & in_ra]
+
+
+def build_compact_catalog(source, catalog_dir, cell_size=1.0, mag_limit=None,
+                          logger=None):
+    """
+    Converts a star catalogue into the compact, spatially indexed format.
+
+    The catalogue is processed band by band in declination, so memory usage
+    is limited to the stars of a single band.
+
+    :type source: Path or str
+    :param source: UCAC4 directory or SQLite star database file.
+    :type catalog_dir: Path or str
+    :param catalog_dir: Output directory of the compact catalogue.
+    :type cell_size: float
+    :param cell_size: Size of the sky cells in degrees, has to divide 180.
+    :type mag_limit: float
+    :param mag_limit: Stars fainter than this magnitude are not included.
+    """
+    source = Path(source)
+    catalog_dir = Path(catalog_dir)
+    catalog_dir.mkdir(parents=True, exist_ok=True)
+
+    if source.is_dir():
+        reader = UCAC4Reader(source)
+    else:
+        reader = SQLiteStarReader(source)
+
+    n_dec = int(round(180. / cell_size))
+    n_ra = int(round(360. / cell_size))
+    if not np.isclose(n_dec * cell_size, 180.):
+        raise StarCatalogError("Cell size has to divide 180 deg.")
+
+    counts = np.zeros(n_dec * n_ra, np.int64)
+    total_flux = 0.0
+    dropped_flux = 0.0
+
+    files = {name: open(str(catalog_dir / (name + ".bin")), "wb")
+             for name in COMPACT_COLUMNS}
+    try:
+        for band in range(n_dec):
+            dec_min = band * cell_size - 90.
+            stardata = reader.query_box(180., dec_min + cell_size / 2,
+                                        360., cell_size)
+
+            # Bands are half-open, except the last one including the pole
+            dec = stardata[:, 1]
+            if band < n_dec - 1:
+                stardata = stardata[dec < dec_min + cell_size]
+            stardata = stardata[stardata[:, 1] >= dec_min]
+
+            flux = np.power(10., -0.4 * stardata[:, 2])
+            total_flux += np.sum(flux)
+            if mag_limit is not None:
+                faint = stardata[:, 2] > mag_limit
+                dropped_flux += np.sum(flux[faint])
+                stardata = stardata[~faint]
+
+            ra_mas = np.round(stardata[:, 0] * MAS_PER_DEG) % (360 * MAS_PER_DEG)
+            ra_bin = np.minimum((ra_mas / MAS_PER_DEG / cell_size).astype(int),
+                                n_ra - 1)
+
+            order = np.lexsort((ra_mas, ra_bin))
+            counts[band * n_ra:(band + 1) * n_ra] = np.bincount(
+                ra_bin, minlength=n_ra)
+
+            columns = {
+                "ra": ra_mas[order],
+                "dec": np.round(stardata[order, 1] * MAS_PER_DEG),
+                "mag": np.round(stardata[order, 2] * 1000.),
+            }
+            for name, dtype in COMPACT_COLUMNS.items():
+                files[name].write(columns[name].astype(dtype).tobytes())
+
+            if logger is not None:
+                logger.debug("Dec band %d/%d with %d stars",
+                             band + 1, n_dec, len(stardata))
+    finally:
+        for file in files.values():
+            file.close()
+
+    index = np.zeros(n_dec * n_ra + 1, np.int64)
+    np.cumsum(counts, out=index[1:])
+    np.save(str(catalog_dir / COMPACT_INDEX_FILE), index)
+
+    meta = {
+        "source": str(source),
+        "cell_size": cell_size,
+        "n_dec": n_dec,
+        "n_ra": n_ra,
+        "stars": int(index[-1]),
+        "mag_limit": mag_limit,
+        "total_flux": float(total_flux),
+        "dropped_flux": float(dropped_flux),
+    }
+    with open(str(catalog_dir / COMPACT_META_FILE), "w+") as metafile:
+        json.dump(meta, metafile, indent=4)
+
+    return meta
+
+
+def radec_to_vec(ra, dec):
+    """
+    Converts RA and Dec in degrees into unit vectors of the rendering frame.
+
+    Two candidate vectors are returned, the second one mirrored in y. The
+    candidate closer to the camera direction has to be chosen, see
+    :py:func:`project_stars`.
+
+    :type ra: numpy.ndarray
+    :param ra: Right ascensions in degrees.
+    :type dec: numpy.ndarray
+    :param dec: Declinations in degrees.
+    """
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+
+    vecs = np.empty((len(ra), 3), np.float64)
+    vecs[:, 0] = np.cos(dec) * np.cos(ra - np.pi)
+    vecs[:, 1] = -np.cos(dec) * np.sin(ra - np.pi)
+    vecs[:, 2] = np.sin(dec)
+
+    vecs_mirror = vecs.copy()
+    vecs_mirror[:, 1] *= -1
+
+    return vecs, vecs_mirror
+
+
+def project_stars(stardata, fov_vecs, res, ss=1):
+    """
+    Projects stars onto the image plane of a pinhole camera.
+
+    All stars are processed at once as array operations. Stars outside the
+    field of view are clipped to the image border.
+
+    :type stardata: numpy.ndarray or list
+    :param stardata: Stars as rows of (ra, dec, mag), angles in degrees.
+    :type fov_vecs: tuple
+    :param fov_vecs: Camera direction, right, left, upper and lower edge
+                     vectors as returned by render.get_fov_vecs.
+    :type res: tuple
+    :param res: Image resolution (res_x, res_y).
+    :type ss: int
+    :param ss: Supersampling factor of the target image.
+    :returns: Pixel coordinates x_pix, y_pix and fluxes of the stars.
+    """
+    stardata = np.asarray(stardata, dtype=np.float64).reshape(-1, 3)
+    (res_x, res_y) = res
+
+    (direction, right_edge, _, upper_edge, _) = fov_vecs
+    direction = np.asarray(direction, dtype=np.float64)
+    right_edge = np.asarray(right_edge, dtype=np.float64) - direction
+    upper_edge = np.asarray(upper_edge, dtype=np.float64) - direction
+
+    right_len = np.linalg.norm(right_edge)
+    up_len = np.linalg.norm(upper_edge)
+    right_norm = right_edge / right_len
+    up_norm = upper_edge / up_len
+    f_over_w_ccd_2 = 1.0 / right_len
+    f_over_h_ccd_2 = 1.0 / up_len
+
+    flux = np.power(10., -0.4 * stardata[:, 2])
+
+    # Choose star vector or its mirror, whichever is closer to direction
+    vecs, vecs_mirror = radec_to_vec(stardata[:, 0], stardata[:, 1])
+    mirror = (vecs @ direction) < (vecs_mirror @ direction)
+    vecs[mirror] = vecs_mirror[mirror]
+
+    depth = vecs @ direction
+
+    x_pix = ss * (f_over_w_ccd_2 * (vecs @ right_norm) / depth + 1.0) \
+        * (res_x - 1) / 2.0
+    x_pix = np.clip(np.rint(x_pix), 0, res_x * ss - 1).astype(np.intp)
+
+    y_pix = ss * (-f_over_h_ccd_2 * (vecs @ up_norm) / depth + 1.0) \
+        * (res_y - 1) / 2.0
+    y_pix = np.clip(np.rint(y_pix), 0, res_y * ss - 1).astype(np.intp)
+
+    return x_pix, y_pix, flux
+
+
+@functools.lru_cache()
+def create_splat_kernels(ss=2):
+    """
+    Creates 1D star profiles at final resolution for each sub-pixel phase.
+
+    The profiles equal depositing a star at a pixel of an image supersampled
+    by ss, Gaussian blurring it with replicated borders and downsampling it
+    by area, as the starmap used to be rendered. Rows 0 to ss-1 are the
+    profiles of the sub-pixel phases, row ss is the profile of a star on the
+    first supersampled pixel and row ss+1 of a star on the last one, which
+    receive the flux blurred across the border.
+
+    :returns: Profiles and offset of the first profile pixel to the pixel of
+              the star.
+    """
+    # Kernel size calculated to equal skimage.filters.gaussian
+    # Reference:
+    # https://github.com/scipy/scipy/blob/4bfc152f6ee1ca48c73c06e27f7ef021d729f496/scipy/ndimage/filters.py#L214
+    sig = ss / 2.0
+    kernel = int((4 * sig + 0.5) * 2)
+    radius = kernel // 2
+    gauss = cv2.getGaussianKernel(kernel, sig, cv2.CV_64F).ravel()
+
+    # Replicated border, all flux blurred across the border stays on it
+    border = np.cumsum(gauss)[radius::-1]
+
+    offset = -(-radius // ss)
+    length = 2 * offset + 1
+
+    profiles = np.zeros((ss + 2, length), np.float64)
+    for k in range(length):
+        for m in range(ss):
+            for phase in range(ss):
+                dist = ss * (k - offset) + m - phase
+                if abs(dist) <= radius:
+                    profiles[phase, k] += gauss[dist + radius]
+
+            # First pixel, supersampled pixel index equals dist
+            dist = ss * (k - offset) + m
+            if 0 <= dist <= radius:
+                profiles[ss, k] += border[dist]
+
+            # Last pixel, supersampled pixel index equals -dist from the end
+            dist = ss * (offset - k) + (ss - 1) - m
+            if 0 <= dist <= radius:
+                profiles[ss + 1, k] += border[dist]
+
+    return profiles, offset
+
+
+def _get_star_profiles(pix, size, ss):
+    """Selects profiles and first final resolution pixel of each star."""
+    profiles, offset = create_splat_kernels(ss)
+
+    rows = pix % ss
+    rows[pix == 0] = ss
+    rows[pix == size * ss - 1] = ss + 1
+
+    return profiles[rows], pix // ss - offset
+
+
+def splat_stars(shape, x_pix, y_pix, flux, ss=2, batch_size=65536):
+    """
+    Renders stars by adding a small Gaussian stamp per star.
+
+    Stamps are precomputed for each sub-pixel phase of the supersampled
+    star positions and added directly at final resolution. Memory and time
+    scale with the number of stars instead of the number of pixels.
+
+    :type shape: tuple
+    :param shape: Final image shape (res_y, res_x).
+    :type x_pix: numpy.ndarray
+    :param x_pix: Star x coordinates in supersampled pixels.
+    :type y_pix: numpy.ndarray
+    :param y_pix: Star y coordinates in supersampled pixels.
+    :type flux: numpy.ndarray
+    :param flux: Star fluxes.
+    :type ss: int
+    :param ss: Supersampling factor of the star coordinates.
+    :returns: Single channel image with the star fluxes.
+    """
+    (res_y, res_x) = shape
+    image = np.zeros(shape, np.float32)
+
+    for start in range(0, len(flux), batch_size):
+        batch = slice(start, start + batch_size)
+
+        prof_y, y_start = _get_star_profiles(y_pix[batch], res_y, ss)
+        prof_x, x_start = _get_star_profiles(x_pix[batch], res_x, ss)
+        length = prof_y.shape[1]
+
+        stamps = (flux[batch, None, None] * prof_y[:, :, None]
+                  * prof_x[:, None, :])
+        ys = y_start[:, None, None] + np.arange(length)[None, :, None]
+        xs = x_start[:, None, None] + np.arange(length)[None, None, :]
+        ys, xs = np.broadcast_arrays(ys, xs)
+
+        inside = (ys >= 0) & (ys < res_y) & (xs >= 0) & (xs < res_x)
+        np.add.at(image, (ys[inside], xs[inside]), stamps[inside])
+
+    return image
+
+
 # class StarCache:
 #    """Handling stars in field of view, for rendering of scene."""
 #
@@ -172,3 +902,73 @@ def get_stardata(self, ra, dec, width, height, filename="ucac4.txt"):
 #
 #        return total_flux
 #
+
+
+def build_catalog_tiers(source, starcat_dir, mag_limits, cell_size=1.0,
+                        logger=None):
+    """
+    Builds compact catalogue tiers limited to given magnitudes.
+
+    Each tier is written to a sub directory mag_<limit> of starcat_dir, a
+    limit of None creates the complete catalogue in sub directory all.
+
+    :returns: List of the catalogue meta data of all tiers.
+    """
+    starcat_dir = Path(starcat_dir)
+
+    metas = []
+    for mag_limit in mag_limits:
+        if mag_limit is None:
+            tier_dir = starcat_dir / "all"
+        else:
+            tier_dir = starcat_dir / f"mag_{mag_limit:g}"
+
+        meta = build_compact_catalog(source, tier_dir, cell_size, mag_limit,
+                                     logger)
+        metas.append(meta)
+
+    return metas
+
+
+def main():
+    """Builds a compact star catalogue from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Builds a compact, spatially indexed star catalogue.")
+    parser.add_argument("source",
+                        type=str,
+                        help="UCAC4 directory or SQLite star database")
+    parser.add_argument("catalog_dir",
+                        type=str,
+                        help="Output directory of the compact catalogue")
+    parser.add_argument("--cell-size",
+                        default=1.0,
+                        type=float,
+                        dest="cell_size",
+                        help="Size of sky cells in degrees")
+    parser.add_argument("--mag-limit",
+                        default=None,
+                        type=float,
+                        dest="mag_limit",
+                        help="Faintest magnitude included")
+    parser.add_argument("--tiers",
+                        default=None,
+                        type=float,
+                        nargs="+",
+                        help="Magnitude limits of catalogue tiers to build")
+    args = parser.parse_args()
+
+    if args.tiers is not None:
+        metas = build_catalog_tiers(args.source, args.catalog_dir,
+                                    args.tiers + [None], args.cell_size)
+    else:
+        metas = [build_compact_catalog(args.source, args.catalog_dir,
+                                       args.cell_size, args.mag_limit)]
+
+    for meta in metas:
+        print(f"Compact catalogue with {meta['stars']} stars created, "
+              f"{meta['dropped_flux']:g} of {meta['total_flux']:g} "
+              "total flux dropped.")
+
+
+if __name__ == "__main__":
+    main()
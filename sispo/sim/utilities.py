@@ -98,8 +98,41 @@ def serialise(o):
             return str(o)
 
 
-def read_openexr_image(filename):
-    """Read image in OpenEXR file format into numpy array."""
+def read_openexr_image(
+    filename,
+    channels=None,
+    y_range=None,
+    x_range=None,
+    out=None,
+    planar=False
+):
+    """
+    Read image in OpenEXR file format into numpy array.
+
+    Channels are decoded into buffers of the OpenEXR library, which are
+    wrapped with np.frombuffer and copied once into the output array.
+
+    :type filename: Path or str
+    :param filename: OpenEXR file name.
+    :type channels: tuple
+    :param channels: Channel names to read in given order, e.g. ("R", "A").
+                     If None, RGB or RGBA channels are read.
+    :type y_range: tuple
+    :param y_range: Optional range (start, stop) of rows to read, relative
+                    to the first row of the image. Only the scan lines of
+                    the range are decoded.
+    :type x_range: tuple
+    :param x_range: Optional range (start, stop) of columns to read,
+                    relative to the first column of the image.
+    :type out: numpy.ndarray
+    :param out: Optional float32 array the image is read into, e.g. a
+                preallocated buffer.
+    :type planar: bool
+    :param planar: If True, the image is read as (channels, rows, columns),
+                   so that each channel is copied contiguously.
+    :returns: float32 array (rows, columns, channels) or None if the file or
+              a channel is invalid.
+    """
     filename = check_file_ext(filename, ".exr")
 
     if not OpenEXR.isOpenExrFile(str(filename)):
@@ -107,69 +140,269 @@ def read_openexr_image(filename):
 
     image = OpenEXR.InputFile(str(filename))
 
-    if not image.isComplete():
-        return None
+    try:
+        if not image.isComplete():
+            return None
+
+        header = image.header()
+
+        size = header["dataWindow"]
+        resolution = (size.max.x - size.min.x + 1, size.max.y - size.min.y + 1)
+
+        ch_info = header["channels"]
+        if channels is None:
+            if "R" in ch_info and "G" in ch_info and "B" in ch_info:
+                if "A" in ch_info:
+                    channels = ("R", "G", "B", "A")
+                else:
+                    channels = ("R", "G", "B")
+            else:
+                return None
+        elif not all(ch in ch_info for ch in channels):
+            return None
+
+        if y_range is None:
+            y_range = (0, resolution[1])
+        if x_range is None:
+            x_range = (0, resolution[0])
+        y_0 = max(y_range[0], 0)
+        y_1 = min(y_range[1], resolution[1])
+        x_0 = max(x_range[0], 0)
+        x_1 = min(x_range[1], resolution[0])
+        rows = max(y_1 - y_0, 0)
+        cols = max(x_1 - x_0, 0)
+
+        if planar:
+            shape = (len(channels), rows, cols)
+        else:
+            shape = (rows, cols, len(channels))
 
-    header = image.header()
+        if out is None:
+            out = np.empty(shape, np.float32)
+        elif out.shape != shape or out.dtype != np.float32:
+            raise RuntimeError(f"Output array must be float32 of {shape}.")
 
-    size = header["displayWindow"]
-    resolution = (size.max.x - size.min.x + 1, size.max.y - size.min.y + 1)
+        if rows <= 0 or cols <= 0:
+            return out
 
-    ch_info = header["channels"]
-    if "R" in ch_info and "G" in ch_info and "B" in ch_info:
-        if "A" in ch_info:
-            channels = 4
-        else:
-            channels = 3
-    else:
-        return None
+        pt = Imath.PixelType(Imath.PixelType.FLOAT)
+        scan_lines = (size.min.y + y_0, size.min.y + y_1 - 1)
+        data = image.channels(list(channels), pt, *scan_lines)
 
-    image_o = np.zeros((resolution[1],resolution[0],channels), np.float32)
+        for c, buffer in enumerate(data):
+            channel = np.frombuffer(buffer, np.float32)
+            channel = channel.reshape(rows, resolution[0])[:, x_0:x_1]
+            if planar:
+                out[c] = channel
+            else:
+                out[:, :, c] = channel
+    finally:
+        image.close()
 
-    ch = ["R", "G", "B", "A"]
-    pt = Imath.PixelType(Imath.PixelType.FLOAT)
+    return out
 
-    for c in range(0, channels):
-        image_channel = np.fromstring(image.channel(ch[c], pt), np.float32)
-        image_o[:, :, c] = image_channel.reshape(resolution[1], resolution[0])
 
+def read_openexr_resolution(filename):
+    """Reads resolution (width, height) of an OpenEXR file from its header."""
+    filename = check_file_ext(filename, ".exr")
+
+    image = OpenEXR.InputFile(str(filename))
+    size = image.header()["dataWindow"]
     image.close()
 
-    return image_o
+    return (size.max.x - size.min.x + 1, size.max.y - size.min.y + 1)
+
+
+# Compression methods of OpenEXR files, names as used by Blender
+EXR_COMPRESSIONS = {
+    "NONE": Imath.Compression.NO_COMPRESSION,
+    "RLE": Imath.Compression.RLE_COMPRESSION,
+    "ZIPS": Imath.Compression.ZIPS_COMPRESSION,
+    "ZIP": Imath.Compression.ZIP_COMPRESSION,
+    "PIZ": Imath.Compression.PIZ_COMPRESSION,
+    "PXR24": Imath.Compression.PXR24_COMPRESSION,
+    "B44": Imath.Compression.B44_COMPRESSION,
+    "B44A": Imath.Compression.B44A_COMPRESSION,
+    "DWAA": Imath.Compression.DWAA_COMPRESSION,
+    "DWAB": Imath.Compression.DWAB_COMPRESSION,
+}
+
+
+def write_openexr_image(
+    filename,
+    image,
+    planar=False,
+    compression=None,
+    half=False,
+    half_rtol=1E-3
+):
+    """
+    Save image in OpenEXR file format from numpy array.
+
+    :type filename: Path or str
+    :param filename: OpenEXR file name.
+    :type image: numpy.ndarray
+    :param image: float32 image (height, width, channels).
+    :type planar: bool
+    :param planar: If True, image is (channels, height, width) and written
+                   without copies.
+    :type compression: str
+    :param compression: One of EXR_COMPRESSIONS, default is ZIP.
+    :type half: bool
+    :param half: Whether to store half floats. Images which do not pass
+                 check_half_precision are stored as float.
+    :type half_rtol: float
+    :param half_rtol: Tolerance of check_half_precision.
+    :returns: True if the image is stored as half floats.
+    """
+    if planar:
+        (channels, height, width) = image.shape
+    else:
+        (height, width, channels) = image.shape
 
+    if half:
+        with np.errstate(over="ignore"):
+            half_image = image.astype(np.float16)
+        half = check_half_precision(image, half_rtol, planar, half_image)
+        if half:
+            image = half_image
 
-def write_openexr_image(filename, image):
-    """Save image in OpenEXR file format from numpy array."""
-    filename = check_file_ext(filename, ".exr")
+    writer = OpenEXRWriter(filename, width, height, channels, compression, half)
+    try:
+        writer.write(image, planar)
+    finally:
+        writer.close()
 
-    height = len(image)
-    width = len(image[0])
-    channels = len(image[0][0])
-
-    # Default header only has RGB channels
-    hdr = OpenEXR.Header(width, height)
-
-    if channels == 4:
-        data_r = image[:, :, 0].tobytes()
-        data_g = image[:, :, 1].tobytes()
-        data_b = image[:, :, 2].tobytes()
-        data_a = image[:, :, 3].tobytes()
-        image_data = {"R": data_r, "G": data_g, "B": data_b, "A": data_a}
-        # Add alpha channel to header
-        alpha_channel = {"A": Imath.Channel(Imath.PixelType(OpenEXR.FLOAT))}
-        hdr["channels"].update(alpha_channel)
-
-    elif channels == 3:
-        data_r = image[:, :, 0].tobytes()
-        data_g = image[:, :, 1].tobytes()
-        data_b = image[:, :, 2].tobytes()
-        image_data = {"R": data_r, "G": data_g, "B": data_b}
-    else:
-        raise RuntimeError("Invalid number of channels of starmap image.")
+    return half
+
+
+def check_half_precision(image, rtol=1E-3, planar=False, half_image=None):
+    """
+    Checks whether an image keeps its calibration if stored as half floats.
+
+    Half floats overflow above 65504 and lose precision below 6.1E-5.
+    Calibration of the compositor uses sums over scene images, so the sum
+    of each channel has to be preserved within rtol and all values have to
+    be finite.
+
+    :type image: numpy.ndarray
+    :param image: float32 image (height, width, channels).
+    :type rtol: float
+    :param rtol: Relative tolerance of channel sums.
+    :type planar: bool
+    :param planar: If True, image is (channels, height, width).
+    :type half_image: numpy.ndarray
+    :param half_image: Optional image already converted to half floats.
+    :returns: True if the image can be stored as half floats.
+    """
+    axis = (1, 2) if planar else (0, 1)
+
+    half = half_image
+    if half is None:
+        with np.errstate(over="ignore"):
+            half = image.astype(np.float16)
+    if not np.all(np.isfinite(half)):
+        return False
+
+    ref_sums = np.sum(image, axis=axis, dtype=np.float64)
+    half_sums = np.sum(half, axis=axis, dtype=np.float64)
+    errors = np.abs(half_sums - ref_sums)
 
-    file_handler = OpenEXR.OutputFile(str(filename), hdr)
-    file_handler.writePixels(image_data)
-    file_handler.close()
+    return bool(np.all(errors <= rtol * np.abs(ref_sums)))
+
+
+class OpenEXRWriter:
+    """
+    Writes an OpenEXR image in strips of scan lines.
+
+    Images with 4 channels are stored as RGBA, with 3 channels as RGB and
+    single band images as luminance channel Y. Strips are written top to
+    bottom, so that images larger than memory can be written.
+    """
+
+    CHANNEL_NAMES = {1: ("Y",), 3: ("R", "G", "B"), 4: ("R", "G", "B", "A")}
+
+    def __init__(
+        self,
+        filename,
+        width,
+        height,
+        channels,
+        compression=None,
+        half=False
+    ):
+        """
+        :type filename: Path or str
+        :param filename: OpenEXR file name.
+        :type width: int
+        :param width: Image width.
+        :type height: int
+        :param height: Image height.
+        :type channels: int
+        :param channels: Number of channels, 1, 3 or 4.
+        :type compression: str
+        :param compression: One of EXR_COMPRESSIONS, default is ZIP.
+        :type half: bool
+        :param half: Whether pixels are stored as half floats.
+        """
+        if channels not in self.CHANNEL_NAMES:
+            raise RuntimeError("Invalid number of channels of starmap image.")
+        if compression is None:
+            compression = "ZIP"
+        if compression not in EXR_COMPRESSIONS:
+            raise RuntimeError(f"Invalid OpenEXR compression {compression}.")
+
+        filename = check_file_ext(filename, ".exr")
+
+        self.names = self.CHANNEL_NAMES[channels]
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+
+        if half:
+            self.dtype = np.float16
+            pixel_type = Imath.PixelType(Imath.PixelType.HALF)
+        else:
+            self.dtype = np.float32
+            pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+
+        # Default header only has RGB channels
+        hdr = OpenEXR.Header(width, height)
+        channel = Imath.Channel(pixel_type)
+        hdr["channels"] = {name: channel for name in self.names}
+        hdr["compression"] = Imath.Compression(EXR_COMPRESSIONS[compression])
+
+        self._file = OpenEXR.OutputFile(str(filename), hdr)
+
+    def write(self, image, planar=False):
+        """
+        Writes the next scan lines.
+
+        Contiguous float32 channels, e.g. of planar images, are passed to
+        the OpenEXR library as memoryview without copies. Half float
+        images are converted per channel.
+
+        :type image: numpy.ndarray
+        :param image: float32 or float16 array (rows, width, channels).
+        :type planar: bool
+        :param planar: If True, image is (channels, rows, width).
+        """
+        rows = image.shape[1] if planar else image.shape[0]
+        if self.rows_written + rows > self.height:
+            raise RuntimeError("More rows written than image height.")
+
+        image_data = {}
+        for c, name in enumerate(self.names):
+            channel = image[c] if planar else image[:, :, c]
+            channel = np.ascontiguousarray(channel, self.dtype)
+            image_data[name] = memoryview(channel)
+
+        self._file.writePixels(image_data, rows)
+        self.rows_written += rows
+
+    def close(self):
+        """Closes the file, all rows have to be written before."""
+        self._file.close()
 
 
 def read_png_image(filename):
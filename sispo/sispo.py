@@ -28,6 +28,7 @@
 from .compression import *
 from .reconstruction import *
 from .sim import *
+from .sim import compositor, runstore
 from .plugins import plugins
 
 logger = logging.getLogger("sispo")
@@ -68,6 +69,19 @@ def _create_parser():
                         action="store_true",
                         dest="with_render",
                         help="If set, SISPO will render the scenario")
+    parser.add_argument("--with-recompose",
+                        action="store_true",
+                        dest="with_recompose",
+                        help="If set, SISPO will compose existing raw images "
+                             "for each instrument of the recompose settings")
+    parser.add_argument("--rebuild-blend",
+                        action="store",
+                        default=None,
+                        type=str,
+                        dest="rebuild_blend",
+                        metavar="FRAME_ID",
+                        help="Rebuilds the .blend file of a rendered frame "
+                             "from the scene journal")
     parser.add_argument("--with-compression",
                         action="store_true",
                         dest="with_compression",
@@ -82,6 +96,20 @@ def _create_parser():
     parser.add_argument("--opengl",
                         action="store_true",
                         help="Use OpenGL based rendering")
+    parser.add_argument("--render-workers",
+                        action="store",
+                        default=1,
+                        type=int,
+                        dest="render_workers",
+                        help="Number of Blender render processes, frames "
+                             "are partitioned across processes")
+    parser.add_argument("--render-threads",
+                        action="store",
+                        default=None,
+                        type=int,
+                        dest="render_threads",
+                        help="Cycles threads per render process, default "
+                             "are all CPUs shared by the processes")
     parser.add_argument("--profile",
                         action="store_true",
                         help="Use cProfiler and write results to log.")
@@ -122,6 +150,8 @@ def read_input():
         # If all options are false it is default case and all steps are done
         if (not settings["options"].with_sim and
             not settings["options"].with_render and
+            not settings["options"].with_recompose and
+            settings["options"].rebuild_blend is None and
             not settings["options"].with_compression and
             not settings["options"].with_reconstruction):
 
@@ -174,8 +204,20 @@ def parse_input(settings):
     if "reconstruction" not in settings:
         logger.debug("No reconstruction settings provided!")
 
+    if "recompose" not in settings:
+        if settings["options"].with_recompose:
+            raise RuntimeError("--with-recompose requires a recompose section "
+                               "with raw_dir, res_dir and instruments in the "
+                               "definition file.")
+        logger.debug("No recompose settings provided!")
+
+    # Raw images to recompose might be rendered in the same run, recompose
+    # paths are therefore parsed when recomposing
+    recomp_settings = settings.pop("recompose", None)
     settings = _parse_paths(settings)
     settings = _parse_flags(settings)
+    if recomp_settings is not None:
+        settings["recompose"] = _parse_flags(recomp_settings)
 
     return settings
 
@@ -297,9 +339,24 @@ def main():
 
     logger.debug("Run full pipeline")
 
-    if settings["options"].with_sim or settings["options"].with_render:
+    render_workers = settings["options"].render_workers
+    render_threads = settings["options"].render_threads
+    sharded = (settings["options"].with_render and render_workers > 1
+               and not settings["options"].opengl)
+
+    if sharded:
+        logger.debug("With rendering in %d processes", render_workers)
+        if settings["options"].with_plugins:
+            logger.debug("Plugins are not run with several render workers")
+        render_sharded(sim_settings,
+                       render_workers,
+                       render_threads,
+                       settings["options"].with_sim,
+                       ext_logger=logger)
+
+    elif settings["options"].with_sim or settings["options"].with_render:
         logger.debug("With either simulation or rendering")
-        env = Environment(**sim_settings, ext_logger=logger, opengl_renderer=settings["options"].opengl)
+        env = Environment(**sim_settings, threads=render_threads, ext_logger=logger, opengl_renderer=settings["options"].opengl)
 
         if settings["options"].with_sim:
             env.simulate()
@@ -310,6 +367,18 @@ def main():
         if settings["options"].with_render:
             env.render()
 
+    if settings["options"].rebuild_blend is not None:
+        frame_id = settings["options"].rebuild_blend
+        logger.debug("Rebuilding .blend file of frame %s", frame_id)
+        from .sim import render
+        filename = render.rebuild_blend(sim_settings["res_dir"] / "raw",
+                                        frame_id)
+        logger.debug("Saved %s", filename)
+
+    if settings["options"].with_recompose:
+        logger.debug("With recompose")
+        recompose(settings["recompose"], sim_settings)
+
     if settings["options"].with_compression:
         logger.debug("With compression")
         comp = compression.Compressor(**comp_settings, ext_logger=logger)
@@ -339,6 +408,57 @@ def main():
     logger.debug("Finished sispo main")
 
 
+def recompose(recomp_settings, sim_settings):
+    """
+    Composes existing raw images for several instrument variants.
+
+    :type recomp_settings: dict
+    :param recomp_settings: Recompose settings with raw_dir, res_dir and
+                            instruments, a dict of variant names and
+                            instrument characteristics. sssb, with_infobox,
+                            with_clipping and compositor settings default to
+                            the simulation settings. Raw frames are read
+                            from the run store in raw_dir if it exists.
+    :type sim_settings: dict
+    :param sim_settings: Simulation settings.
+    """
+    def get_setting(key, default=None):
+        return recomp_settings.get(key, sim_settings.get(key, default))
+
+    raw_dir = utilities.check_dir(recomp_settings["raw_dir"], False)
+    res_dir = utilities.check_dir(recomp_settings["res_dir"])
+
+    instruments = {}
+    for name, charas in recomp_settings["instruments"].items():
+        instruments[name] = Instrument(charas)
+
+    comp_settings = get_setting("compositor")
+    if comp_settings is None:
+        comp_settings = {}
+
+    # Raw frames of runs with run store are read from the store
+    store_dir = raw_dir / "store"
+    if runstore.RunStore.exists(store_dir):
+        store = runstore.RunStore(store_dir)
+    else:
+        store = None
+
+    comp = compositor.ImageCompositor(res_dir,
+                                      raw_dir,
+                                      None,
+                                      get_setting("sssb"),
+                                      get_setting("with_infobox", False),
+                                      get_setting("with_clipping", False),
+                                      logger,
+                                      exr=get_setting("exr", {}).get("composition"),
+                                      store=store,
+                                      **comp_settings)
+    try:
+        comp.recompose(instruments)
+    finally:
+        comp.close()
+
+
 def run():
     """Alias for :py:func:`main` ."""
     main()
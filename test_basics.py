@@ -1,10 +1,16 @@
 """Test suite."""
 
+import logging
+import shutil
+import tempfile
 import unittest
 from pathlib import Path
 
 import numpy as np
-import sispo.sim.utilities as utils
+# sispo.sim is shadowed by the star imported sispo.sim.sim module, so
+# sub-modules are imported from the package
+from sispo.sim import compositor, noise, psf, runstore, sc, smear
+from sispo.sim import utilities as utils
 
 
 class TestUtils(unittest.TestCase):
@@ -55,6 +61,195 @@ def test_serialise(self):
         self.assertEqual(utils.serialise(test_array), [0, 1, 2, 3, 4, 5, 6])
         self.assertEqual(utils.serialise(test_float), float(test_float))
 
+    def test_openexr_window(self):
+        file_dir = Path(__file__).parent.resolve()
+        filename = file_dir / "window_test.exr"
+
+        rng = np.random.default_rng(0)
+        image = rng.random((30, 40, 4), dtype=np.float32)
+        utils.write_openexr_image(filename, image)
+
+        window = utils.read_openexr_image(filename, ("A", "R"), (5, 12), (3, 20))
+        self.assertTrue(np.array_equal(window, image[5:12, 3:20][:, :, [3, 0]]))
+
+        planar = np.empty((4, 30, 40), np.float32)
+        utils.read_openexr_image(filename, out=planar, planar=True)
+        self.assertTrue(np.array_equal(planar, image.transpose(2, 0, 1)))
+
+        filename.unlink()
+
+
+class TestPSF(unittest.TestCase):
+    """PSF engine tests"""
+    def test_engines(self):
+        rng = np.random.default_rng(0)
+        image = rng.random((120, 160, 3), dtype=np.float32)
+        gauss = psf.gaussian_psf(3.0)
+
+        reference = gauss.apply(image, engine="separable")
+        for engine in ("spatial", "fft"):
+            result = gauss.apply(image, engine=engine)
+            self.assertTrue(np.allclose(result, reference, atol=1E-5))
+
+        kernel = psf.PSF(rng.random((7, 11)))
+        reference = kernel.apply(image, engine="spatial")
+        result = kernel.apply(image, engine="fft")
+        self.assertTrue(np.allclose(result, reference, atol=1E-5))
+
+    def test_bessel_j1(self):
+        values = psf.bessel_j1([0., 1., -2., 5., 10.])
+        expected = [0., 0.44005059, -0.57672481, -0.32757914, 0.04347275]
+        self.assertTrue(np.allclose(values, expected, atol=1E-7))
+
+
+class TestNoise(unittest.TestCase):
+    """Detector noise tests"""
+    def test_tiles(self):
+        model = noise.NoiseModel(seed=1, read_noise=2., strip_rows=16)
+        image = np.full((64, 32), 50., np.float32)
+
+        reference = model.apply(image, "frame")
+        result = model.apply(image[32:], "frame", row_offset=32)
+        self.assertTrue(np.array_equal(result, reference[32:]))
+
+        with self.assertRaises(noise.NoiseError):
+            model.apply(image, "frame", row_offset=8)
+
+
+class TestSmear(unittest.TestCase):
+    """Motion smear tests"""
+    def test_line_kernel(self):
+        motion = smear.MotionSmear(0.5, 1000.)
+        self.assertIsNone(motion.line_kernel((0.5, 0.5)))
+
+        kernel = motion.line_kernel((20., 6.))
+        self.assertAlmostEqual(float(np.sum(kernel)), 1., places=6)
+        self.assertTrue(np.allclose(kernel, kernel[::-1, ::-1]))
+
+        image = np.zeros((64, 64), np.float32)
+        image[32, 32] = 1.
+        result = motion.apply(image, (20., 0.))
+        x_mean = np.sum(result * np.arange(64)[None, :])
+        self.assertAlmostEqual(float(x_mean), 32., places=4)
+
+
+class TestRunStore(unittest.TestCase):
+    """Run store tests"""
+    def test_append_read(self):
+        store_dir = Path(__file__).parent.resolve() / "store_test"
+        image = np.random.default_rng(0).random((100, 20, 4), np.float32)
+
+        for compression in (None, "zlib"):
+            store = runstore.RunStore(store_dir, compression, chunk_rows=16)
+            store.append_scene("frame", "SssbOnly", image)
+            self.assertNotIn("frame", runstore.RunStore(store_dir))
+
+            store.append_frame("frame", {"distance": 1.})
+            store.close()
+
+            reader = runstore.RunStore(store_dir)
+            self.assertEqual(reader.frame_ids, ["frame"])
+            self.assertEqual(reader.get_metadata("frame")["distance"], 1.)
+            result = reader.read("frame", "SssbOnly", ("A", "R"), (30, 70))
+            self.assertTrue(np.array_equal(result, image[30:70, :, [3, 0]]))
+
+            for filename in store_dir.iterdir():
+                filename.unlink()
+            Path.rmdir(store_dir)
+
+
+class TestCompositor(unittest.TestCase):
+    """Compositor tests"""
+    @staticmethod
+    def create_store(store_dir):
+        """Run store with one random 64 x 48 frame."""
+        rng = np.random.default_rng(0)
+        image = rng.random((64, 48, 4), np.float32)
+        image[:, :, 3] = image[:, :, 3] > 0.5
+        metadata = {
+            "date": "2017-08-15T120000-000000",
+            "distance": 1E5,
+            "sc_pos": [1.5E11, 0., 0.],
+            "sssb_pos": [1.5E11, 1E5, 0.],
+            "total_flux": 1.,
+        }
+
+        store = runstore.RunStore(store_dir)
+        for scene_name in compositor.Frame.SCENE_CHANNELS:
+            store.append_scene("frame", scene_name, image)
+        store.append_frame("frame", metadata)
+        store.close()
+
+        return store
+
+    def test_recompose_reads(self):
+        tmp_dir = Path(tempfile.mkdtemp())
+        store = self.create_store(tmp_dir / "store")
+
+        reads = []
+        read = store.read
+        def count_read(*args, **kwargs):
+            reads.append(args[1])
+            return read(*args, **kwargs)
+        store.read = count_read
+
+        comp = compositor.ImageCompositor(
+            tmp_dir, tmp_dir, None, {"max_dim": 512, "albedo": 0.15}, False,
+            False, logging.getLogger("test"), workers=1, store=store
+        )
+        counts = []
+        for variants in (1, 3):
+            reads.clear()
+            instruments = {
+                f"inst{k}": sc.Instrument({"res": [48, 64]})
+                for k in range(variants)
+            }
+            comp.recompose(instruments, tmp_dir)
+            counts.append(sorted(reads))
+        comp.close()
+        shutil.rmtree(tmp_dir)
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(len(counts[0]), len(set(counts[0])))
+
+    def test_failure_reported_once(self):
+        tmp_dir = Path(tempfile.mkdtemp())
+        store = self.create_store(tmp_dir / "store")
+        comp = compositor.ImageCompositor(
+            tmp_dir, tmp_dir, sc.Instrument({"res": [48, 64]}),
+            {"max_dim": 512, "albedo": 0.15}, False, False,
+            logging.getLogger("test"), workers=1, store=store
+        )
+
+        with self.assertRaises(runstore.RunStoreError):
+            comp.compose("missing")
+        comp.close()
+        shutil.rmtree(tmp_dir)
+
+    def test_tiled_compose(self):
+        tmp_dir = Path(tempfile.mkdtemp())
+        store = self.create_store(tmp_dir / "store")
+        instrument = sc.Instrument({"res": [48, 64], "noise": {"strip_rows": 16}})
+
+        results = []
+        for tile_rows in (None, 16, 40):
+            comp = compositor.ImageCompositor(
+                tmp_dir, tmp_dir, None, {"max_dim": 512, "albedo": 0.15},
+                False, False, logging.getLogger("test"), workers=1,
+                tile_rows=tile_rows, store=store
+            )
+            comp.recompose({f"tiles{tile_rows}": instrument}, tmp_dir)
+            comp.close()
+            (exrfile,) = (tmp_dir / f"tiles{tile_rows}").glob("Comp_*.exr")
+            results.append(utils.read_openexr_image(exrfile))
+        shutil.rmtree(tmp_dir)
+
+        # Tiles may select other convolution engines or FFT blocks, frames
+        # are equal within float32 rounding
+        for result in results[1:]:
+            np.testing.assert_allclose(result, results[0], rtol=1E-6,
+                                       atol=1E-7)
+
 
 if __name__ == "__main__":
     unittest.main()